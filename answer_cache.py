@@ -0,0 +1,124 @@
+import hashlib
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# 相似度阈值：新问题与缓存问题的余弦相似度不低于该值时直接返回缓存答案
+SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+# 缓存条目有效期 (秒)
+TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600)))
+# 进程内最多缓存的答案数 (LRU 淘汰)
+MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+
+
+def kb_version(embed_key, model_name, doc_ids):
+    """
+    知识库内容版本：由 Embedding 模型、回答模型和文档内容哈希集合决定。
+    文档增删后版本随之改变，旧答案自然失效；
+    文档集合相同的用户 (例如同一门课的学生) 共享同一版本的缓存。
+    """
+    raw = "|".join([embed_key, model_name] + sorted(doc_ids))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:24]
+
+
+def _strip_sources(docs):
+    """缓存的参考片段不保留来源文件名 (由命中的用户按自己登记的文件名重新标注)"""
+    return [
+        type(doc)(page_content=doc.page_content, metadata={k: v for k, v in doc.metadata.items() if k != 'source'})
+        for doc in docs
+    ]
+
+
+def _normalize(vector):
+    import numpy as np
+    vec = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+class SemanticAnswerCache:
+    """
+    按知识库版本分区的语义答案缓存 (跨用户共享)。
+    用问题向量做最近邻匹配，支持 LRU + TTL 淘汰，并统计命中率。
+    条目中不保存提问原文和上传者的文件名，命中时不会暴露其他用户的问题或文件名。
+    """
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, ttl=TTL_SECONDS, max_entries=MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        # (version, entry_id) -> entry，按最近使用排序
+        self._entries = OrderedDict()
+        # version -> {entry_id: entry}
+        self._by_version = {}
+
+    def _drop(self, version, entry_id):
+        self._entries.pop((version, entry_id), None)
+        bucket = self._by_version.get(version)
+        if bucket is not None:
+            bucket.pop(entry_id, None)
+            if not bucket:
+                del self._by_version[version]
+
+    def lookup(self, version, query_vector):
+        """
+        :return: (entry, score) 或 None；entry 为 dict (answer, docs, created_at)，docs 不含 source
+        """
+        import numpy as np
+        query = _normalize(query_vector)
+        now = time.time()
+
+        with self._lock:
+            bucket = self._by_version.get(version, {})
+            for entry_id, entry in list(bucket.items()):
+                if now - entry['created_at'] > self.ttl:
+                    self._drop(version, entry_id)
+
+            bucket = self._by_version.get(version)
+            if bucket:
+                entry_ids = list(bucket)
+                matrix = np.stack([bucket[i]['vector'] for i in entry_ids])
+                scores = matrix @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.hits += 1
+                    self._entries.move_to_end((version, entry_ids[best]))
+                    return bucket[entry_ids[best]], float(scores[best])
+
+            self.misses += 1
+            return None
+
+    def store(self, version, query_vector, answer, docs):
+        entry = {
+            'answer': answer,
+            'docs': _strip_sources(docs),
+            'vector': _normalize(query_vector),
+            'created_at': time.time(),
+        }
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[(version, entry_id)] = entry
+            self._by_version.setdefault(version, {})[entry_id] = entry
+            while len(self._entries) > self.max_entries:
+                (old_version, old_id), _ = self._entries.popitem(last=False)
+                self._drop(old_version, old_id)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+
+# 进程级共享实例
+cache = SemanticAnswerCache()
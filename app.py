@@ -1,6 +1,7 @@
 import streamlit as st
 import os
 import warnings
+import functools
 
 # --- 针对 Streamlit Cloud 的 SQLite 补丁 (解决 ChromaDB 部署报错) ---
 # 必须在引入 chromadb 或 langchain 之前运行
@@ -12,8 +13,6 @@ except ImportError:
     pass
 # ---------------------------------------------------------------
 
-import oss2 # 引入 OSS SDK
-
 # 💡 关键修复：必须在引入任何 HuggingFace 相关库之前设置镜像环境变量
 # 这样才能确保 sentence-transformers 和 transformers 使用镜像站
 os.environ['HF_ENDPOINT'] = 'https://hf-mirror.com'
@@ -28,29 +27,34 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 warnings.filterwarnings("ignore", message=".*pkg_resources is deprecated.*")
 # 忽略 LangChain 的 HuggingFaceEmbeddings 弃用警告
 warnings.filterwarnings("ignore", message=".*HuggingFaceEmbeddings was deprecated.*")
-# 忽略一般性的 LangChainDeprecationWarning
-try:
-    from langchain_core._api.deprecation import LangChainDeprecationWarning
-    warnings.filterwarnings("ignore", category=LangChainDeprecationWarning)
-except ImportError:
-    pass
 
-import tempfile
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import HuggingFaceEmbeddings # 引入本地 Embeddings
-from langchain.chains import create_retrieval_chain
-# from langchain.chains.combine_documents import create_stuff_documents_chain # 暂时移除以解决 Streamlit Cloud 报错
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough, RunnableLambda
-from langchain_core.output_parsers import StrOutputParser
+# 重量级依赖 (LangChain / torch / oss2 / requests) 均在对应功能首次使用时才导入，
+# 登录页只需要 streamlit 和数据库模块。导入耗时可用 bench_imports.py 测量。
+@functools.cache
+def silence_langchain_warnings():
+    """忽略一般性的 LangChainDeprecationWarning (首次进入主界面时执行一次)"""
+    try:
+        from langchain_core._api.deprecation import LangChainDeprecationWarning
+        warnings.filterwarnings("ignore", category=LangChainDeprecationWarning)
+    except ImportError:
+        pass
+
 from dotenv import load_dotenv
-from openai import OpenAI # 引入 OpenAIError 基类
 # from BingImageCreator import ImageGen # 原版引入
-from bing_debug import ImageGen # 引入调试版 ImageGen
+import bing_pool # 按 Cookie 指纹复用的 Bing 会话池 (基于调试版 ImageGen)
 import db_manager # 引入数据库管理器
+import embedding_manager # 进程级共享 Embedding 模型
+import ingest_cache # 文档解析/切分/向量的磁盘缓存
+import ingestion # 文档解析与切分
+import knowledge_base # 用户持久化知识库
+import llm_clients # 跨 rerun 复用的 LLM 客户端与链
+import answer_cache # 按知识库版本分区的语义答案缓存
+import chat_history # 有上限、按窗口渲染的对话记录
+import context_builder # 按 token 预算拼接参考资料
+import image_jobs # 后台绘图任务队列
+import image_providers # 多绘图服务并发请求
+import image_store # 生成图片的本地内容寻址存储
+import oss_backup # 后台 OSS 备份 (按内容哈希去重、分片断点续传)
 
 # 加载环境变量
 load_dotenv()
@@ -58,9 +62,6 @@ load_dotenv()
 # 设置页面配置 (必须是第一个 Streamlit 命令)
 st.set_page_config(page_title="🎓 校园知识库助手 (RAG + 🎨)", layout="wide")
 
-# 初始化数据库
-db_manager.init_db()
-
 # 初始化 Session State
 if "user_id" not in st.session_state:
     st.session_state.user_id = None
@@ -70,58 +71,68 @@ if "user_config" not in st.session_state:
     st.session_state.user_config = {}
 
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = chat_history.ChatHistory()
 
 if "vector_store" not in st.session_state:
     st.session_state.vector_store = None
 
-if "current_docs" not in st.session_state: # 用于存储当前文档内容用于摘要
-    st.session_state.current_docs = None
-
-# --- 辅助函数：OSS 上传 ---
-def upload_file_to_oss(file_obj, filename, config):
-    """
-    上传文件到阿里云 OSS
-    :param file_obj: Streamlit UploadedFile 对象
-    :param filename: 文件名
-    :param config: 用户配置字典 (包含 OSS 凭证)
-    :return: (bool, str) -> (是否成功, 消息/URL)
-    """
-    endpoint = config.get('oss_endpoint')
-    access_key_id = config.get('oss_access_key_id')
-    access_key_secret = config.get('oss_access_key_secret')
-    bucket_name = config.get('oss_bucket_name')
-
-    # 简单校验
-    if not all([endpoint, access_key_id, access_key_secret, bucket_name]):
-        return False, "OSS 配置不完整"
-
-    try:
-        import time
-        # 1. 认证
-        auth = oss2.Auth(access_key_id, access_key_secret)
-        # 2. 获取 Bucket
-        # 确保 endpoint 不带 http/https (或者带了也行，oss2比较智能)
-        # 规范化：oss2.Bucket 需要 http://...
-        if not endpoint.startswith('http'):
-            endpoint = 'http://' + endpoint
-            
-        bucket = oss2.Bucket(auth, endpoint, bucket_name)
-        
-        # 3. 构造云端路径 (例如 uploads/20231027/timestamp_filename.pdf)
-        date_str = time.strftime("%Y%m%d")
-        # 使用 int(time.time()) 防止重名
-        cloud_path = f"uploads/{date_str}/{int(time.time())}_{filename}"
-        
-        # 4. 上传
-        # UploadedFile.getvalue() 返回 bytes
-        bucket.put_object(cloud_path, file_obj.getvalue())
-        
-        # 5. 成功提示
-        return True, f"已备份至 OSS: {cloud_path}"
-        
-    except Exception as e:
-        return False, str(e)
+if "llm_slots" not in st.session_state: # 当前 Session 使用的客户端缓存键
+    st.session_state.llm_slots = {}
+
+if "kb_documents" not in st.session_state: # 当前知识库中的文档列表
+    st.session_state.kb_documents = []
+
+if "current_doc_id" not in st.session_state: # 最近处理的文档 (只保存哈希，文本按需从磁盘读取)
+    st.session_state.current_doc_id = None
+
+# --- 辅助函数："记住此设备" 令牌 ---
+# 令牌保存在浏览器 Cookie 中，不出现在页面链接 (浏览历史、代理日志) 里
+SESSION_COOKIE = "kb_session"
+
+def read_session_cookie():
+    """读取浏览器随连接带上的令牌 (st.context 需要 Streamlit 1.37+，更早的版本不支持免登录)"""
+    context = getattr(st, "context", None)
+    if context is None:
+        return None
+    return context.cookies.get(SESSION_COOKIE)
+
+def set_session_cookie(token, max_age):
+    """在下一次渲染时写入 (token 为空、max_age 为 0 时删除) 令牌 Cookie"""
+    st.session_state.pending_session_cookie = (token, max_age)
+
+def flush_session_cookie():
+    pending = st.session_state.pop("pending_session_cookie", None)
+    if pending is None:
+        return
+    import json
+    import streamlit.components.v1 as components
+    token, max_age = pending
+    # 组件运行在同源 iframe 中，写入主页面的 Cookie
+    components.html(
+        "<script>"
+        f"parent.document.cookie = {json.dumps(SESSION_COOKIE)} + '=' + {json.dumps(token)}"
+        f" + '; path=/; max-age={int(max_age)}; SameSite=Strict'"
+        " + (parent.location.protocol === 'https:' ? '; Secure' : '');"
+        "</script>",
+        height=0,
+    )
+
+# --- 辅助函数：OSS 备份 ---
+def report_oss_backups():
+    """显示已完成的后台 OSS 备份结果 (未完成的留到下次 rerun)"""
+    pending = []
+    for future in st.session_state.get("oss_backups") or []:
+        if not future.done():
+            pending.append(future)
+            continue
+        success, msg = future.result()
+        if success:
+            st.toast(msg, icon="☁️")
+        else:
+            # 仅显示警告，不打断流程
+            print(f"OSS Upload Warning: {msg}")
+            st.warning(f"OSS 备份失败: {msg}")
+    st.session_state.oss_backups = pending
 
 # --- 辅助函数：处理 API 错误 ---
 def handle_api_error(e):
@@ -141,6 +152,21 @@ def handle_api_error(e):
     else:
         return f"❌ **发生错误**: {error_str}"
 
+# --- 辅助函数：展示绘图错误 ---
+def describe_image_error(error_str):
+    """根据错误信息给出对应的提示"""
+    error_str = error_str or ""
+    if "AuthCookieError" in error_str or "Unauthorized" in error_str:
+        st.error("❌ **Cookie 无效或过期**\n请重新获取 _U Cookie 并更新。")
+    elif "Redirect" in error_str or "30 redirects" in error_str:
+        st.error(f"❌ **重定向错误 (Redirect Loop)**\n\n{error_str}\n\n原因：Bing 可能将您的请求重定向到了错误的区域 (如 cn.bing.com)。请尝试更换为美国/日本节点。")
+    elif "Could not get results" in error_str or "timed out" in error_str:
+        st.error("❌ **生成超时或无结果**\n\nBing 正在处理任务但未返回结果。这通常是因为：\n1. **网络波动**：连接 Bing 服务器不稳定。\n2. **服务器繁忙**：Bing 免费服务当前负载过高。\n3. **Prompt 违规**：提示词可能触发了审核机制但没明确报错。\n\n👉 **建议**：稍等几秒再试一次，或尝试修改提示词。")
+    elif error_str == "Cancelled":
+        st.info("任务已取消。")
+    else:
+        st.error(f"❌ **绘图出错**: {error_str}")
+
 # --- 登录/注册页面 ---
 def auth_page():
     st.title("🎓 校园知识库助手 - 登录")
@@ -151,6 +177,7 @@ def auth_page():
         with st.form("login_form"):
             username = st.text_input("用户名")
             password = st.text_input("密码", type="password")
+            remember = st.checkbox("记住此设备", help=f"{db_manager.SESSION_TTL // 86400} 天内在此浏览器打开本页面免登录 (请勿在公共电脑上勾选)")
             submit = st.form_submit_button("登录")
             
             if submit:
@@ -161,6 +188,10 @@ def auth_page():
                     st.session_state.username = username
                     # 加载用户配置
                     st.session_state.user_config = db_manager.get_user_config(user_id)
+                    if remember:
+                        # 令牌保存在浏览器 Cookie 中，刷新或重新打开页面后直接恢复登录
+                        st.session_state.session_token = db_manager.create_session(user_id)
+                        set_session_cookie(st.session_state.session_token, db_manager.SESSION_TTL)
                     st.rerun()
                 else:
                     st.error(msg)
@@ -184,8 +215,38 @@ def auth_page():
                     else:
                         st.error(msg)
 
+# --- 对话记录 ---
+def _persist_message(message):
+    """ChatHistory 的持久化回调：发送第一条消息时才创建对话"""
+    if st.session_state.get("conversation_id") is None:
+        st.session_state.conversation_id = db_manager.create_conversation(st.session_state.user_id, message["content"][:30])
+        st.session_state.conversations = None
+    db_manager.append_chat_message(st.session_state.user_id, st.session_state.conversation_id, message["role"], message["content"])
+
+def open_conversation(user_id, conversation_id=None):
+    """只加载对话最近的一页消息；conversation_id 为空时恢复最近一次对话"""
+    st.session_state.conversations = db_manager.list_conversations(user_id)
+    if conversation_id is None and st.session_state.conversations:
+        conversation_id = st.session_state.conversations[0]['id']
+    history = chat_history.ChatHistory(sink=_persist_message)
+    if conversation_id is not None:
+        messages, has_older = db_manager.load_chat_messages(user_id, conversation_id, limit=chat_history.RENDER_WINDOW)
+        history.extend_older(messages, has_older)
+    st.session_state.messages = history
+    st.session_state.conversation_id = conversation_id
+    st.session_state.chat_user_id = user_id
+
+def new_conversation():
+    st.session_state.messages = chat_history.ChatHistory(sink=_persist_message)
+    st.session_state.conversation_id = None
+
 # --- 主应用逻辑 ---
 def main_app():
+    silence_langchain_warnings()
+    # 登录 (或用令牌恢复登录) 后恢复最近一次对话
+    if st.session_state.get("chat_user_id") != st.session_state.user_id:
+        open_conversation(st.session_state.user_id)
+    report_oss_backups()
     # 标题
     st.title(f"🤖 校园知识库助手 (欢迎, {st.session_state.username})")
     st.markdown("上传文档，支持 **智能问答** 和 **创意配图生成**！")
@@ -194,6 +255,9 @@ def main_app():
     with st.sidebar:
         st.header("⚙️ 设置")
         debug_mode = st.checkbox("开发者调试模式", value=False, key="input_debug_mode")
+        if debug_mode:
+            stats = answer_cache.cache.stats()
+            st.caption(f"⚡ 答案缓存: {stats['entries']} 条 · 命中 {stats['hits']} / 未命中 {stats['misses']} ({stats['hit_rate']:.0%})")
         
         # 获取默认值 (从 session_state.user_config 中取，如果没有则用默认值)
         cfg = st.session_state.user_config
@@ -229,6 +293,27 @@ def main_app():
             default_embed_idx = embed_options.index(cfg.get('embedding_type'))
             
         embedding_type = st.selectbox("Embeddings 模型", embed_options, index=default_embed_idx, key="input_embedding_type")
+        embed_key = embedding_manager.get_embedding_key(embedding_type, base_url)
+        if embedding_type == "本地 HuggingFace (免费/慢)":
+            # 后台预热本地 Embedding 模型 (每个进程只会执行一次)
+            embedding_manager.start_warmup()
+        
+        # 重新连接用户的持久化知识库 (登录后、切换 Embedding 模型或更换 API Key 时)
+        # 键中包含 Key 的哈希：更换 Key 后不再沿用以旧 Key 创建的 Embedding 客户端
+        kb_key = (st.session_state.user_id, embed_key, llm_clients.hash_key(api_key))
+        if st.session_state.get("kb_key") != kb_key and (api_key or embedding_type == "本地 HuggingFace (免费/慢)"):
+            try:
+                embeddings = ingest_cache.cached_embeddings(
+                    embedding_manager.get_embeddings(embedding_type, api_key, base_url), embed_key
+                )
+                st.session_state.vector_store = knowledge_base.open_store(st.session_state.user_id, embeddings, embed_key)
+                st.session_state.kb_documents = knowledge_base.list_documents(st.session_state.user_id, embed_key)
+                st.session_state.kb_key = kb_key
+                st.session_state.current_doc_id = None
+            except Exception as e:
+                print(f"DEBUG: Failed to open knowledge base: {e}")
+                st.session_state.vector_store = None
+                st.session_state.kb_documents = []
         
         with st.expander("🎨 绘图设置 (可选)"):
             image_provider_opts = ["OpenAI DALL-E 3", "Bing Image Creator (免费)", "SiliconFlow (Flux)"]
@@ -336,161 +421,170 @@ def main_app():
         if image_provider == "Bing Image Creator (免费)":
             if st.button("🧪 测试 Bing 连接 (检查 Cookie)"):
                 try:
-                    final_u = bing_cookie
-                    final_srch = bing_cookie_srch
-                    all_cookies_list = []
-                    if full_cookie_str:
-                        full_cookie_str = full_cookie_str.strip()
-                        if full_cookie_str.lower().startswith("cookie:"):
-                            full_cookie_str = full_cookie_str[7:].strip()
-                        if full_cookie_str.startswith('[') and full_cookie_str.endswith(']'):
-                            import json
-                            json_cookies = json.loads(full_cookie_str)
-                            for item in json_cookies:
-                                if 'name' in item and 'value' in item:
-                                    all_cookies_list.append({'name': item['name'], 'value': item['value']})
-                                    if item['name'] == "_U":
-                                        final_u = item['value']
-                                    elif item['name'] == "SRCHHPGUSR":
-                                        final_srch = item['value']
-                        else:
-                            for item in full_cookie_str.split(';'):
-                                if '=' in item:
-                                    k, v = item.strip().split('=', 1)
-                                    all_cookies_list.append({'name': k, 'value': v})
-                                    if k.strip() == "_U":
-                                        final_u = v
-                                    elif k.strip() == "SRCHHPGUSR":
-                                        final_srch = v
+                    final_u, final_srch, all_cookies_list = bing_pool.parse_cookies(bing_cookie, bing_cookie_srch, full_cookie_str)
                     if not final_u:
                         st.error("❌ 无法找到 _U Cookie，请先填写配置！")
                     else:
-                        if not final_srch:
-                            final_srch = final_u
-                        test_gen = ImageGen(
-                            auth_cookie=final_u,
-                            auth_cookie_SRCHHPGUSR=final_srch,
-                            all_cookies=all_cookies_list,
-                            quiet=(not debug_mode),
-                            user_agent=user_agent
-                        )
-                        if proxy_url:
-                            test_gen.session.proxies = {"http": proxy_url, "https": proxy_url}
+                        pool_args = (st.session_state.user_id, final_u, final_srch, all_cookies_list, proxy_url, user_agent)
                         with st.spinner("正在验证 Bing 连接..."):
-                            if test_gen.validate_session():
+                            # 手动点击测试时强制重新验证，并刷新缓存的验证结果
+                            valid, _ = bing_pool.validate(*pool_args, force=True)
+                            if valid:
                                 st.success("✅ Bing 连接成功！Cookie 有效，且未检测到登录跳转。")
                             else:
                                 st.error("❌ Bing 连接验证失败：Cookie 可能失效，或 IP 被重定向到登录页。请检查日志。")
+                            # 出口 IP 探测只在调试模式下进行
+                            if debug_mode:
+                                ip_info = bing_pool.ip_diagnostics(*pool_args)
+                                if ip_info:
+                                    st.caption(f"🌐 当前出口 IP: {ip_info.get('query')} ({ip_info.get('country')})")
                 except Exception as e:
                     st.error(f"测试出错: {e}")
 
         if st.button("🚪 退出登录"):
+            # 作废 "记住此设备" 令牌 (本次连接后轮换过的令牌保存在 session_token 中)
+            db_manager.revoke_session(st.session_state.get("session_token") or read_session_cookie())
+            st.query_params.clear()
             # 清除所有 Session State，确保登出彻底
             st.session_state.clear()
+            set_session_cookie("", 0)
             st.rerun()
 
         st.divider()
         
+        # 知识库文档列表
+        st.header("📚 我的知识库")
+        kb_documents = st.session_state.get("kb_documents") or []
+        if not kb_documents:
+            st.caption("知识库为空，请在下方上传文档。")
+        for kb_doc in kb_documents:
+            doc_col, del_col = st.columns([4, 1])
+            shared_tag = " · 共享索引" if kb_doc.get('shared') else ""
+            doc_col.markdown(f"📄 {kb_doc['filename']}  \n`{kb_doc['chunk_count']} 个片段{shared_tag}`")
+            if del_col.button("🗑️", key=f"kb_remove_{kb_doc['doc_id']}", help="从知识库中移除该文档"):
+                knowledge_base.remove_document(st.session_state.vector_store, st.session_state.user_id, embed_key, kb_doc['doc_id'])
+                st.session_state.kb_documents = knowledge_base.list_documents(st.session_state.user_id, embed_key)
+                st.session_state.current_doc_id = None
+                st.rerun()
+
+        st.divider()
+        
         # 文件上传
         st.header("📂 文档上传")
-        uploaded_file = st.file_uploader("上传 PDF 或 TXT 文件", type=["pdf", "txt"])
+        uploaded_files = st.file_uploader("上传 PDF 或 TXT 文件 (可多选)", type=["pdf", "txt"], accept_multiple_files=True)
+        private_upload = st.checkbox(
+            "🔒 私有文档 (不与其他用户共享索引)", value=False, key="input_private_upload",
+            help="默认情况下，与其他用户内容完全相同的文件 (如课程大纲、学生手册) 共用一份只读索引，不会重复计算向量。",
+        )
         
-        if uploaded_file and st.button("开始处理文档"):
+        if uploaded_files and st.button("开始处理文档"):
             if not api_key:
                 st.error("请先输入 API Key！")
+            elif st.session_state.vector_store is None:
+                st.error("知识库未连接，请检查 API Key 与 Embeddings 设置")
             else:
-                with st.spinner("正在处理文档，请稍候..."):
-                    try:
-                        # 1. 保存临时文件
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp_file:
-                            tmp_file.write(uploaded_file.getvalue())
-                            tmp_path = tmp_file.name
-
-                        # --- OSS 备份 ---
-                        if cfg.get('oss_endpoint') and cfg.get('oss_bucket_name'):
-                            with st.spinner("正在备份文件到阿里云 OSS..."):
-                                success, msg = upload_file_to_oss(uploaded_file, uploaded_file.name, cfg)
-                                if success:
-                                    st.toast(msg, icon="☁️")
-                                else:
-                                    # 仅显示警告，不打断流程
-                                    print(f"OSS Upload Warning: {msg}")
-                                    if "OSS 配置不完整" not in msg:
-                                        st.warning(f"OSS 备份失败: {msg}")
-                        # ----------------
-
-                        # 2. 加载文档
-                        if uploaded_file.name.endswith(".pdf"):
-                            loader = PyPDFLoader(tmp_path)
-                        elif uploaded_file.name.endswith(".docx"):
-                            loader = Docx2txtLoader(tmp_path)
-                        else:
-                            loader = TextLoader(tmp_path)
-                        docs = loader.load()
-                        st.session_state.current_docs = docs # 保存文档引用
-                        
-                        # 3. 切分文档
-                        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-                        splits = text_splitter.split_documents(docs)
-                        
-                        # 4. 向量化并存储
-                        if embedding_type == "本地 HuggingFace (免费/慢)":
-                            with st.spinner("正在加载本地 Embedding 模型 (首次运行需要下载)..."):
-                                embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-                        else:
-                            embeddings = OpenAIEmbeddings(
-                                model="text-embedding-3-small", # 显式指定模型，防止兼容性问题
-                                api_key=api_key,
-                                base_url=base_url if "openai" not in base_url else None
-                            )
-                        
-                        # 5. 创建向量数据库 (每个用户独立或共享？这里暂时是内存式 Session State，所以其实是隔离的)
-                        # 如果需要持久化到磁盘且区分用户，persist_directory 应该加上 user_id
-                        # 但这里为了简单，我们还是用 Session 里的 vector_store，刷新就没了
-                        # 如果用 persist_directory="./chroma_db"，会混用。
-                        # 改进：使用临时目录或者不持久化到磁盘(默认内存)，或者每个用户一个文件夹
-                        
-                        # 这里我们改用内存模式 (不传 persist_directory) 或者每个用户独立目录
-                        user_db_dir = f"./chroma_db_{st.session_state.user_id}"
-                        
-                        # 为避免再次上传仍读取旧文件，这里在“开始处理文档”时清空用户目录
-                        try:
-                            if os.path.exists(user_db_dir):
-                                import shutil
-                                shutil.rmtree(user_db_dir, ignore_errors=True)
-                                print(f"DEBUG: Cleared old vector store directory: {user_db_dir}")
-                        except Exception as _e:
-                            print(f"DEBUG: Failed to clear old vector store: {_e}")
-                        
-                        st.session_state.vector_store = None
-                        vector_store = Chroma.from_documents(
-                            documents=splits, 
-                            embedding=embeddings
-                        )
-                        print(f"DEBUG: New in-memory vector store built from {len(splits)} chunks")
-                        
-                        st.session_state.vector_store = vector_store
-                        st.success(f"成功处理 {len(splits)} 个文本片段！现在可以提问或生成配图了。")
-                        
-                        # 清理临时文件
-                        os.remove(tmp_path)
-                        
-                    except Exception as e:
-                        st.error("❌ 文档处理发生错误")
+                # --- OSS 备份 (后台上传，不阻塞文档处理；结果在之后的 rerun 中提示) ---
+                for f in uploaded_files:
+                    future = oss_backup.submit_backup(f.getvalue(), f.name, cfg)
+                    if future is not None:
+                        st.session_state.setdefault("oss_backups", []).append(future)
+                # ----------------
+
+                if embedding_type == "本地 HuggingFace (免费/慢)" and not embedding_manager.is_local_ready():
+                    with st.spinner("正在加载本地 Embedding 模型 (首次运行需要下载)..."):
+                        embedding_manager.get_local_embeddings()
+
+                # 1-5. 各文件并发流式处理：逐页解析 → 切分 → 分批向量化 → 写入持久化知识库
+                #      (同一文件/文本块再次出现时直接读取磁盘缓存)
+                batch = ingestion.BatchIngest(
+                    [(f.name, f.getvalue()) for f in uploaded_files],
+                    st.session_state.vector_store,
+                    st.session_state.user_id,
+                    embed_key,
+                    skip_doc_ids=[doc['doc_id'] for doc in st.session_state.kb_documents],
+                    shared=not private_upload,
+                )
+                progress_bars = [st.progress(0.0, text=f.name) for f in uploaded_files]
+
+                def refresh_progress(snapshot):
+                    for i, (fraction, text) in snapshot.items():
+                        progress_bars[i].progress(min(fraction, 1.0), text=f"{uploaded_files[i].name}: {text}")
+
+                total_added = 0
+                for i, result, error in batch.iter_results(on_tick=refresh_progress):
+                    if error is not None:
+                        st.error(f"❌ {uploaded_files[i].name} 处理失败")
                         with st.expander("查看详细错误信息 (请复制并发送给开发者)"):
-                            st.code(str(e))
+                            st.code(str(error))
                             import traceback
-                            st.code(traceback.format_exc())
+                            st.code("".join(traceback.format_exception(type(error), error, error.__traceback__)))
                         
-                        if "404" in str(e) or "not found" in str(e).lower():
+                        if "404" in str(error) or "not found" in str(error).lower():
                             st.warning("💡 **可能的原因**：你正在使用 DeepSeek 或其他模型，但它们不支持 OpenAI 格式的 Embedding 接口。\n👉 **建议**：请在左侧设置中将 'Embeddings 模型' 切换为 **'本地 HuggingFace'** 再试一次。")
+                        continue
+
+                    total_added += result['chunk_count']
+                    # Session 中只保存文档哈希，配图时再从磁盘读取需要的片段
+                    st.session_state.current_doc_id = result['doc_id']
+
+                st.session_state.kb_documents = knowledge_base.list_documents(st.session_state.user_id, embed_key)
+                knowledge_base.sync_segments(st.session_state.vector_store, st.session_state.kb_documents)
+                if total_added:
+                    st.success(f"成功处理 {total_added} 个文本片段！现在可以提问或生成配图了。")
+                else:
+                    st.info("没有新的文本片段需要处理 (文档可能已在你的知识库中)。")
+
+                report_oss_backups()
 
     # === Tab 1: 智能问答 ===
     tab1, tab2 = st.tabs(["💬 智能问答", "🎨 创意配图"])
 
     with tab1:
-        # 显示历史消息
-        for message in st.session_state.messages:
+        # 对话切换
+        if st.session_state.get("conversations") is None:
+            st.session_state.conversations = db_manager.list_conversations(st.session_state.user_id)
+        conversations = st.session_state.conversations
+        col_conv, col_new = st.columns([4, 1])
+        if conversations:
+            conv_ids = [conv['id'] for conv in conversations]
+            current_id = st.session_state.get("conversation_id")
+            selected_id = col_conv.selectbox(
+                "历史对话",
+                conv_ids,
+                index=conv_ids.index(current_id) if current_id in conv_ids else None,
+                format_func=lambda conv_id: next(conv['title'] or "未命名对话" for conv in conversations if conv['id'] == conv_id),
+                placeholder="新对话",
+                label_visibility="collapsed",
+            )
+            if selected_id is not None and selected_id != current_id:
+                open_conversation(st.session_state.user_id, selected_id)
+                st.rerun()
+        if col_new.button("🆕 新对话", key="chat_new"):
+            new_conversation()
+            st.rerun()
+
+        # 显示历史消息 (只渲染最近的窗口，更早的消息按需加载)
+        history = st.session_state.messages
+        can_load_older = history.has_older and history.room > 0
+        if history.hidden or can_load_older or history.visible > history.window:
+            col_more, col_collapse = st.columns([3, 1])
+            if history.hidden and col_more.button(f"⬆️ 加载更早的消息 (还有 {history.hidden} 条)", key="chat_show_more"):
+                history.show_more()
+                st.rerun()
+            elif not history.hidden and can_load_older and col_more.button("⬆️ 加载更早的消息", key="chat_load_older"):
+                # 从数据库读取上一页
+                messages, has_older = db_manager.load_chat_messages(
+                    st.session_state.user_id, st.session_state.conversation_id,
+                    before=history.oldest, limit=chat_history.PAGE_SIZE,
+                )
+                history.extend_older(messages, has_older)
+                st.rerun()
+            if history.visible > history.window and col_collapse.button("收起", key="chat_collapse"):
+                history.collapse()
+                st.rerun()
+        if history.dropped:
+            st.caption(f"更早的 {history.dropped} 条消息已不在本次会话中保留")
+        for message in history.recent():
             if message.get("type") != "image": # 只显示文本消息
                 with st.chat_message(message["role"]):
                     st.markdown(message["content"])
@@ -501,12 +595,13 @@ def main_app():
             with st.chat_message("user"):
                 st.markdown(prompt)
 
-            if st.session_state.vector_store is None:
+            if not st.session_state.get("kb_documents"):
                 with st.chat_message("assistant"):
                     response = "请先在左侧上传文档并点击“开始处理文档”哦！👋"
                     st.markdown(response)
             else:
                 with st.chat_message("assistant"):
+                    sources_placeholder = st.empty()
                     message_placeholder = st.empty()
                     try:
                         def log_debug(msg):
@@ -515,69 +610,76 @@ def main_app():
                         # 调试信息：检查关键对象
                         log_debug(f"DEBUG: Model Name: {model_name}")
                         log_debug(f"DEBUG: Base URL: {base_url}")
-                        
-                        # 修正 base_url：去除空格/反引号/引号，若为空则设为 None，避免 httpx 报错
-                        def sanitize_base_url(url):
-                            if not url:
-                                return None
-                            cleaned = url.strip().strip("`").strip("\"").strip("'")
-                            if not cleaned:
-                                return None
-                            # Ensure path includes /v1 for OpenAI-compatible providers
-                            try:
-                                from urllib.parse import urlparse
-                                parsed = urlparse(cleaned)
-                                if parsed.path == "" or parsed.path == "/":
-                                    cleaned = cleaned.rstrip("/") + "/v1"
-                            except Exception:
-                                pass
-                            return cleaned
-                        final_base_url = sanitize_base_url(base_url)
-                        log_debug(f"DEBUG: Final Base URL: {final_base_url}")
-
-                        llm = ChatOpenAI(
-                            model=model_name, 
-                            temperature=0, 
-                            api_key=api_key,
-                            base_url=final_base_url
-                        )
-                        log_debug(f"DEBUG: LLM created: {type(llm)}")
+                        log_debug(f"DEBUG: Final Base URL: {llm_clients.sanitize_base_url(base_url)}")
 
                         if not st.session_state.vector_store:
                             raise ValueError("Vector Store is None")
 
-                        retriever = st.session_state.vector_store.as_retriever()
-                        log_debug(f"DEBUG: Retriever created: {type(retriever)}")
-
-                        system_prompt = (
-                            "你是一个乐于助人的校园助手。请根据下面的上下文（Context）回答用户的问题。"
-                            "如果上下文中没有答案，请诚实地说你不知道。\n\nContext: {context}"
-                        )
-                        prompt_template = ChatPromptTemplate.from_messages([
-                            ("system", system_prompt),
-                            ("human", "{input}"),
-                        ])
-                        
-                        def format_docs(docs):
-                            return "\n\n".join(doc.page_content for doc in docs)
-                        
-                        format_docs_runnable = RunnableLambda(lambda docs: format_docs(docs))
-                        log_debug(f"DEBUG: format_docs_runnable ready: {format_docs_runnable}")
+                        def show_sources(docs):
+                            with sources_placeholder.container():
+                                with st.expander(f"📑 参考片段 ({len(docs)})"):
+                                    for doc in docs:
+                                        source = doc.metadata.get("source", "未知来源")
+                                        if "page" in doc.metadata:
+                                            source += f" · 第 {doc.metadata['page'] + 1} 页"
+                                        st.caption(source)
+                                        st.markdown(doc.page_content[:300] + ("..." if len(doc.page_content) > 300 else ""))
                         
-                        chain = (
-                            {
-                                "context": retriever | format_docs_runnable,
-                                "input": RunnablePassthrough()
-                            }
-                            | prompt_template
-                            | llm
-                            | StrOutputParser()
-                        )
-                        log_debug(f"DEBUG: Composed chain: {type(chain)}")
+                        store = st.session_state.vector_store
+                        # 先走关键词检索 (课程代码、教室号、日期等精确匹配)，足够可信时不再计算问题向量
+                        keyword_hits = knowledge_base.keyword_search(store, prompt)
+                        query_vector = None
+                        cached = None
+                        if knowledge_base.keyword_confident(store, prompt, keyword_hits):
+                            log_debug(f"DEBUG: Keyword fast path: {keyword_hits[:2]}")
+                        else:
+                            # 问题向量只计算一次：既用于语义缓存匹配，也用于向量检索
+                            query_vector = store.embeddings.embed_query(prompt)
+                            version = answer_cache.kb_version(
+                                embed_key, model_name, [doc['doc_id'] for doc in st.session_state.kb_documents]
+                            )
+                            cached = answer_cache.cache.lookup(version, query_vector)
                         
-                        answer = chain.invoke(prompt)
+                        if cached:
+                            entry, score = cached
+                            log_debug(f"DEBUG: Answer cache hit (score={score:.3f})")
+                            # 缓存可能由其他用户写入：参考片段按本用户的文件名标注来源
+                            show_sources(knowledge_base.label_sources(entry['docs'], st.session_state.kb_documents))
+                            message_placeholder.markdown(entry['answer'])
+                            st.caption(f"⚡ 来自答案缓存 (与之前的问题相似度 {score:.2f})")
+                            answer = entry['answer']
+                        else:
+                            # 先检索，在生成开始前展示参考片段
+                            if query_vector is None:
+                                retrieved_docs = knowledge_base.get_chunks(store, [chunk_id for chunk_id, _ in keyword_hits[:4]])
+                            else:
+                                # 关键词与向量结果按排名融合
+                                retrieved_docs = knowledge_base.hybrid_search(store, query_vector, keyword_hits, k=4)
+                            log_debug(f"DEBUG: Retrieved {len(retrieved_docs)} docs")
+                            show_sources(retrieved_docs)
+                            
+                            # 复用缓存的客户端与编译好的链 (保留 HTTP 连接池，避免每次提问重新握手)
+                            chain = llm_clients.get_rag_chain(model_name, base_url, api_key, slots=st.session_state.llm_slots)
+                            log_debug(f"DEBUG: Using cached chain: {type(chain)}")
+                            
+                            # 合并相邻/重叠的文本块，按模型的 token 预算装入上下文
+                            context, context_stats = context_builder.build_context(retrieved_docs, model_name)
+                            log_debug(f"DEBUG: Context tokens: {context_stats}")
+                            if debug_mode:
+                                st.caption(
+                                    f"🧮 上下文 {context_stats['context_tokens']} / {context_stats['budget']} tokens · "
+                                    f"{context_stats['chunks']} 个文本块合并为 {context_stats['segments']} 段 · "
+                                    f"节省 {context_stats['saved_tokens']} tokens"
+                                    + (" · 已截断" if context_stats['truncated'] else "")
+                                )
+                            
+                            # 流式输出：token 一到达就渲染
+                            answer = message_placeholder.write_stream(
+                                chain.stream({"context": context, "input": prompt})
+                            )
+                            if query_vector is not None:
+                                answer_cache.cache.store(version, query_vector, answer, retrieved_docs)
                         
-                        message_placeholder.markdown(answer)
                         st.session_state.messages.append({"role": "assistant", "content": answer})
                         
                     except Exception as e:
@@ -601,13 +703,31 @@ def main_app():
         st.header("🎨 文档灵感配图")
         st.markdown("基于文档内容，自动生成一张创意封面或插图。")
         
-        if st.session_state.vector_store is None:
+        if not st.session_state.get("kb_documents"):
             st.warning("请先上传并处理文档！")
         else:
             col1, col2 = st.columns([1, 2])
             
             with col1:
                 style = st.selectbox("选择绘画风格", ["油画 (Oil Painting)", "水彩 (Watercolor)", "赛博朋克 (Cyberpunk)", "素描 (Sketch)", "写实 (Realistic)"])
+                # 可同时请求多个绘图服务 (按历史延迟排序，最快的健康服务在前)
+                selected_providers = st.multiselect(
+                    "绘图服务 (可多选并发请求)",
+                    image_providers.stats.rank(image_providers.ALL_PROVIDERS),
+                    default=[image_provider],
+                    key="input_fanout_providers",
+                )
+                fanout_mode = image_providers.MODE_FIRST
+                if len(selected_providers) > 1:
+                    mode_label = st.radio("并发模式", ["⚡ 先到先得 (错峰启动，有结果后不再请求其余服务)", "🖼️ 展示全部结果"], key="input_fanout_mode")
+                    if mode_label.startswith("🖼️"):
+                        fanout_mode = image_providers.MODE_ALL
+                for provider in selected_providers:
+                    provider_stat = image_providers.stats.get(provider)
+                    if provider_stat.get('latency') is not None:
+                        health = "" if image_providers.stats.is_healthy(provider) else " · ⚠️ 近期连续失败"
+                        st.caption(f"{provider}: 平均 {provider_stat['latency']:.1f}s{health}")
+                force_regenerate = st.checkbox("🔄 强制重新生成 (忽略本地缓存)", value=False, key="input_force_regenerate")
                 generate_btn = st.button("✨ 生成配图")
             
             if generate_btn:
@@ -615,34 +735,15 @@ def main_app():
                     with st.spinner("正在构思画面并绘图 (这可能需要十几秒)..."):
                         try:
                             # 1. 使用 LLM 生成绘画 Prompt
-                            # 清洗 base_url，避免粘贴时带了反引号/引号
-                            def sanitize_base_url(url):
-                                if not url:
-                                    return None
-                                cleaned = url.strip().strip("`").strip("\"").strip("'")
-                                if not cleaned:
-                                    return None
-                                try:
-                                    from urllib.parse import urlparse
-                                    parsed = urlparse(cleaned)
-                                    if parsed.path == "" or parsed.path == "/":
-                                        cleaned = cleaned.rstrip("/") + "/v1"
-                                except Exception:
-                                    pass
-                                return cleaned
-                            final_base_url_img = sanitize_base_url(base_url)
-                            
-                            llm = ChatOpenAI(
-                                model=model_name, 
-                                temperature=0.7, 
-                                api_key=api_key,
-                                base_url=final_base_url_img
+                            llm = llm_clients.get_chat_model(
+                                model_name, base_url, api_key, temperature=0.7,
+                                slots=st.session_state.llm_slots, slot="image_prompt"
                             )
                             
                             # 简单获取文档摘要（取前2000字符，避免token溢出）
-                            doc_snippet = ""
-                            if st.session_state.current_docs:
-                                doc_snippet = st.session_state.current_docs[0].page_content[:2000]
+                            # 刷新/重新登录后没有最近处理的文档，使用知识库中最新的文档
+                            latest_doc_id = st.session_state.current_doc_id or st.session_state.kb_documents[0]['doc_id']
+                            doc_snippet = ingest_cache.read_text(latest_doc_id, 2000) or ""
                             
                             prompt_gen_prompt = f"""
                             请阅读以下文档片段，提取核心主题和意境，将其转化为一段英文的 DALL-E 绘画提示词 (Prompt)。
@@ -656,159 +757,160 @@ def main_app():
                             {doc_snippet}
                             """
                             
-                            image_prompt_response = llm.invoke(prompt_gen_prompt)
-                            image_prompt = image_prompt_response.content
+                            # 同一文档 + 风格 + 模型复用之前设计的提示词，这样也能命中本地图片库
+                            image_prompt = None if force_regenerate else image_store.lookup_prompt(latest_doc_id, style, model_name)
+                            if not image_prompt:
+                                image_prompt_response = llm.invoke(prompt_gen_prompt)
+                                image_prompt = image_prompt_response.content
+                                image_store.record_prompt(latest_doc_id, style, model_name, image_prompt)
                             st.info(f"🎨 **AI 设计的提示词**: {image_prompt}")
                             
-                            # 2. 调用绘图接口
-                            if image_provider == "OpenAI DALL-E 3":
-                                # 优先使用专门的 Image Key，否则尝试使用主 Key
-                                final_image_key = image_api_key if image_api_key else api_key
-                                
-                                if not final_image_key:
-                                    st.error("缺少用于绘图的 API Key！")
-                                else:
-                                    client = OpenAI(api_key=final_image_key) # 使用官方 SDK
-                                    
-                                    response = client.images.generate(
-                                        model="dall-e-3",
-                                        prompt=image_prompt,
-                                        size="1024x1024",
-                                        quality="standard",
-                                        n=1,
-                                    )
-                                    
-                                    image_url = response.data[0].url
-                                    st.image(image_url, caption=f"基于文档生成的 {style} 风格配图 (DALL-E 3)")
+                            # 2. 为每个选中的服务准备请求 (未在侧边栏显示的服务使用已保存的配置)
+                            generators = {}
+                            for provider in selected_providers:
+                                if provider == image_providers.DALLE:
+                                    # 优先使用专门的 Image Key，否则尝试使用主 Key
+                                    final_image_key = image_api_key or cfg.get('image_api_key') or api_key
+                                    if not final_image_key:
+                                        st.error("缺少用于绘图的 API Key！")
+                                    else:
+                                        generators[provider] = functools.partial(image_providers.generate_dalle, api_key=final_image_key)
 
-                            elif image_provider == "SiliconFlow (Flux)":
-                                if not siliconflow_api_key:
-                                    st.error("❌ 请先在左侧侧边栏填写 SiliconFlow API Key！")
-                                else:
-                                    try:
-                                        client = OpenAI(
-                                            api_key=siliconflow_api_key,
-                                            base_url="https://api.siliconflow.cn/v1"
-                                        )
-                                        
-                                        response = client.images.generate(
-                                            model="black-forest-labs/FLUX.1-schnell",
-                                            prompt=image_prompt,
-                                            size="1024x1024",
-                                            n=1,
-                                        )
-                                        
-                                        image_url = response.data[0].url
-                                        st.image(image_url, caption=f"基于文档生成的 {style} 风格配图 (Flux.1 Schnell)")
-                                        
-                                    except Exception as e:
-                                        st.error(f"❌ SiliconFlow 绘图失败: {e}")
-                                    
-                            elif image_provider == "Bing Image Creator (免费)":
-                                # 检查配置是否已填写 (直接使用 Sidebar 中定义的变量)
-                                if not bing_cookie and not full_cookie_str:
-                                    st.warning("⚠️ 请先在左侧侧边栏【设置 -> 绘图设置】中填写 Bing Cookie！\n\n👉 **推荐操作**：\n1. 打开侧边栏设置\n2. 找到“完整 Cookie 字符串”\n3. 粘贴刚才复制的一长串 Cookie")
-                                else:
+                                elif provider == image_providers.FLUX:
+                                    final_flux_key = siliconflow_api_key or cfg.get('siliconflow_api_key')
+                                    if not final_flux_key:
+                                        st.error("❌ 请先在左侧侧边栏填写 SiliconFlow API Key！")
+                                    else:
+                                        generators[provider] = functools.partial(image_providers.generate_flux, api_key=final_flux_key)
+
+                                elif provider == image_providers.BING:
+                                    final_bing_cookie = bing_cookie or cfg.get('bing_cookie', '')
+                                    final_full_cookie_str = full_cookie_str or cfg.get('full_cookie_str', '')
+                                    # 检查配置是否已填写
+                                    if not final_bing_cookie and not final_full_cookie_str:
+                                        st.warning("⚠️ 请先在左侧侧边栏【设置 -> 绘图设置】中填写 Bing Cookie！\n\n👉 **推荐操作**：\n1. 打开侧边栏设置\n2. 找到“完整 Cookie 字符串”\n3. 粘贴刚才复制的一长串 Cookie")
+                                        continue
                                     # 智能解析逻辑
-                                    final_u = bing_cookie
-                                    final_srch = bing_cookie_srch
-                                    all_cookies_list = []
-                                    
-                                    if full_cookie_str:
-                                        try:
-                                            # Clean input
-                                            full_cookie_str = full_cookie_str.strip()
-                                            # Remove "Cookie:" prefix if present (case insensitive)
-                                            if full_cookie_str.lower().startswith("cookie:"):
-                                                full_cookie_str = full_cookie_str[7:].strip()
-                                                
-                                            # 尝试解析 JSON 格式 (针对 Cookie-Editor 插件导出)
-                                            if full_cookie_str.strip().startswith('[') and full_cookie_str.strip().endswith(']'):
-                                                import json
-                                                json_cookies = json.loads(full_cookie_str)
-                                                for item in json_cookies:
-                                                    if 'name' in item and 'value' in item:
-                                                        all_cookies_list.append({'name': item['name'], 'value': item['value']})
-                                                        if item['name'] == "_U":
-                                                            final_u = item['value']
-                                                        elif item['name'] == "SRCHHPGUSR":
-                                                            final_srch = item['value']
-                                            else:
-                                                # 解析完整 Cookie 字符串 (key=value; key2=value2)
-                                                for item in full_cookie_str.split(';'):
-                                                    if '=' in item:
-                                                        k, v = item.strip().split('=', 1)
-                                                        all_cookies_list.append({'name': k, 'value': v})
-                                                        # 自动提取关键 Cookie
-                                                        if k.strip() == "_U":
-                                                            final_u = v
-                                                        elif k.strip() == "SRCHHPGUSR":
-                                                            final_srch = v
-                                        except Exception as parse_e:
-                                            st.warning(f"Cookie 字符串解析部分失败: {parse_e}")
+                                    final_u, final_srch, all_cookies_list = final_bing_cookie, bing_cookie_srch or cfg.get('bing_cookie_srch', ''), []
+                                    try:
+                                        final_u, final_srch, all_cookies_list = bing_pool.parse_cookies(final_u, final_srch, final_full_cookie_str)
+                                    except Exception as parse_e:
+                                        st.warning(f"Cookie 字符串解析部分失败: {parse_e}")
                                     
                                     if not final_u:
                                          st.error("❌ 无法从完整字符串中找到 _U Cookie，请检查复制是否完整！")
-                                    else:
-                                        # 如果没有填写 SRCHHPGUSR，尝试使用 _U (兼容旧逻辑)
-                                        if not final_srch:
-                                            final_srch = final_u
-
-                                        with st.status("正在请求 Bing Image Creator...", expanded=True) as status:
-                                            try:
-                                                status.write("正在连接 Bing 服务器...")
-                                                # 开启调试模式 quiet=False
-                                                image_gen = ImageGen(
-                                                    auth_cookie=final_u, 
-                                                    auth_cookie_SRCHHPGUSR=final_srch, 
-                                                    all_cookies=all_cookies_list,
-                                                    quiet=False,
-                                                    user_agent=user_agent
-                                                )
-                                                
-                                                # 如果用户配置了代理，手动设置到 session 中
-                                                if proxy_url:
-                                                    image_gen.session.proxies = {
-                                                        "http": proxy_url,
-                                                        "https": proxy_url
-                                                    }
-                                                    print(f"DEBUG: Using Proxy: {proxy_url}")
-                                                
-                                                status.write("正在提交绘画任务...")
-                                                if debug_mode:
-                                                    print(f"DEBUG: Submitting prompt to Bing: {image_prompt}")
-                                                image_urls = image_gen.get_images(image_prompt)
-                                                if debug_mode:
-                                                    print(f"DEBUG: Received {len(image_urls)} images")
-                                                
-                                                status.update(label="绘图成功！", state="complete")
-                                                
-                                                cols = st.columns(2)
-                                                for i, url in enumerate(image_urls):
-                                                    with cols[i % 2]:
-                                                        st.image(url, caption=f"Bing 生成图 {i+1}")
-                                                        
-                                            except Exception as e:
-                                                # 打印详细错误日志到控制台，方便调试
-                                                print(f"ERROR generating image: {e}")
-                                                import traceback
-                                                traceback.print_exc()
-                                                
-                                                status.update(label="绘图失败", state="error")
-                                                error_str = str(e)
-                                                if "AuthCookieError" in error_str or "Unauthorized" in error_str:
-                                                    st.error("❌ **Cookie 无效或过期**\n请重新获取 _U Cookie 并更新。")
-                                                elif "Redirect" in error_str or "30 redirects" in error_str:
-                                                    st.error(f"❌ **重定向错误 (Redirect Loop)**\n\n{error_str}\n\n原因：Bing 可能将您的请求重定向到了错误的区域 (如 cn.bing.com)。请尝试更换为美国/日本节点。")
-                                                elif "Could not get results" in error_str:
-                                                    st.error("❌ **生成超时或无结果**\n\nBing 正在处理任务但未返回结果。这通常是因为：\n1. **网络波动**：连接 Bing 服务器不稳定。\n2. **服务器繁忙**：Bing 免费服务当前负载过高。\n3. **Prompt 违规**：提示词可能触发了审核机制但没明确报错。\n\n👉 **建议**：稍等几秒再试一次，或尝试修改提示词。")
-                                                else:
-                                                    st.error(f"❌ **Bing 绘图出错**: {error_str}")
+                                         continue
+                                    pool_args = (
+                                        st.session_state.user_id, final_u, final_srch or final_u, all_cookies_list,
+                                        proxy_url or cfg.get('proxy_url', ''), user_agent or cfg.get('user_agent') or None
+                                    )
+
+                                    # 工作线程从会话池借出已登录的 Bing 会话 (复用 keep-alive 连接)；
+                                    # Cookie 验证也在工作线程中进行，失效时作为任务错误展示
+                                    def acquire_bing_session(pool_args=pool_args):
+                                        return bing_pool.acquire(*pool_args, quiet=not debug_mode, diagnostics=debug_mode)
+
+                                    def validate_bing_cookie(pool_args=pool_args):
+                                        return bing_pool.validate(*pool_args)[0]
+                                    generators[provider] = functools.partial(
+                                        image_providers.generate_bing, acquire_session=acquire_bing_session, validate=validate_bing_cookie
+                                    )
+
+                            # 3. 提交后台任务 (多个服务时并发请求)
+                            if generators:
+                                if debug_mode:
+                                    print(f"DEBUG: Submitting prompt to {list(generators)}: {image_prompt}")
+                                job_id = image_jobs.submit_job(
+                                    st.session_state.user_id, image_prompt, generators, mode=fanout_mode,
+                                    caption=f"基于文档生成的 {style} 风格配图",
+                                    style=style, use_cache=not force_regenerate
+                                )
+                                st.success(f"✅ 已提交绘图任务 #{job_id}，可以继续提问或提交更多任务，结果会显示在下方任务列表中。")
+                            elif not selected_providers:
+                                st.warning("请至少选择一个绘图服务。")
                                 
                         except Exception as e:
                             st.error(handle_api_error(e))
 
+            # 后台绘图任务列表
+            render_image_jobs()
+
+# --- 后台绘图任务列表 ---
+def _render_image_jobs_body():
+    jobs = image_jobs.list_jobs(st.session_state.user_id)
+    if not jobs:
+        return
+
+    st.subheader("🗂️ 绘图任务")
+    state_labels = {
+        image_jobs.QUEUED: "⏳ 排队中",
+        image_jobs.RUNNING: "🎨 生成中",
+        image_jobs.DONE: "✅ 已完成",
+        image_jobs.FAILED: "❌ 失败",
+    }
+    for job in jobs:
+        label = f"#{job.id} {state_labels.get(job.state, job.state)} · {job.provider}"
+        with st.expander(label, expanded=job.state == image_jobs.DONE):
+            st.caption(job.prompt)
+            for provider, text in job.provider_status.items():
+                st.caption(f"{provider}: {text}")
+            if job.state == image_jobs.DONE:
+                # 默认展示本地缩略图，需要时再加载原图
+                show_full = st.checkbox("显示原图", value=False, key=f"show_full_{job.id}")
+                cols = st.columns(2)
+                for i, image in enumerate(job.images):
+                    with cols[i % 2]:
+                        st.image(image['url'] if show_full else image['thumb'], caption=f"{job.caption} ({image['provider']}) {i+1}")
+            elif job.state == image_jobs.FAILED:
+                describe_image_error(job.error)
+            elif st.button("取消", key=f"cancel_job_{job.id}"):
+                image_jobs.cancel_job(job.id)
+
+    if st.button("🧹 清除已结束的任务"):
+        image_jobs.clear_finished(st.session_state.user_id)
+        st.rerun()
+
+
+# 有进行中的任务时定期局部刷新 (仅刷新任务列表，不重跑整个页面)
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+if _fragment is not None:
+    @_fragment(run_every=3)
+    def _render_image_jobs_live():
+        _render_image_jobs_body()
+
+def render_image_jobs():
+    if _fragment is not None and image_jobs.has_active_jobs(st.session_state.user_id):
+        _render_image_jobs_live()
+    else:
+        _render_image_jobs_body()
+        if image_jobs.has_active_jobs(st.session_state.user_id):
+            st.button("🔄 刷新任务状态")
+
 # --- 程序入口 ---
+if "session" in st.query_params:
+    # 旧版本把令牌放在页面链接中：读取后立即从地址栏移除 (该令牌随后被轮换作废)
+    legacy_token = st.query_params.get("session")
+    del st.query_params["session"]
+else:
+    legacy_token = None
+if not st.session_state.user_id and not st.session_state.get("session_checked"):
+    # "记住此设备"：用令牌恢复登录，无需再次计算密码哈希；每个连接只尝试一次
+    st.session_state.session_checked = True
+    presented = read_session_cookie() or legacy_token
+    if presented:
+        # 令牌每次使用后轮换，旧令牌随即失效
+        user_id, username, token = db_manager.resolve_session(presented)
+        if user_id:
+            st.session_state.user_id = user_id
+            st.session_state.username = username
+            st.session_state.user_config = db_manager.get_user_config(user_id)
+            st.session_state.session_token = token
+            set_session_cookie(token, db_manager.SESSION_TTL)
+        else:
+            set_session_cookie("", 0)
+
+flush_session_cookie()
+
 if not st.session_state.user_id:
     auth_page()
 else:
@@ -0,0 +1,115 @@
+"""
+db_manager 微基准：50 个并发会话反复执行 登录 -> 读取配置 -> 保存配置。
+对比旧的 "每次调用新建连接 + 回滚日志" 模式与连接池 + WAL + 配置缓存。
+
+用法: python bench_db.py [会话数] [每个会话的轮数]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import db_manager
+
+SESSIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+PASSWORD = "bench-password"
+
+
+def legacy_login(username, password):
+    conn = sqlite3.connect(db_manager.DB_FILE, timeout=30)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT id, password_hash, salt FROM users WHERE username = ?", (username,))
+        user_id, stored_hash, salt = c.fetchone()
+        return user_id if db_manager.hash_password(password, salt)[0] == stored_hash else None
+    finally:
+        conn.close()
+
+
+def legacy_get_config(user_id):
+    conn = sqlite3.connect(db_manager.DB_FILE, timeout=30)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT " + ", ".join(db_manager.CONFIG_FIELDS) + " FROM user_configs WHERE user_id = ?", (user_id,))
+        return dict(zip(db_manager.CONFIG_FIELDS, c.fetchone()))
+    finally:
+        conn.close()
+
+
+def legacy_save_config(user_id, config):
+    conn = sqlite3.connect(db_manager.DB_FILE, timeout=30)
+    try:
+        conn.execute(
+            "UPDATE user_configs SET " + ", ".join(f"{k}=?" for k in db_manager.CONFIG_FIELDS) + " WHERE user_id=?",
+            [config.get(k, '') for k in db_manager.CONFIG_FIELDS] + [user_id],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def run(label, login, get_config, save_config):
+    errors = []
+    barrier = threading.Barrier(SESSIONS + 1)
+    user_ids = [None] * SESSIONS
+
+    def session(i):
+        try:
+            user_ids[i] = login(f"bench_user_{i}", PASSWORD)
+        except Exception as e:
+            errors.append(e)
+        barrier.wait()  # 登录阶段结束
+        barrier.wait()  # 配置阶段开始
+        try:
+            for r in range(ROUNDS):
+                config = get_config(user_ids[i])
+                if r % 5 == 0:
+                    config['base_url'] = f"https://example.com/{r}"
+                    save_config(user_ids[i], config)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(SESSIONS)]
+    started = time.time()
+    for t in threads:
+        t.start()
+    barrier.wait()
+    login_elapsed = time.time() - started
+    started = time.time()
+    barrier.wait()
+    for t in threads:
+        t.join()
+    config_elapsed = time.time() - started
+
+    print(f"{label:<28} login {SESSIONS / login_elapsed:7.1f}/s  "
+          f"config {SESSIONS * ROUNDS / config_elapsed:8.1f}/s  errors {len(errors)}")
+    if errors:
+        print(f"  first error: {errors[0]}")
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db_manager.DB_FILE = os.path.join(tmp, "bench.db")
+        db_manager.init_db()
+        for i in range(SESSIONS):
+            db_manager.register_user(f"bench_user_{i}", PASSWORD)
+
+        print(f"--- {SESSIONS} sessions x {ROUNDS} rounds ---")
+        # 旧模式：切回回滚日志，每次调用新建连接
+        db_manager.reset_pool()
+        conn = sqlite3.connect(db_manager.DB_FILE)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+        run("legacy (connect per call)", legacy_login, legacy_get_config, legacy_save_config)
+
+        db_manager.reset_pool()
+        run("pooled + WAL + cache", lambda u, p: db_manager.login_user(u, p)[0],
+            db_manager.get_user_config, db_manager.save_user_config)
+        db_manager.reset_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+冷启动导入耗时报告 (基于 python -X importtime)。
+
+1. 登录页路径：app.py 在渲染登录页之前导入的模块，按顶层包汇总累计耗时；
+2. 各功能首次使用时才导入的重量级依赖，分别在全新进程中测量。
+
+用法: python bench_imports.py [--top N]
+每次测量都在新的子进程中进行，结果不受本进程已导入模块影响。
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+# app.py 顶层导入 (登录页渲染前)
+STARTUP_MODULES = [
+    "streamlit", "dotenv",
+    "bing_pool", "db_manager", "embedding_manager", "ingest_cache", "ingestion",
+    "knowledge_base", "llm_clients", "answer_cache", "chat_history", "context_builder",
+    "image_jobs", "image_providers", "image_store", "oss_backup",
+]
+
+# 功能 -> 首次使用时导入的模块
+FEATURE_MODULES = {
+    "文档解析/切分": ["pypdf", "docx2txt", "langchain_text_splitters"],
+    "向量库": ["langchain_community.vectorstores"],
+    "本地 Embedding": ["langchain_community.embeddings", "sentence_transformers"],
+    "问答 (LLM)": ["langchain_openai", "langchain_core.prompts", "tiktoken"],
+    "OSS 备份": ["oss2"],
+    "Bing 绘图": ["bing_debug"],
+}
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure(modules):
+    """
+    :return: ({顶层包: 累计微秒}, 总微秒, [导入失败信息, ...])
+    """
+    # 逐个导入，某个依赖缺失时其余模块仍然计入报告；标记行之前的是解释器自身启动的导入
+    code = (
+        "import importlib, sys\n"
+        "sys.stderr.write('--start--\\n')\n"
+        f"for name in {modules!r}:\n"
+        "    try:\n"
+        "        importlib.import_module(name)\n"
+        "    except Exception as e:\n"
+        "        print(f'IMPORT-FAILED {name}: {type(e).__name__}: {e}')\n"
+    )
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    # db_manager 导入时会在当前目录初始化数据库，放到临时目录中运行
+    with tempfile.TemporaryDirectory() as tmp:
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=tmp, env=env, capture_output=True, text=True,
+        )
+
+    per_package = {}
+    total = 0
+    started = False
+    for line in proc.stderr.splitlines():
+        if line == "--start--":
+            started = True
+            continue
+        if not started or not line.startswith("import time:"):
+            continue
+        _, cumulative_us, raw_name = line[len("import time:"):].split("|")
+        # importtime 用缩进表示嵌套层级，只统计顶层导入 (其累计耗时已包含子模块)
+        if raw_name.startswith("  "):
+            continue
+        package = raw_name.strip().split(".")[0]
+        per_package[package] = per_package.get(package, 0) + int(cumulative_us)
+        total += int(cumulative_us)
+
+    errors = [line[len("IMPORT-FAILED "):] for line in proc.stdout.splitlines() if line.startswith("IMPORT-FAILED ")]
+    if proc.returncode != 0:
+        errors.append((proc.stderr.strip().splitlines() or ["unknown error"])[-1])
+    return per_package, total, errors
+
+def main():
+    top = int(sys.argv[sys.argv.index("--top") + 1]) if "--top" in sys.argv else 15
+
+    print("--- 登录页 (app.py 顶层导入) ---")
+    per_package, total, errors = measure(STARTUP_MODULES)
+    for package, us in sorted(per_package.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {package:<32} {us / 1000:8.1f} ms")
+    print(f"  {'TOTAL':<32} {total / 1000:8.1f} ms")
+    for error in errors:
+        print(f"  (导入失败) {error}")
+
+    print("\n--- 按需导入 (各功能首次使用时) ---")
+    for feature, modules in FEATURE_MODULES.items():
+        _, total, errors = measure(modules)
+        status = f"{total / 1000:8.1f} ms" if not errors else f"不可用 ({errors[0]})"
+        print(f"  {feature:<20} {status}")
+
+
+if __name__ == "__main__":
+    main()
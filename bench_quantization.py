@@ -0,0 +1,68 @@
+"""
+量化存储的召回率报告：float16 / int8 (有无 float32 重新打分) 相对 float32 精确检索的 recall@k、
+每个向量占用的常驻字节数和单次查询延迟。
+
+用法: python bench_quantization.py [向量数量] [查询次数]
+向量为模拟的聚类分布 (类似真实文本 Embedding 的 "主题簇")，查询取自库内向量加噪声。
+"""
+import sys
+import time
+
+import numpy as np
+
+import quantization
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+QUERIES = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+DIM = 384
+KS = (1, 4, 10)
+
+
+def normalize(x):
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def make_corpus(rng):
+    centers = rng.standard_normal((max(N // 100, 1), DIM)).astype(np.float32)
+    labels = rng.integers(0, len(centers), N)
+    vectors = normalize(centers[labels] + 0.6 * rng.standard_normal((N, DIM)).astype(np.float32))
+    picks = rng.integers(0, N, QUERIES)
+    queries = normalize(vectors[picks] + 0.3 * rng.standard_normal((QUERIES, DIM)).astype(np.float32))
+    return vectors, queries
+
+
+def run(full, queries, mode, rescore):
+    codes, scales = quantization.quantize(full, mode)
+    fetch_full = (lambda rows: full[rows]) if rescore else None
+    results, latencies = [], []
+    for query in queries:
+        started = time.perf_counter()
+        rows, _ = quantization.search(codes, scales, query, max(KS), fetch_full=fetch_full)
+        latencies.append(time.perf_counter() - started)
+        results.append(rows)
+    bytes_per_vector = codes.itemsize * DIM + (4 if scales is not None else 0)
+    return results, bytes_per_vector, sorted(latencies)[len(latencies) // 2] * 1000
+
+
+def main():
+    rng = np.random.default_rng(0)
+    full, queries = make_corpus(rng)
+    exact, _, _ = run(full, queries, quantization.FLOAT32, False)
+
+    print(f"--- {N} vectors x {DIM} dims, {QUERIES} queries ---")
+    header = "  ".join(f"recall@{k:<3}" for k in KS)
+    print(f"{'mode':<22} {header}  bytes/vec  p50 ms")
+    for mode in quantization.MODES:
+        for rescore in ((False,) if mode == quantization.FLOAT32 else (False, True)):
+            results, bytes_per_vector, p50 = run(full, queries, mode, rescore)
+            recalls = []
+            for k in KS:
+                hits = sum(len(set(got[:k]) & set(truth[:k])) for got, truth in zip(results, exact))
+                recalls.append(hits / (k * len(exact)))
+            label = mode + (" + rescore" if rescore else "")
+            cols = "  ".join(f"{r:<10.4f}" for r in recalls)
+            print(f"{label:<22} {cols}  {bytes_per_vector:9d}  {p50:6.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Session 内存基准：每个 Session 在 current_docs 中持有整个文档 (旧做法)
+vs 只持有文档哈希、按需从磁盘读取片段 (ingest_cache.read_text)。
+
+用法: python bench_session_memory.py [Session 数量] [每个文档页数]
+每种模式在独立子进程中运行，报告 RSS 增量和每个 Session 的平均占用。
+每个 Session 上传不同的文档 (最坏情况：没有共享)。
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+SESSIONS = int(sys.argv[1]) if len(sys.argv) > 1 and not sys.argv[1].startswith("--") else 200
+PAGES = int(sys.argv[2]) if len(sys.argv) > 2 and not sys.argv[2].startswith("--") else 30
+PAGE_CHARS = 1500  # 一页 PDF 的典型字符数
+SNIPPET_CHARS = 2000
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_pages(session):
+    text = f"第 {session} 份课程资料：教学楼 A{session % 300} 的课程安排与考试说明。" * (PAGE_CHARS // 30)
+    return [{"page_content": f"[{page}] {text}", "metadata": {"source": f"doc{session}.pdf", "page": page}} for page in range(PAGES)]
+
+
+def run_mode(mode, cache_dir):
+    os.environ["INGEST_CACHE_DIR"] = cache_dir
+    from langchain_core.documents import Document
+    import ingest_cache
+
+    doc_ids = [f"{session:064x}" for session in range(SESSIONS)]
+    if mode == "handle":
+        # 文本已由解析阶段写入磁盘缓存
+        for session, doc_id in enumerate(doc_ids):
+            with ingest_cache.pages_writer(doc_id) as writer:
+                for page in make_pages(session):
+                    writer.write(Document(**page))
+
+    baseline = rss_mb()
+    sessions = []
+    for session, doc_id in enumerate(doc_ids):
+        state = {}
+        if mode == "full":
+            state["current_docs"] = [Document(**page) for page in make_pages(session)]
+        else:
+            state["current_doc_id"] = doc_id
+        sessions.append(state)
+
+    # 模拟每个 Session 生成一次配图提示词
+    snippet_chars = 0
+    for state in sessions:
+        if mode == "full":
+            snippet = state["current_docs"][0].page_content[:SNIPPET_CHARS]
+        else:
+            snippet = ingest_cache.read_text(state["current_doc_id"], SNIPPET_CHARS)
+        snippet_chars += len(snippet)
+    delta = rss_mb() - baseline
+    return {'rss_mb': delta, 'per_session_kb': delta * 1024 / SESSIONS, 'snippet_chars': snippet_chars}
+
+
+def main():
+    if "--mode" in sys.argv:
+        with tempfile.TemporaryDirectory() as tmp:
+            print(json.dumps(run_mode(sys.argv[sys.argv.index("--mode") + 1], tmp)))
+        return
+
+    print(f"--- {SESSIONS} sessions x {PAGES} pages x ~{PAGE_CHARS} chars ---")
+    root = os.path.dirname(os.path.abspath(__file__))
+    for mode, label in (("full", "current_docs (全文)"), ("handle", "current_doc_id (句柄)")):
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), str(SESSIONS), str(PAGES), "--mode", mode],
+            cwd=root, capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            print(f"{label:<24} failed: {(proc.stderr.strip().splitlines() or ['unknown error'])[-1]}")
+            continue
+        r = json.loads(proc.stdout.strip().splitlines()[-1])
+        print(f"{label:<24} RSS +{r['rss_mb']:7.1f}MB  {r['per_session_kb']:8.1f}KB/session  "
+              f"snippet chars {r['snippet_chars']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+向量库后端基准：Chroma.from_documents vs NumpyVectorStore。
+测量建库耗时、单次查询延迟 (按向量检索 top-4) 和进程 RSS 增量。
+
+用法: python bench_vectorstore.py [文本块数量] [查询次数]
+每个后端在独立子进程中运行，RSS 互不影响。Embedding 使用确定性的假向量 (不访问网络)。
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+CHUNKS = int(sys.argv[1]) if len(sys.argv) > 1 and not sys.argv[1].startswith("--") else 10000
+QUERIES = int(sys.argv[2]) if len(sys.argv) > 2 and not sys.argv[2].startswith("--") else 200
+DIM = 384  # all-MiniLM-L6-v2 的向量维度
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_backend(backend, chunks, queries):
+    import numpy as np
+    from langchain_core.documents import Document
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    embeddings = DeterministicFakeEmbedding(size=DIM)
+    docs = [
+        Document(page_content=f"第 {i} 段课程资料 CS-{i % 500} 教室 A{i % 300}", metadata={"doc_id": "bench", "chunk": i})
+        for i in range(chunks)
+    ]
+    ids = [f"bench:{i}" for i in range(chunks)]
+    query_vectors = np.random.default_rng(0).standard_normal((queries, DIM)).astype(np.float32).tolist()
+
+    if backend == "chroma":
+        from langchain_community.vectorstores import Chroma
+    else:
+        from numpy_store import NumpyVectorStore
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 基线在导入之后测量，RSS 增量只包含数据本身
+        baseline = rss_mb()
+        started = time.perf_counter()
+        if backend == "chroma":
+            store = Chroma.from_documents(docs, embeddings, ids=ids, persist_directory=tmp)
+        else:
+            store = NumpyVectorStore.from_documents(docs, embeddings, ids=ids, directory=tmp)
+        build = time.perf_counter() - started
+
+        store.similarity_search_by_vector(query_vectors[0], k=4)  # 预热
+        latencies = []
+        for vector in query_vectors:
+            started = time.perf_counter()
+            store.similarity_search_by_vector(vector, k=4)
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        return {
+            'build_s': build,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+            'rss_mb': rss_mb() - baseline,
+        }
+
+
+def main():
+    if "--backend" in sys.argv:
+        backend = sys.argv[sys.argv.index("--backend") + 1]
+        print(json.dumps(run_backend(backend, CHUNKS, QUERIES)))
+        return
+
+    print(f"--- {CHUNKS} chunks x {DIM} dims, {QUERIES} queries ---")
+    root = os.path.dirname(os.path.abspath(__file__))
+    for backend in ("chroma", "numpy"):
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), str(CHUNKS), str(QUERIES), "--backend", backend],
+            cwd=root, capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            print(f"{backend:<8} failed: {(proc.stderr.strip().splitlines() or ['unknown error'])[-1]}")
+            continue
+        r = json.loads(proc.stdout.strip().splitlines()[-1])
+        print(f"{backend:<8} build {r['build_s']:7.2f}s  query p50 {r['p50_ms']:7.2f}ms  "
+              f"p95 {r['p95_ms']:7.2f}ms  RSS +{r['rss_mb']:7.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
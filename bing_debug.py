@@ -1,9 +1,10 @@
 import os
 import random
+import threading
 import time
 import regex
 import requests
-from typing import Dict, List, Union
+from typing import Callable, Dict, List, Union
 from functools import partial
 import contextlib
 
@@ -52,6 +53,7 @@ class ImageGen:
         quiet: bool = False,
         all_cookies: List[Dict] = None,
         user_agent: str = None,
+        diagnostics: bool = False,
     ) -> None:
         self.session: requests.Session = requests.Session()
         self.session.headers = HEADERS.copy()
@@ -73,6 +75,7 @@ class ImageGen:
             print("DEBUG: WARNING - Cookie _U is MISSING or EMPTY!")
             
         self.quiet = quiet
+        self.diagnostics = diagnostics
         self.debug_file = debug_file
         if self.debug_file:
             self.debug = partial(debug, self.debug_file)
@@ -112,23 +115,31 @@ class ImageGen:
             print(f"DEBUG: Validation error: {e}")
             return False
 
-    def get_images(self, prompt: str) -> list:
+    def check_ip(self) -> Union[Dict, None]:
+        """
+        Reports the outbound IP location seen through the current session / proxy
         """
-        Fetches image links from Bing
+        try:
+            ip_url = "http://ip-api.com/json/"
+            ip_resp = self.session.get(ip_url, timeout=5)
+            if ip_resp.status_code == 200:
+                data = ip_resp.json()
+                print(f"DEBUG: Current IP Location: {data.get('country')} ({data.get('query')})")
+                return data
+            print(f"DEBUG: Failed to check IP: {ip_resp.status_code}")
+        except Exception as e:
+            print(f"DEBUG: Proxy/IP check failed: {e}")
+        return None
+
+    def submit(self, prompt: str) -> str:
+        """
+        Submits a generation request to Bing and returns the polling URL
         """
         if not self.quiet:
             print(sending_message)
-            # Verify Proxy / IP
-            try:
-                ip_url = "http://ip-api.com/json/"
-                ip_resp = self.session.get(ip_url, timeout=5)
-                if ip_resp.status_code == 200:
-                    data = ip_resp.json()
-                    print(f"DEBUG: Current IP Location: {data.get('country')} ({data.get('query')})")
-                else:
-                    print(f"DEBUG: Failed to check IP: {ip_resp.status_code}")
-            except Exception as e:
-                print(f"DEBUG: Proxy/IP check failed: {e}")
+        if self.diagnostics:
+            # Verify Proxy / IP (only when diagnostics are explicitly requested)
+            self.check_ip()
         
         url_encoded_prompt = requests.utils.quote(prompt)
         payload = f"q={url_encoded_prompt}&qs=ds"
@@ -190,38 +201,65 @@ class ImageGen:
         
         if not self.quiet:
             print(f"{wait_message} (Polling URL: {polling_url})")
-            
-        start_wait = time.time()
-        while True:
-            if int(time.time() - start_wait) > 300:
-                raise Exception(error_timeout)
-                
-            if not self.quiet:
-                print(".", end="", flush=True)
-                
-            response = self.session.get(polling_url)
-            
-            # --- DEBUG LOGGING ADDED ---
+        return polling_url
+
+    def poll_once(self, polling_url: str) -> Union[str, None]:
+        """
+        Polls the results endpoint once. Returns the result HTML when ready, otherwise None
+        """
+        response = self.session.get(polling_url, timeout=30)
+        if response.status_code != 200:
             if not self.quiet:
-                # Print detailed status for debugging
-                # Only print every 5 seconds or if status changes to avoid spamming too much? 
-                # Actually, user wants to see what's happening.
-                pass
-                
-            if response.status_code != 200:
                 print(f" [Status: {response.status_code}] ", end="", flush=True)
-                time.sleep(1)
-                continue
-            
-            if not response.text or response.text.find("errorMessage") != -1:
+            return None
+        if not response.text or response.text.find("errorMessage") != -1:
+            if not self.quiet:
                 print(f" [No Content or Error Message] ", end="", flush=True)
-                time.sleep(1)
-                continue
+            return None
+        return response.text
+
+    def wait_for_results(
+        self,
+        polling_url: str,
+        timeout: float = 300,
+        initial_delay: float = 2,
+        max_delay: float = 30,
+        on_poll: Callable[[int], None] = None,
+        cancel_event: threading.Event = None,
+    ) -> str:
+        """
+        Polls with exponential backoff and equal jitter until the results are ready
+        """
+        start_wait = time.time()
+        delay = initial_delay
+        attempt = 0
+        while True:
+            attempt += 1
+            if on_poll:
+                on_poll(attempt)
+            text = self.poll_once(polling_url)
+            if text:
+                return text
+
+            remaining = timeout - (time.time() - start_wait)
+            if remaining <= 0:
+                raise Exception(error_timeout)
+            # Equal jitter: sleep a random time in [delay/2, delay] so concurrent jobs spread out
+            # while still waiting at least delay/2 between polls (full jitter could poll again at once)
+            sleep_for = min(random.uniform(delay / 2, delay), remaining)
+            if cancel_event is not None:
+                if cancel_event.wait(sleep_for):
+                    raise Exception("Cancelled")
             else:
-                break
-                
-        # Parse images
-        image_links = regex.findall(r'src="([^"]+)"', response.text)
+                time.sleep(sleep_for)
+            delay = min(delay * 2, max_delay)
+
+    @staticmethod
+    def parse_images(text: str) -> list:
+        """
+        Extracts image links from the results HTML
+        """
+        image_links = regex.findall(r'src="([^"]+)"', text)
         normal_image_links = [link.split("?w=")[0] for link in image_links]
         normal_image_links = list(set(normal_image_links))
 
@@ -237,3 +275,10 @@ class ImageGen:
             raise Exception(error_no_images)
             
         return normal_image_links
+
+    def get_images(self, prompt: str) -> list:
+        """
+        Fetches image links from Bing (blocking)
+        """
+        polling_url = self.submit(prompt)
+        return self.parse_images(self.wait_for_results(polling_url))
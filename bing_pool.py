@@ -0,0 +1,141 @@
+import contextlib
+import hashlib
+import json
+import threading
+import time
+
+# validate_session() 结果的缓存时间 (秒)
+VALIDATE_TTL = 600
+# 每个 Cookie 指纹最多保留的空闲会话数
+MAX_IDLE_PER_KEY = 2
+
+_lock = threading.Lock()
+# key -> [空闲的 ImageGen, ...]
+_idle = {}
+# user_id -> 当前使用的 key (Cookie/代理变化后淘汰旧会话)
+_user_keys = {}
+# key -> (是否有效, 验证时间)
+_validated = {}
+
+
+def parse_cookies(bing_cookie, bing_cookie_srch, full_cookie_str):
+    """
+    解析用户填写的 Cookie，支持完整 Cookie 字符串 (key=value; ...) 和 Cookie-Editor 导出的 JSON。
+    :return: (_U, SRCHHPGUSR, all_cookies_list)
+    """
+    final_u = bing_cookie
+    final_srch = bing_cookie_srch
+    all_cookies_list = []
+
+    if full_cookie_str:
+        # Clean input
+        full_cookie_str = full_cookie_str.strip()
+        # Remove "Cookie:" prefix if present (case insensitive)
+        if full_cookie_str.lower().startswith("cookie:"):
+            full_cookie_str = full_cookie_str[7:].strip()
+
+        # 尝试解析 JSON 格式 (针对 Cookie-Editor 插件导出)
+        if full_cookie_str.startswith('[') and full_cookie_str.endswith(']'):
+            for item in json.loads(full_cookie_str):
+                if 'name' in item and 'value' in item:
+                    all_cookies_list.append({'name': item['name'], 'value': item['value']})
+                    if item['name'] == "_U":
+                        final_u = item['value']
+                    elif item['name'] == "SRCHHPGUSR":
+                        final_srch = item['value']
+        else:
+            # 解析完整 Cookie 字符串 (key=value; key2=value2)
+            for item in full_cookie_str.split(';'):
+                if '=' in item:
+                    k, v = item.strip().split('=', 1)
+                    all_cookies_list.append({'name': k, 'value': v})
+                    # 自动提取关键 Cookie
+                    if k.strip() == "_U":
+                        final_u = v
+                    elif k.strip() == "SRCHHPGUSR":
+                        final_srch = v
+
+    # 如果没有填写 SRCHHPGUSR，尝试使用 _U (兼容旧逻辑)
+    if final_u and not final_srch:
+        final_srch = final_u
+    return final_u, final_srch, all_cookies_list
+
+
+def session_key(user_id, auth_cookie, auth_cookie_srch, all_cookies, proxy_url, user_agent):
+    """会话池的键：用户 + Cookie 指纹 + 代理 + UA (不保存明文 Cookie)"""
+    raw = json.dumps([auth_cookie, auth_cookie_srch, all_cookies, user_agent], sort_keys=True)
+    fingerprint = hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+    return (user_id, fingerprint, proxy_url or "")
+
+
+def _remember_key(user_id, key):
+    """用户的 Cookie 或代理变化后，丢弃旧会话及其验证结果"""
+    old_key = _user_keys.get(user_id)
+    if old_key is not None and old_key != key:
+        for session in _idle.pop(old_key, []):
+            session.session.close()
+        _validated.pop(old_key, None)
+    _user_keys[user_id] = key
+
+
+@contextlib.contextmanager
+def acquire(user_id, auth_cookie, auth_cookie_srch, all_cookies=None, proxy_url="", user_agent=None, quiet=True, diagnostics=False):
+    """
+    从池中借出一个 ImageGen (复用其 requests.Session 与 keep-alive 连接)，用完自动归还。
+    同一时刻一个会话只会被一个线程使用。
+    """
+    key = session_key(user_id, auth_cookie, auth_cookie_srch, all_cookies, proxy_url, user_agent)
+    with _lock:
+        _remember_key(user_id, key)
+        idle = _idle.get(key)
+        image_gen = idle.pop() if idle else None
+
+    if image_gen is None:
+        from bing_debug import ImageGen # 首次使用 Bing 时才导入 (requests/regex)
+        image_gen = ImageGen(
+            auth_cookie=auth_cookie,
+            auth_cookie_SRCHHPGUSR=auth_cookie_srch,
+            all_cookies=all_cookies,
+            quiet=quiet,
+            user_agent=user_agent,
+        )
+        # 如果用户配置了代理，手动设置到 session 中
+        if proxy_url:
+            image_gen.session.proxies = {"http": proxy_url, "https": proxy_url}
+            print(f"DEBUG: Using Proxy: {proxy_url}")
+    image_gen.quiet = quiet
+    image_gen.diagnostics = diagnostics
+
+    try:
+        yield image_gen
+    finally:
+        with _lock:
+            # Cookie 已被替换的旧会话不再归还
+            if _user_keys.get(user_id) == key and len(_idle.setdefault(key, [])) < MAX_IDLE_PER_KEY:
+                _idle[key].append(image_gen)
+            else:
+                image_gen.session.close()
+
+
+def validate(user_id, auth_cookie, auth_cookie_srch, all_cookies=None, proxy_url="", user_agent=None, force=False):
+    """
+    检查 Cookie 是否有效，结果按会话键缓存 VALIDATE_TTL 秒。
+    :return: (是否有效, 是否来自缓存)
+    """
+    key = session_key(user_id, auth_cookie, auth_cookie_srch, all_cookies, proxy_url, user_agent)
+    with _lock:
+        cached = _validated.get(key)
+    if cached and not force and time.time() - cached[1] < VALIDATE_TTL:
+        return cached[0], True
+
+    with acquire(user_id, auth_cookie, auth_cookie_srch, all_cookies, proxy_url, user_agent) as image_gen:
+        valid = image_gen.validate_session()
+    with _lock:
+        _validated[key] = (valid, time.time())
+    return valid, False
+
+
+def ip_diagnostics(user_id, auth_cookie, auth_cookie_srch, all_cookies=None, proxy_url="", user_agent=None):
+    """仅在显式请求诊断时探测出口 IP 所在地"""
+    with acquire(user_id, auth_cookie, auth_cookie_srch, all_cookies, proxy_url, user_agent) as image_gen:
+        return image_gen.check_ip()
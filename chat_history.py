@@ -0,0 +1,78 @@
+import os
+from collections import deque
+
+# 每个 Session 在内存中最多保留的消息数 (更早的消息被丢弃)
+MAX_MESSAGES = int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", "200"))
+# 每次 rerun 默认渲染的最近消息数
+RENDER_WINDOW = 20
+# 点击 "加载更早的消息" 时每次多渲染的条数
+PAGE_SIZE = 20
+
+
+class ChatHistory:
+    """
+    有上限的对话记录：内存中最多保留 max_messages 条，
+    渲染时只取最近 visible 条，更早的消息按需分页展开。
+    :param sink: 新消息的持久化回调 fn(message)，为空时只保存在内存中
+    """
+
+    def __init__(self, max_messages=MAX_MESSAGES, window=RENDER_WINDOW, sink=None):
+        self._messages = deque(maxlen=max_messages)
+        self.window = window
+        self.visible = window
+        self.dropped = 0  # 因超出上限被丢弃的消息数
+        self.sink = sink
+        self.has_older = False  # 数据库中是否还有更早的消息未加载
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(self._messages)
+
+    def append(self, message):
+        if len(self._messages) == self._messages.maxlen:
+            self.dropped += 1
+        self._messages.append(message)
+        if self.sink is not None:
+            self.sink(message)
+
+    @property
+    def room(self):
+        return self._messages.maxlen - len(self._messages)
+
+    @property
+    def oldest(self):
+        """已加载的最早一条持久化消息 (created_at, id)，用于向前翻页"""
+        for message in self._messages:
+            if 'id' in message:
+                return (message['created_at'], message['id'])
+        return None
+
+    def extend_older(self, messages, has_older):
+        """
+        在开头插入从数据库读取的更早消息 (从旧到新)。
+        内存已满时只插入放得下的部分，不会挤掉较新的消息；
+        被截掉的更早消息仍在数据库中，下次从 oldest 继续翻页。
+        """
+        kept = messages[-self.room:] if self.room else []
+        for message in reversed(kept):
+            self._messages.appendleft(message)
+        self.visible = min(self.visible + len(kept), len(self._messages))
+        self.has_older = has_older or len(kept) < len(messages)
+
+    def recent(self):
+        """当前窗口内的消息 (从旧到新)"""
+        start = max(len(self._messages) - self.visible, 0)
+        return [self._messages[i] for i in range(start, len(self._messages))]
+
+    @property
+    def hidden(self):
+        """内存中还有多少条更早的消息未渲染"""
+        return max(len(self._messages) - self.visible, 0)
+
+    def show_more(self, count=PAGE_SIZE):
+        self.visible = min(self.visible + count, len(self._messages))
+
+    def collapse(self):
+        self.visible = self.window
@@ -0,0 +1,156 @@
+import functools
+import os
+
+# 各模型的参考资料 token 预算 (不含系统提示词、问题和回答)
+MODEL_CONTEXT_BUDGETS = {
+    'gpt-3.5-turbo': 3000,
+    'deepseek-chat': 6000,
+    'deepseek-reasoner': 6000,
+}
+DEFAULT_CONTEXT_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# 剩余预算少于该值时不再截断放入下一段
+MIN_PARTIAL_TOKENS = 64
+# 没有 start_index 时，相邻文本块之间查找的最大重叠字符数 (略大于 chunk_overlap)
+MAX_OVERLAP_SEARCH = 400
+SEPARATOR = "\n\n"
+# 无法加载 tiktoken 编码器时，按每个 token 约 2 个字符估算
+CHARS_PER_TOKEN = 2
+
+
+def budget_for(model_name):
+    return MODEL_CONTEXT_BUDGETS.get(model_name, DEFAULT_CONTEXT_BUDGET)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoder(model_name):
+    """
+    tiktoken 编码器 (每个模型只加载一次)；DeepSeek 等未收录的模型按 cl100k_base 近似计算。
+    编码文件需要联网下载，离线或被防火墙拦截时返回 None，改用按字符数估算。
+    """
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"DEBUG: tiktoken unavailable for {model_name}, estimating tokens by characters: {e}")
+        return None
+
+
+def _estimate_tokens(text):
+    # 中文为主的文本约 1~2 个字符一个 token，按 2 个字符估算 (英文会偏多，只会少放一些参考资料)
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text, model_name):
+    encoder = get_encoder(model_name)
+    if encoder is None:
+        return _estimate_tokens(text)
+    return len(encoder.encode(text))
+
+
+def _truncate(text, max_tokens, model_name):
+    encoder = get_encoder(model_name)
+    if encoder is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    return encoder.decode(encoder.encode(text)[:max_tokens])
+
+
+def _text_overlap(left, right):
+    """left 的结尾与 right 的开头重叠的字符数"""
+    for size in range(min(len(left), len(right), MAX_OVERLAP_SEARCH), 0, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _merge_key(doc):
+    meta = doc.metadata
+    return (meta.get('doc_id') or meta.get('source'), meta.get('page'))
+
+
+def merge_chunks(docs):
+    """
+    把同一文档同一页中相邻或重叠的文本块合并成连续片段，去掉重复的重叠文本。
+    :param docs: 按相关度排序的文本块
+    :return: [{'text', 'rank', 'chunks'}, ...]，rank 为片段中最相关文本块的名次
+    """
+    groups = {}
+    for rank, doc in enumerate(docs):
+        groups.setdefault(_merge_key(doc), []).append((rank, doc))
+
+    segments = []
+    for members in groups.values():
+        members.sort(key=lambda item: (item[1].metadata.get('start_index', -1), item[1].metadata.get('chunk', item[0])))
+        current = None
+        for rank, doc in members:
+            text = doc.page_content
+            meta = doc.metadata
+            if current is not None:
+                overlap = None
+                if 'start_index' in meta and current['end'] is not None:
+                    # 有原文位置时直接计算重叠；两段之间有空隙则不合并
+                    gap = meta['start_index'] - current['end']
+                    overlap = -gap if gap <= 0 else None
+                elif meta.get('chunk') is not None and meta.get('chunk') == current['last_chunk'] + 1:
+                    overlap = _text_overlap(current['text'], text)
+                if overlap is not None:
+                    current['text'] += text[min(overlap, len(text)):]
+                    current['rank'] = min(current['rank'], rank)
+                    current['chunks'] += 1
+                    if 'start_index' in meta:
+                        current['end'] = max(current['end'], meta['start_index'] + len(text))
+                    current['last_chunk'] = meta.get('chunk', -2)
+                    continue
+                segments.append(current)
+            current = {
+                'text': text,
+                'rank': rank,
+                'chunks': 1,
+                'end': meta['start_index'] + len(text) if 'start_index' in meta else None,
+                'last_chunk': meta.get('chunk', -2),
+            }
+        if current is not None:
+            segments.append(current)
+
+    return [{'text': s['text'], 'rank': s['rank'], 'chunks': s['chunks']} for s in sorted(segments, key=lambda s: s['rank'])]
+
+
+def build_context(docs, model_name, budget=None):
+    """
+    合并重叠文本块，按相关度把片段装入模型的 token 预算。
+    :return: (context 文本, 统计信息 dict)
+    """
+    budget = budget or budget_for(model_name)
+    raw_tokens = sum(count_tokens(doc.page_content, model_name) for doc in docs)
+    separator_tokens = count_tokens(SEPARATOR, model_name)
+
+    parts = []
+    used = 0
+    truncated = False
+    for segment in merge_chunks(docs):
+        tokens = count_tokens(segment['text'], model_name)
+        cost = tokens + (separator_tokens if parts else 0)
+        if used + cost <= budget:
+            parts.append(segment['text'])
+            used += cost
+            continue
+        separator = separator_tokens if parts else 0
+        remaining = budget - used - separator
+        if remaining >= MIN_PARTIAL_TOKENS:
+            parts.append(_truncate(segment['text'], remaining, model_name))
+            used += separator + remaining
+        truncated = True
+        break
+
+    return SEPARATOR.join(parts), {
+        'chunks': len(docs),
+        'segments': len(parts),
+        'raw_tokens': raw_tokens,
+        'context_tokens': used,
+        'saved_tokens': max(raw_tokens - used, 0),
+        'budget': budget,
+        'truncated': truncated,
+    }
@@ -1,15 +1,119 @@
 import sqlite3
+import atexit
 import hashlib
 import os
+import queue
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 DB_FILE = "users.db"
 
-def init_db():
-    """初始化数据库表"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    
-    # 创建用户表
+# --- 连接池 ---
+# Streamlit 每次 rerun 都可能在新的脚本线程中运行，因此不按线程长期持有连接，
+# 而是每次操作从池中借出一个连接 (同一时刻只被一个线程使用)，用完归还。
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+_pool_db_file = DB_FILE
+
+# 用户配置的进程内缓存 (读穿透 + 写穿透)，TTL 兜底多进程部署时的不一致
+CONFIG_CACHE_TTL = 60
+_config_cache = {}
+_config_lock = threading.Lock()
+
+# --- 登录 ---
+# PBKDF2 迭代次数 (新注册或登录成功时按该值重新哈希)
+PBKDF2_ITERATIONS = int(os.getenv("PBKDF2_ITERATIONS", "100000"))
+# 密码哈希线程池：限制同时进行的哈希计算，集中登录时不会占满 CPU
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))
+# 排队等待哈希的请求上限，超过时直接提示稍后再试
+MAX_PENDING_HASHES = int(os.getenv("MAX_PENDING_HASHES", "64"))
+# 同一用户名在 LOGIN_WINDOW 秒内最多失败 LOGIN_MAX_FAILURES 次
+LOGIN_MAX_FAILURES = 5
+LOGIN_WINDOW = 300
+# 最多记录的用户名数量 (随机用户名刷登录接口时，淘汰最早失败的记录)
+MAX_TRACKED_LOGINS = int(os.getenv("MAX_TRACKED_LOGINS", "10000"))
+# "记住此设备" 令牌有效期 (秒)。令牌放在页面链接中，每次使用后轮换，有效期从最后一次使用起算
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(7 * 24 * 3600)))
+
+_hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="password-hash")
+_hash_slots = threading.BoundedSemaphore(MAX_PENDING_HASHES)
+# username -> [失败时间, ...]，按最近一次失败时间排序；过期记录随时清理，总数不超过 MAX_TRACKED_LOGINS
+_login_failures = OrderedDict()
+_login_lock = threading.Lock()
+
+# --- 对话记录 ---
+# 消息先进入内存队列，由单个写线程每 CHAT_FLUSH_INTERVAL 秒 (或攒满 CHAT_FLUSH_BATCH 条) 批量追加写入
+CHAT_FLUSH_INTERVAL = 0.5
+CHAT_FLUSH_BATCH = 500
+# 批量写入失败 (如 database is locked) 时的重试次数，每次重试前等待 CHAT_RETRY_DELAY * 2^n 秒
+CHAT_WRITE_ATTEMPTS = 5
+CHAT_RETRY_DELAY = 0.2
+_chat_queue = queue.Queue()
+_chat_writer = None
+_chat_pending = 0  # 已入队但尚未写入数据库的消息数
+_chat_lock = threading.Lock()
+
+CONFIG_FIELDS = [
+    'api_key', 'base_url', 'embedding_type', 'image_provider', 'image_api_key',
+    'bing_cookie', 'bing_cookie_srch', 'full_cookie_str', 'proxy_url',
+]
+
+def _connect():
+    """创建一个调优过的连接：WAL 模式允许读写并发，写操作只在提交时短暂加锁"""
+    conn = sqlite3.connect(DB_FILE, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")   # WAL 下 NORMAL 已保证不损坏
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-8000")     # 约 8MB 页缓存
+    return conn
+
+def _acquire():
+    """从连接池借出连接"""
+    global _pool_db_file
+    if _pool_db_file != DB_FILE:
+        # 数据库文件被切换 (例如测试/基准脚本)，丢弃旧连接
+        reset_pool()
+        _pool_db_file = DB_FILE
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        return _connect()
+
+def _release(conn):
+    """归还连接；未提交的事务先回滚，池满时直接关闭"""
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+    except sqlite3.Error:
+        conn.close()
+
+def reset_pool():
+    """关闭池中所有连接并清空配置缓存"""
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            break
+    with _config_lock:
+        _config_cache.clear()
+
+# --- 数据库迁移 ---
+# 数据库版本记录在 PRAGMA user_version 中，每个迁移只会执行一次。
+# 新的表结构变更请追加到 MIGRATIONS 末尾，不要修改已发布的迁移。
+
+def _columns(c, table):
+    c.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in c.fetchall()}
+
+def _migration_1(c):
+    """用户表与配置表"""
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -18,8 +122,6 @@ def init_db():
             salt TEXT NOT NULL
         )
     ''')
-    
-    # 创建配置表
     # 使用 user_id 作为主键，确保每个用户只有一行配置
     c.execute('''
         CREATE TABLE IF NOT EXISTS user_configs (
@@ -30,77 +132,138 @@ def init_db():
             image_provider TEXT,
             image_api_key TEXT,
             bing_cookie TEXT,
-            bing_cookie_srch TEXT,
-            full_cookie_str TEXT,
             proxy_url TEXT,
-            siliconflow_api_key TEXT,
-            oss_endpoint TEXT,
-            oss_access_key_id TEXT,
-            oss_access_key_secret TEXT,
-            oss_bucket_name TEXT,
             FOREIGN KEY(user_id) REFERENCES users(id)
         )
     ''')
-    
-    conn.commit()
-    conn.close()
 
-def check_migrations():
-    """检查并应用数据库迁移 (添加缺失的列)"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    
-    # 1. 检查 user_configs 表是否存在 bing_cookie_srch
-    try:
-        c.execute("SELECT bing_cookie_srch FROM user_configs LIMIT 1")
-    except sqlite3.OperationalError:
-        # 列不存在，添加它
-        try:
-            print("Applying migration: Adding bing_cookie_srch column...")
-            c.execute("ALTER TABLE user_configs ADD COLUMN bing_cookie_srch TEXT")
-        except Exception as e:
-            print(f"Migration error (bing_cookie_srch): {e}")
+def _migration_2(c):
+    """补齐旧数据库缺少的 Cookie / SiliconFlow / OSS 配置列"""
+    existing = _columns(c, "user_configs")
+    for column in ['bing_cookie_srch', 'full_cookie_str', 'siliconflow_api_key',
+                   'oss_endpoint', 'oss_access_key_id', 'oss_access_key_secret', 'oss_bucket_name']:
+        if column not in existing:
+            print(f"Applying migration: Adding {column} column...")
+            c.execute(f"ALTER TABLE user_configs ADD COLUMN {column} TEXT")
 
-    # 2. 检查 user_configs 表是否存在 full_cookie_str
-    try:
-        c.execute("SELECT full_cookie_str FROM user_configs LIMIT 1")
-    except sqlite3.OperationalError:
-        # 列不存在，添加它
-        try:
-            print("Applying migration: Adding full_cookie_str column...")
-            c.execute("ALTER TABLE user_configs ADD COLUMN full_cookie_str TEXT")
-        except Exception as e:
-            print(f"Migration error (full_cookie_str): {e}")
+def _migration_3(c):
+    """知识库文档表：同一文档 (doc_id 为内容哈希) 在不同 Embedding 模型下分别建索引"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS user_documents (
+            user_id INTEGER NOT NULL,
+            doc_id TEXT NOT NULL,
+            embed_key TEXT NOT NULL,
+            filename TEXT,
+            chunk_count INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY(user_id, embed_key, doc_id),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
 
-    # 3. 检查 user_configs 表是否存在 siliconflow_api_key
-    try:
-        c.execute("SELECT siliconflow_api_key FROM user_configs LIMIT 1")
-    except sqlite3.OperationalError:
-        # 列不存在，添加它
-        try:
-            print("Applying migration: Adding siliconflow_api_key column...")
-            c.execute("ALTER TABLE user_configs ADD COLUMN siliconflow_api_key TEXT")
-        except Exception as e:
-            print(f"Migration error (siliconflow_api_key): {e}")
+def _migration_4(c):
+    """记录每个用户的 KDF 迭代次数 (旧数据为 100000)，新增登录令牌表"""
+    if 'kdf_iterations' not in _columns(c, "users"):
+        c.execute("ALTER TABLE users ADD COLUMN kdf_iterations INTEGER NOT NULL DEFAULT 100000")
+    # 只保存令牌的 SHA-256，数据库泄露不会暴露可用的令牌
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            token_hash TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_user ON user_sessions(user_id)")
+
+def _migration_5(c):
+    """对话与消息表 (消息只追加，不修改)"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            title TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user ON conversations(user_id, updated_at)")
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            FOREIGN KEY(conversation_id) REFERENCES conversations(id)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_messages_conversation ON chat_messages(user_id, conversation_id, created_at)")
+
+def _migration_6(c):
+    """
+    跨用户共享的索引段：相同内容 (doc_id) + 相同 Embedding 只建一次索引。
+    引用计数即 shared = 1 的 user_documents 行数，为 0 时由 collect_shared_segments 回收。
+    """
+    if 'shared' not in _columns(c, "user_documents"):
+        c.execute("ALTER TABLE user_documents ADD COLUMN shared INTEGER NOT NULL DEFAULT 0")
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS shared_segments (
+            embed_key TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            path TEXT NOT NULL,
+            status TEXT NOT NULL,
+            chunk_count INTEGER,
+            claimed_at REAL NOT NULL,
+            PRIMARY KEY(embed_key, doc_id)
+        )
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_documents_shared
+        ON user_documents(embed_key, doc_id) WHERE shared = 1
+    ''')
+
+def _migration_7(c):
+    """
+    共享文档改为写入每个 Embedding 模型一个的共享库 (按 doc_id 过滤)，不再每个文档一个目录。
+    shared_segments.path 改为 build_id (本次建立的标识)；旧布局下按目录保存的共享文档无法读取，
+    清除其登记 (用户重新上传即可，向量由磁盘缓存提供，无需重新计算)。
+    """
+    if 'path' in _columns(c, "shared_segments"):
+        c.execute("ALTER TABLE shared_segments RENAME COLUMN path TO build_id")
+    c.execute("DELETE FROM shared_segments")
+    c.execute("DELETE FROM user_documents WHERE shared = 1")
+
+MIGRATIONS = [_migration_1, _migration_2, _migration_3, _migration_4, _migration_5, _migration_6, _migration_7]
+SCHEMA_VERSION = len(MIGRATIONS)
 
-    # 4. 检查 user_configs 表是否存在 oss_endpoint
+def init_db():
+    """
+    初始化 / 升级数据库。
+    已是最新版本时只读取一次 user_version；否则在一个写事务中依次执行未应用的迁移。
+    BEGIN IMMEDIATE 会先拿到写锁，多个服务进程同时启动时只有一个会真正执行迁移。
+    """
+    conn = _acquire()
+    c = conn.cursor()
+    
     try:
-        c.execute("SELECT oss_endpoint FROM user_configs LIMIT 1")
-    except sqlite3.OperationalError:
-        # 列不存在，添加它们 (批量添加)
-        try:
-            print("Applying migration: Adding OSS columns...")
-            c.execute("ALTER TABLE user_configs ADD COLUMN oss_endpoint TEXT")
-            c.execute("ALTER TABLE user_configs ADD COLUMN oss_access_key_id TEXT")
-            c.execute("ALTER TABLE user_configs ADD COLUMN oss_access_key_secret TEXT")
-            c.execute("ALTER TABLE user_configs ADD COLUMN oss_bucket_name TEXT")
-        except Exception as e:
-            print(f"Migration error (OSS columns): {e}")
-
-    conn.commit()
-    conn.close()
-
-def hash_password(password, salt=None):
+        if c.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        c.execute("BEGIN IMMEDIATE")
+        # 拿到写锁后重新读取，其他进程可能已经完成迁移
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(c)
+            print(f"DEBUG: Applied DB migration {number}")
+        c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+    finally:
+        _release(conn)
+
+def hash_password(password, salt=None, iterations=PBKDF2_ITERATIONS):
     """简单的密码哈希"""
     if salt is None:
         salt = os.urandom(16).hex()
@@ -110,14 +273,51 @@ def hash_password(password, salt=None):
         'sha256',
         password.encode('utf-8'),
         bytes.fromhex(salt),
-        100000
+        iterations
     ).hex()
     
     return pwd_hash, salt
 
+def _hash_in_pool(password, salt=None, iterations=PBKDF2_ITERATIONS):
+    """
+    在有界线程池中计算密码哈希 (pbkdf2_hmac 计算期间会释放 GIL)。
+    排队请求过多时返回 None。
+    """
+    if not _hash_slots.acquire(blocking=False):
+        return None
+    try:
+        return _hash_pool.submit(hash_password, password, salt, iterations).result()
+    finally:
+        _hash_slots.release()
+
+def _recent_failures(username, now):
+    failures = [t for t in _login_failures.get(username, []) if now - t < LOGIN_WINDOW]
+    if failures:
+        _login_failures[username] = failures
+    else:
+        _login_failures.pop(username, None)
+    return failures
+
+def _record_login_failure(username):
+    now = time.time()
+    with _login_lock:
+        _login_failures.setdefault(username, []).append(now)
+        _login_failures.move_to_end(username)
+        # 最前面的记录最近一次失败最早：先清理已过期的，再按上限淘汰
+        while _login_failures:
+            oldest, failures = next(iter(_login_failures.items()))
+            if now - failures[-1] < LOGIN_WINDOW and len(_login_failures) <= MAX_TRACKED_LOGINS:
+                break
+            del _login_failures[oldest]
+
 def register_user(username, password):
     """注册新用户"""
-    conn = sqlite3.connect(DB_FILE)
+    hashed = _hash_in_pool(password)
+    if hashed is None:
+        return False, "服务器繁忙，请稍后再试"
+    pwd_hash, salt = hashed
+
+    conn = _acquire()
     c = conn.cursor()
     
     try:
@@ -126,10 +326,8 @@ def register_user(username, password):
         if c.fetchone():
             return False, "用户名已存在"
         
-        pwd_hash, salt = hash_password(password)
-        
-        c.execute("INSERT INTO users (username, password_hash, salt) VALUES (?, ?, ?)",
-                  (username, pwd_hash, salt))
+        c.execute("INSERT INTO users (username, password_hash, salt, kdf_iterations) VALUES (?, ?, ?, ?)",
+                  (username, pwd_hash, salt, PBKDF2_ITERATIONS))
         
         # 初始化空配置
         user_id = c.lastrowid
@@ -140,33 +338,116 @@ def register_user(username, password):
     except Exception as e:
         return False, str(e)
     finally:
-        conn.close()
+        _release(conn)
 
 def login_user(username, password):
     """用户登录"""
-    conn = sqlite3.connect(DB_FILE)
+    with _login_lock:
+        if len(_recent_failures(username, time.time())) >= LOGIN_MAX_FAILURES:
+            return None, "尝试次数过多，请稍后再试"
+
+    conn = _acquire()
     c = conn.cursor()
     
     try:
-        c.execute("SELECT id, password_hash, salt FROM users WHERE username = ?", (username,))
+        c.execute("SELECT id, password_hash, salt, kdf_iterations FROM users WHERE username = ?", (username,))
         user = c.fetchone()
+    finally:
+        _release(conn)
         
-        if not user:
-            return None, "用户不存在"
-        
-        user_id, stored_hash, salt = user
-        input_hash, _ = hash_password(password, salt)
-        
-        if input_hash == stored_hash:
-            return user_id, "登录成功"
-        else:
-            return None, "密码错误"
+    if not user:
+        _record_login_failure(username)
+        return None, "用户不存在"
+    
+    user_id, stored_hash, salt, iterations = user
+    hashed = _hash_in_pool(password, salt, iterations)
+    if hashed is None:
+        return None, "服务器繁忙，请稍后再试"
+    
+    if not secrets.compare_digest(hashed[0], stored_hash):
+        _record_login_failure(username)
+        return None, "密码错误"
+
+    with _login_lock:
+        _login_failures.pop(username, None)
+    if iterations != PBKDF2_ITERATIONS:
+        # 迭代次数配置变化后，登录成功时按新的成本重新哈希
+        rehashed = _hash_in_pool(password, iterations=PBKDF2_ITERATIONS)
+        if rehashed is not None:
+            conn = _acquire()
+            try:
+                conn.execute("UPDATE users SET password_hash = ?, salt = ?, kdf_iterations = ? WHERE id = ?",
+                             (rehashed[0], rehashed[1], PBKDF2_ITERATIONS, user_id))
+                conn.commit()
+            finally:
+                _release(conn)
+    return user_id, "登录成功"
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def create_session(user_id, ttl=SESSION_TTL):
+    """为 "记住此设备" 创建登录令牌，返回明文令牌 (只有客户端保存)"""
+    token = secrets.token_urlsafe(32)
+    now = time.time()
+    conn = _acquire()
+    
+    try:
+        # 顺便清理过期令牌
+        conn.execute("DELETE FROM user_sessions WHERE expires_at < ?", (now,))
+        conn.execute("INSERT INTO user_sessions (token_hash, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                     (_token_hash(token), user_id, now, now + ttl))
+        conn.commit()
+        return token
     finally:
-        conn.close()
+        _release(conn)
+
+def resolve_session(token, ttl=SESSION_TTL):
+    """
+    用令牌登录 (一次主键查询，不做密码哈希)，同时轮换令牌：旧令牌立即作废，
+    从浏览历史、书签或分享出去的链接中泄露的旧令牌无法再次使用。
+    :return: (user_id, username, new_token)；令牌无效或过期时返回 (None, None, None)
+    """
+    if not token:
+        return None, None, None
+    conn = _acquire()
+    c = conn.cursor()
+    
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        row = c.execute('''
+            SELECT users.id, users.username FROM user_sessions
+            JOIN users ON users.id = user_sessions.user_id
+            WHERE user_sessions.token_hash = ? AND user_sessions.expires_at > ?
+        ''', (_token_hash(token), now)).fetchone()
+        if row is None:
+            conn.commit()
+            return None, None, None
+        new_token = secrets.token_urlsafe(32)
+        c.execute("DELETE FROM user_sessions WHERE token_hash = ?", (_token_hash(token),))
+        c.execute("INSERT INTO user_sessions (token_hash, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                  (_token_hash(new_token), row[0], now, now + ttl))
+        conn.commit()
+        return row[0], row[1], new_token
+    finally:
+        _release(conn)
+
+def revoke_session(token):
+    """退出登录时作废令牌"""
+    if not token:
+        return
+    conn = _acquire()
+    
+    try:
+        conn.execute("DELETE FROM user_sessions WHERE token_hash = ?", (_token_hash(token),))
+        conn.commit()
+    finally:
+        _release(conn)
 
 def save_user_config(user_id, config):
     """保存用户配置"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = _acquire()
     c = conn.cursor()
     
     try:
@@ -190,16 +471,24 @@ def save_user_config(user_id, config):
             user_id
         ))
         conn.commit()
+        # 写穿透：更新进程内缓存
+        with _config_lock:
+            _config_cache[user_id] = ({k: config.get(k, '') or "" for k in CONFIG_FIELDS}, time.time())
         return True
     except Exception as e:
         print(f"Save config error: {e}")
         return False
     finally:
-        conn.close()
+        _release(conn)
 
 def get_user_config(user_id):
-    """获取用户配置"""
-    conn = sqlite3.connect(DB_FILE)
+    """获取用户配置 (优先读取进程内缓存)"""
+    with _config_lock:
+        cached = _config_cache.get(user_id)
+    if cached and time.time() - cached[1] < CONFIG_CACHE_TTL:
+        return dict(cached[0])
+
+    conn = _acquire()
     c = conn.cursor()
     
     try:
@@ -211,24 +500,356 @@ def get_user_config(user_id):
         row = c.fetchone()
         
         if row:
-            return {
-                'api_key': row[0] or "",
-                'base_url': row[1] or "",
-                'embedding_type': row[2] or "",
-                'image_provider': row[3] or "",
-                'image_api_key': row[4] or "",
-                'bing_cookie': row[5] or "",
-                'bing_cookie_srch': row[6] or "",
-                'full_cookie_str': row[7] or "",
-                'proxy_url': row[8] or ""
-            }
+            config = dict(zip(CONFIG_FIELDS, (value or "" for value in row)))
+            # 读穿透：写入进程内缓存
+            with _config_lock:
+                _config_cache[user_id] = (config, time.time())
+            return dict(config)
         return {}
     finally:
-        conn.close()
+        _release(conn)
+
+def add_user_document(user_id, embed_key, doc_id, filename, chunk_count):
+    """登记用户知识库中的文档"""
+    conn = _acquire()
+    c = conn.cursor()
+    
+    try:
+        c.execute('''
+            INSERT OR REPLACE INTO user_documents (user_id, embed_key, doc_id, filename, chunk_count)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, embed_key, doc_id, filename, chunk_count))
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Add document error: {e}")
+        return False
+    finally:
+        _release(conn)
+
+def list_user_documents(user_id, embed_key):
+    """列出用户知识库中的文档 (最新的在前)"""
+    conn = _acquire()
+    c = conn.cursor()
+    
+    try:
+        c.execute('''
+            SELECT doc_id, filename, chunk_count, created_at, shared
+            FROM user_documents
+            WHERE user_id = ? AND embed_key = ?
+            ORDER BY created_at DESC, rowid DESC
+        ''', (user_id, embed_key))
+        return [
+            {'doc_id': row[0], 'filename': row[1], 'chunk_count': row[2], 'created_at': row[3],
+             'shared': bool(row[4])}
+            for row in c.fetchall()
+        ]
+    finally:
+        _release(conn)
+
+def remove_user_document(user_id, embed_key, doc_id):
+    """从用户知识库登记表中删除文档"""
+    conn = _acquire()
+    c = conn.cursor()
+    
+    try:
+        c.execute("DELETE FROM user_documents WHERE user_id = ? AND embed_key = ? AND doc_id = ?",
+                  (user_id, embed_key, doc_id))
+        conn.commit()
+        return c.rowcount > 0
+    finally:
+        _release(conn)
+
+# --- 共享索引段 ---
+# 同一 Embedding 模型的所有共享文档写入同一个共享库 (按 doc_id 过滤检索)，本表只记录每个文档的建立状态：
+# building (建立中) -> ready (可挂载) -> removing (引用计数为 0 或建立失败，正在删除其文本块) -> 删除记录
+def claim_shared_segment(embed_key, doc_id, build_id, stale_after):
+    """
+    查询 / 认领共享文档。
+    :param build_id: 本次建立的唯一标识，之后完成 / 放弃时用于确认认领仍属于自己
+    :param stale_after: 建立中 (或删除中) 的记录超过该秒数未完成，视为对方进程已退出，可以重新认领
+    :return: (status, build_id)；status 为 'ready' (可直接挂载)、'building' (其他人正在建立或删除，稍后重试)
+             或 'claimed' (由调用方写入文本块，完成后调用 finish_shared_segment)
+    """
+    conn = _acquire()
+    c = conn.cursor()
+    
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        row = c.execute("SELECT status, build_id, claimed_at FROM shared_segments WHERE embed_key = ? AND doc_id = ?",
+                        (embed_key, doc_id)).fetchone()
+        now = time.time()
+        if row is None:
+            c.execute('''
+                INSERT INTO shared_segments (embed_key, doc_id, build_id, status, claimed_at)
+                VALUES (?, ?, ?, 'building', ?)
+            ''', (embed_key, doc_id, build_id, now))
+            conn.commit()
+            return 'claimed', build_id
+        status, current_build_id, claimed_at = row
+        if status != 'ready' and now - claimed_at > stale_after:
+            # 接手超时的记录：新的建立者按相同的 chunk id 覆盖写入；
+            # 上一个建立者之后完成 / 放弃时因 build_id 不匹配而不做任何修改
+            c.execute('''
+                UPDATE shared_segments SET build_id = ?, status = 'building', claimed_at = ?
+                WHERE embed_key = ? AND doc_id = ?
+            ''', (build_id, now, embed_key, doc_id))
+            conn.commit()
+            return 'claimed', build_id
+        conn.commit()
+        return ('ready' if status == 'ready' else 'building'), current_build_id
+    finally:
+        _release(conn)
+
+def finish_shared_segment(user_id, embed_key, doc_id, build_id, filename, chunk_count):
+    """
+    共享文档写入完成 (之后只读)；与挂载到建立者的知识库在同一事务中，避免刚建好就因引用数为 0 被回收。
+    :return: 认领已被放弃或被其他建立者接手 (build_id 不再匹配) 时返回 False，不做任何登记
+    """
+    conn = _acquire()
+    c = conn.cursor()
+    
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute('''
+            UPDATE shared_segments SET status = 'ready', chunk_count = ?
+            WHERE embed_key = ? AND doc_id = ? AND build_id = ? AND status = 'building'
+        ''', (chunk_count, embed_key, doc_id, build_id))
+        if c.rowcount == 0:
+            conn.rollback()
+            return False
+        c.execute('''
+            INSERT OR REPLACE INTO user_documents (user_id, embed_key, doc_id, filename, chunk_count, shared)
+            VALUES (?, ?, ?, ?, ?, 1)
+        ''', (user_id, embed_key, doc_id, filename, chunk_count))
+        conn.commit()
+        return True
+    finally:
+        _release(conn)
+
+def abandon_shared_segment(embed_key, doc_id, build_id):
+    """
+    建立失败时放弃认领：记录转为 removing，由调用方删除已写入的文本块后调用 delete_shared_segment。
+    :return: 认领已被其他建立者接手 (build_id 不同) 时返回 False，调用方不能删除文本块
+    """
+    conn = _acquire()
+    c = conn.cursor()
+    
+    try:
+        c.execute('''
+            UPDATE shared_segments SET status = 'removing', claimed_at = ?
+            WHERE embed_key = ? AND doc_id = ? AND build_id = ? AND status = 'building'
+        ''', (time.time(), embed_key, doc_id, build_id))
+        conn.commit()
+        return c.rowcount > 0
+    finally:
+        _release(conn)
+
+def delete_shared_segment(embed_key, doc_id, build_id):
+    """文本块删除完成后删除记录，之后相同文档可以重新建立"""
+    conn = _acquire()
+    c = conn.cursor()
+    
+    try:
+        c.execute("DELETE FROM shared_segments WHERE embed_key = ? AND doc_id = ? AND build_id = ? AND status = 'removing'",
+                  (embed_key, doc_id, build_id))
+        conn.commit()
+    finally:
+        _release(conn)
+
+def attach_shared_document(user_id, embed_key, doc_id, filename):
+    """
+    把已建好的共享索引段登记到用户知识库 (引用计数 +1)。
+    与回收在同一把写锁下检查段是否存在，不会挂载到正在被回收的段。
+    :return: 段的文本块数量；段不存在或尚未建好时返回 None
+    """
+    conn = _acquire()
+    c = conn.cursor()
+    
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        row = c.execute('''
+            SELECT chunk_count FROM shared_segments
+            WHERE embed_key = ? AND doc_id = ? AND status = 'ready'
+        ''', (embed_key, doc_id)).fetchone()
+        if row is None:
+            return None
+        c.execute('''
+            INSERT OR REPLACE INTO user_documents (user_id, embed_key, doc_id, filename, chunk_count, shared)
+            VALUES (?, ?, ?, ?, ?, 1)
+        ''', (user_id, embed_key, doc_id, filename, row[0]))
+        conn.commit()
+        return row[0]
+    finally:
+        _release(conn)
+
+def collect_shared_segments():
+    """
+    把引用计数为 0 的共享文档转为 removing (此时不能再挂载或重新认领)。
+    :return: [(embed_key, doc_id, build_id, chunk_count), ...]，调用方删除其文本块后调用 delete_shared_segment
+    """
+    conn = _acquire()
+    c = conn.cursor()
+    
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        rows = c.execute('''
+            SELECT embed_key, doc_id, build_id, chunk_count FROM shared_segments s
+            WHERE status = 'ready' AND NOT EXISTS (
+                SELECT 1 FROM user_documents d
+                WHERE d.shared = 1 AND d.embed_key = s.embed_key AND d.doc_id = s.doc_id
+            )
+        ''').fetchall()
+        now = time.time()
+        c.executemany("UPDATE shared_segments SET status = 'removing', claimed_at = ? WHERE embed_key = ? AND doc_id = ?",
+                      [(now, embed_key, doc_id) for embed_key, doc_id, _, _ in rows])
+        conn.commit()
+        return rows
+    finally:
+        _release(conn)
+
+def create_conversation(user_id, title=""):
+    """新建对话，返回对话 ID"""
+    now = time.time()
+    conn = _acquire()
+    
+    try:
+        c = conn.cursor()
+        c.execute("INSERT INTO conversations (user_id, title, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                  (user_id, title, now, now))
+        conn.commit()
+        return c.lastrowid
+    finally:
+        _release(conn)
+
+def list_conversations(user_id, limit=20):
+    """用户最近的对话 (最近更新的在前)"""
+    conn = _acquire()
+    
+    try:
+        rows = conn.execute('''
+            SELECT id, title, created_at, updated_at FROM conversations
+            WHERE user_id = ? ORDER BY updated_at DESC LIMIT ?
+        ''', (user_id, limit)).fetchall()
+        return [{'id': row[0], 'title': row[1], 'created_at': row[2], 'updated_at': row[3]} for row in rows]
+    finally:
+        _release(conn)
+
+def _insert_chat_batch(batch):
+    conn = _acquire()
+    
+    try:
+        conn.executemany(
+            "INSERT INTO chat_messages (conversation_id, user_id, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+            batch,
+        )
+        latest = {}
+        for conversation_id, _, _, _, created_at in batch:
+            latest[conversation_id] = max(latest.get(conversation_id, 0), created_at)
+        conn.executemany("UPDATE conversations SET updated_at = ? WHERE id = ?",
+                         [(created_at, conversation_id) for conversation_id, created_at in latest.items()])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        _release(conn)
+
+def _write_chat_batch(batch):
+    """写入一批消息 (同一事务)；暂时性错误 (如其他进程持有写锁) 按指数退避重试，全部失败才丢弃"""
+    global _chat_pending
+    try:
+        for attempt in range(1, CHAT_WRITE_ATTEMPTS + 1):
+            try:
+                _insert_chat_batch(batch)
+                return
+            except Exception as e:
+                if attempt == CHAT_WRITE_ATTEMPTS:
+                    print(f"DEBUG: Chat history write failed, dropping {len(batch)} messages: {e}")
+                    return
+                print(f"DEBUG: Chat history write failed (attempt {attempt}/{CHAT_WRITE_ATTEMPTS}), retrying: {e}")
+                time.sleep(CHAT_RETRY_DELAY * 2 ** (attempt - 1))
+    finally:
+        with _chat_lock:
+            _chat_pending -= len(batch)
+
+def _chat_writer_loop():
+    while True:
+        item = _chat_queue.get()
+        batch, waiters = [], []
+        deadline = time.time() + CHAT_FLUSH_INTERVAL
+        while True:
+            if isinstance(item, threading.Event):
+                # flush_chat_messages() 的同步点：写完当前批次后通知
+                waiters.append(item)
+                break
+            batch.append(item)
+            if len(batch) >= CHAT_FLUSH_BATCH:
+                break
+            try:
+                item = _chat_queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+        if batch:
+            _write_chat_batch(batch)
+        for event in waiters:
+            event.set()
+
+def append_chat_message(user_id, conversation_id, role, content):
+    """追加一条消息 (异步批量写入，立即返回)"""
+    global _chat_writer, _chat_pending
+    with _chat_lock:
+        if _chat_writer is None:
+            _chat_writer = threading.Thread(target=_chat_writer_loop, name="chat-writer", daemon=True)
+            _chat_writer.start()
+        _chat_pending += 1
+    _chat_queue.put((conversation_id, user_id, role, content, time.time()))
+
+def flush_chat_messages(timeout=10):
+    """等待已入队的消息全部写入数据库"""
+    with _chat_lock:
+        if _chat_writer is None or _chat_pending <= 0:
+            return
+    done = threading.Event()
+    _chat_queue.put(done)
+    done.wait(timeout)
+
+def load_chat_messages(user_id, conversation_id, before=None, limit=20):
+    """
+    读取对话的一页消息 (默认最近一页)。
+    :param before: 已加载的最早一条消息 (created_at, id)，只读取比它更早的消息 (向前翻页)
+    :return: (消息列表 (从旧到新), 是否还有更早的消息)
+    """
+    flush_chat_messages()
+    conn = _acquire()
+    
+    try:
+        # 走 (user_id, conversation_id, created_at) 索引倒序扫描定位一页 (id 即 rowid，隐含在索引末尾，排序无需额外步骤)；
+        # 该索引不是覆盖索引：role / content 需按 rowid 回表读取，每页只回表 limit + 1 行。
+        # 不把 content 放进索引，避免索引体积随消息正文膨胀
+        if before is None:
+            rows = conn.execute('''
+                SELECT id, role, content, created_at FROM chat_messages
+                WHERE user_id = ? AND conversation_id = ?
+                ORDER BY created_at DESC, id DESC LIMIT ?
+            ''', (user_id, conversation_id, limit + 1)).fetchall()
+        else:
+            rows = conn.execute('''
+                SELECT id, role, content, created_at FROM chat_messages
+                WHERE user_id = ? AND conversation_id = ? AND (created_at, id) < (?, ?)
+                ORDER BY created_at DESC, id DESC LIMIT ?
+            ''', (user_id, conversation_id, before[0], before[1], limit + 1)).fetchall()
+    finally:
+        _release(conn)
+    has_more = len(rows) > limit
+    messages = [
+        {'id': row[0], 'role': row[1], 'content': row[2], 'created_at': row[3]}
+        for row in reversed(rows[:limit])
+    ]
+    return messages, has_more
 
-# 初始化数据库 (如果不存在)
-if not os.path.exists(DB_FILE):
-    init_db()
+# 进程退出前写完队列中的消息
+atexit.register(flush_chat_messages)
 
-# 每次运行时检查迁移 (确保现有数据库拥有新字段)
-check_migrations()
+# 启动时执行一次迁移 (Streamlit rerun 不会重新导入模块)
+init_db()
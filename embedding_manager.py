@@ -0,0 +1,109 @@
+import threading
+
+# 本地 Embedding 模型名称 (sentence-transformers)
+LOCAL_EMBED_MODEL = "all-MiniLM-L6-v2"
+
+# 进程级单例：所有 Session 共享同一个模型实例
+_local_embeddings = None
+_local_lock = threading.Lock()
+_warmup_thread = None
+
+
+def get_local_embeddings():
+    """
+    获取进程内共享的本地 HuggingFace Embeddings。
+    首次调用时加载模型 (可能需要下载)，之后直接复用。
+    """
+    global _local_embeddings
+    if _local_embeddings is not None:
+        return _local_embeddings
+
+    with _local_lock:
+        # 双重检查，避免多个线程同时加载模型
+        if _local_embeddings is None:
+            from langchain_community.embeddings import HuggingFaceEmbeddings
+            print(f"DEBUG: Loading local embedding model: {LOCAL_EMBED_MODEL}")
+            _local_embeddings = HuggingFaceEmbeddings(model_name=LOCAL_EMBED_MODEL)
+    return _local_embeddings
+
+
+def is_local_ready():
+    """本地模型是否已加载完成"""
+    return _local_embeddings is not None
+
+
+def start_warmup():
+    """
+    在后台线程中预热本地模型 (进程启动时调用一次即可，重复调用无副作用)。
+    """
+    global _warmup_thread
+    with _local_lock:
+        if _warmup_thread is not None or _local_embeddings is not None:
+            return
+
+        def _warmup():
+            try:
+                embeddings = get_local_embeddings()
+                # 跑一次推理，让权重真正加载进内存
+                embeddings.embed_query("warmup")
+                print("DEBUG: Local embedding model warmed up.")
+            except Exception as e:
+                print(f"DEBUG: Local embedding warmup failed: {e}")
+
+        _warmup_thread = threading.Thread(target=_warmup, name="embedding-warmup", daemon=True)
+        _warmup_thread.start()
+
+
+_shared_local_proxy = None
+
+
+def _get_shared_local_proxy():
+    """
+    共享本地模型的轻量代理：创建时不加载模型，第一次计算向量时才等待模型就绪。
+    这样在预热完成前打开向量库也不会阻塞页面渲染。
+    (代理类在首次使用时才定义，导入本模块不会加载 LangChain)
+    """
+    global _shared_local_proxy
+    if _shared_local_proxy is None:
+        from langchain_core.embeddings import Embeddings
+
+        class SharedLocalEmbeddings(Embeddings):
+            def embed_documents(self, texts):
+                return get_local_embeddings().embed_documents(texts)
+
+            def embed_query(self, text):
+                return get_local_embeddings().embed_query(text)
+
+        _shared_local_proxy = SharedLocalEmbeddings()
+    return _shared_local_proxy
+
+
+def get_embedding_key(embedding_type, base_url):
+    """
+    Embedding 模型的唯一标识，用于区分缓存和向量库。
+    不同模型产生的向量不能混用。
+    """
+    if embedding_type == "本地 HuggingFace (免费/慢)":
+        return f"hf-{LOCAL_EMBED_MODEL}"
+
+    from urllib.parse import urlparse
+    host = urlparse(base_url or "").netloc or "openai"
+    if "openai" in host:
+        host = "openai"
+    return f"openai-text-embedding-3-small-{host}"
+
+
+def get_embeddings(embedding_type, api_key, base_url):
+    """
+    根据用户选择返回 Embeddings 实例。
+    本地模型返回进程级共享实例；OpenAI 兼容接口按用户配置创建。
+    """
+    if embedding_type == "本地 HuggingFace (免费/慢)":
+        return _get_shared_local_proxy()
+
+    from langchain_openai import OpenAIEmbeddings
+    return OpenAIEmbeddings(
+        model="text-embedding-3-small", # 显式指定模型，防止兼容性问题
+        api_key=api_key,
+        base_url=base_url if "openai" not in base_url else None
+    )
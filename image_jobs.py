@@ -0,0 +1,163 @@
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import image_providers
+import image_store
+
+# 同时运行的绘图任务数 (进程级上限)
+IMAGE_JOB_WORKERS = int(os.getenv("IMAGE_JOB_WORKERS", "4"))
+# 每个用户保留的历史任务数
+MAX_JOBS_PER_USER = 20
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+_pool = ThreadPoolExecutor(max_workers=IMAGE_JOB_WORKERS, thread_name_prefix="image-job")
+_jobs = {}
+_lock = threading.Lock()
+_ids = itertools.count(1)
+
+
+class ImageJob:
+    """后台绘图任务的状态快照 (由工作线程更新，Streamlit 主线程只读)"""
+
+    def __init__(self, job_id, user_id, provider, prompt, caption):
+        self.id = job_id
+        self.user_id = user_id
+        self.provider = provider
+        self.prompt = prompt
+        self.caption = caption
+        self.state = QUEUED
+        self.images = []  # [{'url': 原图路径, 'thumb': 缩略图路径, 'provider': ...}, ...]
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.provider_status = {}
+        self.cancel_event = threading.Event()
+
+    @property
+    def active(self):
+        return self.state in ACTIVE_STATES
+
+    def _update(self, **fields):
+        with _lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.updated_at = time.time()
+
+
+def _run_fanout_job(job, generators, mode, style, use_cache):
+    if job.cancel_event.is_set():
+        job._update(state=FAILED, error="Cancelled")
+        return
+    try:
+        job._update(state=RUNNING)
+
+        def on_update(provider, text):
+            with _lock:
+                job.provider_status[provider] = text
+                job.updated_at = time.time()
+
+        # 1. 同一 (提示词, 风格, 服务) 生成过的图片直接从本地库返回，不再发起生成请求
+        cached = {}
+        if use_cache:
+            for provider in image_providers.stats.rank(list(generators)):
+                records = image_store.lookup(job.prompt, style, provider)
+                if records:
+                    cached[provider] = records
+                    on_update(provider, "⚡ 来自本地图片库")
+                    if mode == image_providers.MODE_FIRST:
+                        break
+
+        remaining = {} if (cached and mode == image_providers.MODE_FIRST) else {
+            provider: generator for provider, generator in generators.items() if provider not in cached
+        }
+        for provider in generators:
+            if provider not in cached and provider not in remaining:
+                on_update(provider, "已跳过 (本地图片库已有结果)")
+
+        # 2. 其余服务并发生成
+        results = image_providers.fan_out(
+            job.prompt, remaining, mode=mode, on_update=on_update, cancel_event=job.cancel_event
+        ) if remaining else {}
+
+        # 3. 并行下载新生成的图片到本地库 (生成缩略图)，之后从本地磁盘展示
+        urls = [(provider, url) for provider, result in results.items() for url in result['images']]
+        downloaded = image_store.download_all([url for _, url in urls])
+        fresh = {}
+        for (provider, _), rec in zip(urls, downloaded):
+            fresh.setdefault(provider, []).append(rec)
+        for provider, records in fresh.items():
+            image_store.record(job.prompt, style, provider, records)
+
+        images = [
+            {'url': rec['path'], 'thumb': rec['thumb'], 'provider': provider}
+            for source in (cached, fresh)
+            for provider, records in source.items()
+            for rec in records
+        ]
+        if images:
+            job._update(state=DONE, images=images)
+        else:
+            errors = "; ".join(f"{provider}: {result['error']}" for provider, result in results.items())
+            job._update(state=FAILED, error=errors or "No images")
+    except Exception as e:
+        print(f"ERROR generating image (job {job.id}): {e}")
+        job._update(state=FAILED, error=str(e))
+
+
+def _trim(user_id):
+    """只保留每个用户最近的 MAX_JOBS_PER_USER 个已结束任务"""
+    finished = sorted(
+        (job for job in _jobs.values() if job.user_id == user_id and not job.active),
+        key=lambda job: job.created_at,
+    )
+    for job in finished[:-MAX_JOBS_PER_USER]:
+        _jobs.pop(job.id, None)
+
+
+def submit_job(user_id, prompt, generators, mode=image_providers.MODE_FIRST, caption="", style="", use_cache=True):
+    """
+    提交一个绘图任务到后台线程池，立即返回任务 ID。
+    :param generators: {服务名: fn(prompt, cancel_event) -> [url, ...]}，多个服务时并发请求
+    :param mode: image_providers.MODE_FIRST (先到先得) 或 MODE_ALL (展示全部结果)
+    :param use_cache: 是否优先使用本地图片库中相同 (提示词, 风格, 服务) 的结果
+    """
+    with _lock:
+        job = ImageJob(next(_ids), user_id, " + ".join(generators), prompt, caption)
+        job.provider_status = {provider: "排队中..." for provider in generators}
+        _jobs[job.id] = job
+        _trim(user_id)
+    _pool.submit(_run_fanout_job, job, generators, mode, style, use_cache)
+    return job.id
+
+
+def list_jobs(user_id):
+    """用户的任务列表 (最新的在前)"""
+    with _lock:
+        jobs = [job for job in _jobs.values() if job.user_id == user_id]
+    return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+
+def has_active_jobs(user_id):
+    return any(job.active for job in list_jobs(user_id))
+
+
+def cancel_job(job_id):
+    with _lock:
+        job = _jobs.get(job_id)
+    if job is not None and job.active:
+        job.cancel_event.set()
+
+
+def clear_finished(user_id):
+    with _lock:
+        for job_id in [job.id for job in _jobs.values() if job.user_id == user_id and not job.active]:
+            del _jobs[job_id]
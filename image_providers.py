@@ -0,0 +1,193 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import llm_clients
+
+DALLE = "OpenAI DALL-E 3"
+BING = "Bing Image Creator (免费)"
+FLUX = "SiliconFlow (Flux)"
+ALL_PROVIDERS = [DALLE, BING, FLUX]
+
+# 并发模式
+MODE_FIRST = "first"  # 第一个成功的结果胜出，取消其余请求
+MODE_ALL = "all"      # 等待所有服务，展示全部结果
+
+# 连续失败达到该次数的服务视为不健康，"先到先得" 模式下暂时跳过
+UNHEALTHY_AFTER_FAILURES = 3
+# 延迟统计的指数滑动平均系数
+LATENCY_ALPHA = 0.3
+# "先到先得" 模式下错峰启动：前一个服务在该时间内未完成 (或失败) 才启动下一个服务
+HEDGE_DELAY = 8
+# 会检查 cancel_event 的服务 (Bing 轮询)；DALL-E / Flux 是单次阻塞请求，发出后无法中止
+CANCELLABLE = {BING}
+
+
+def generate_dalle(prompt, api_key, cancel_event=None):
+    client = llm_clients.get_openai_client(api_key) # 使用官方 SDK
+    response = client.images.generate(
+        model="dall-e-3",
+        prompt=prompt,
+        size="1024x1024",
+        quality="standard",
+        n=1,
+    )
+    return [response.data[0].url]
+
+
+def generate_flux(prompt, api_key, cancel_event=None):
+    client = llm_clients.get_openai_client(api_key, base_url="https://api.siliconflow.cn/v1")
+    response = client.images.generate(
+        model="black-forest-labs/FLUX.1-schnell",
+        prompt=prompt,
+        size="1024x1024",
+        n=1,
+    )
+    return [response.data[0].url]
+
+
+def generate_bing(prompt, acquire_session, cancel_event=None, validate=None):
+    """
+    :param acquire_session: 返回产出 ImageGen 的上下文管理器 (会话池)
+    :param validate: 可选，返回 Cookie 是否有效；在工作线程中调用，冷验证不阻塞页面
+    """
+    if validate is not None and not validate():
+        raise Exception("Bing Cookie 验证未通过 (可能已失效)，请在侧边栏更新 Cookie")
+    with acquire_session() as image_gen:
+        polling_url = image_gen.submit(prompt)
+        text = image_gen.wait_for_results(polling_url, cancel_event=cancel_event)
+        return image_gen.parse_images(text)
+
+
+class ProviderStats:
+    """记录各绘图服务的延迟与健康状况 (进程级，所有用户共享)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, provider, latency, success):
+        with self._lock:
+            stat = self._stats.setdefault(provider, {'latency': None, 'successes': 0, 'failures': 0, 'consecutive_failures': 0})
+            if success:
+                stat['successes'] += 1
+                stat['consecutive_failures'] = 0
+                if stat['latency'] is None:
+                    stat['latency'] = latency
+                else:
+                    stat['latency'] = LATENCY_ALPHA * latency + (1 - LATENCY_ALPHA) * stat['latency']
+            else:
+                stat['failures'] += 1
+                stat['consecutive_failures'] += 1
+
+    def get(self, provider):
+        with self._lock:
+            return dict(self._stats.get(provider, {}))
+
+    def is_healthy(self, provider):
+        return self.get(provider).get('consecutive_failures', 0) < UNHEALTHY_AFTER_FAILURES
+
+    def rank(self, providers):
+        """健康的服务在前，其中平均延迟低的在前；没有数据的服务排在有数据的健康服务之后"""
+        def sort_key(provider):
+            stat = self.get(provider)
+            latency = stat.get('latency')
+            return (not self.is_healthy(provider), latency is None, latency or 0)
+        return sorted(providers, key=sort_key)
+
+
+stats = ProviderStats()
+
+
+def fan_out(prompt, generators, mode=MODE_FIRST, on_update=None, cancel_event=None):
+    """
+    把同一个提示词发送给多个绘图服务。
+    MODE_ALL 同时请求全部服务；MODE_FIRST 按健康度/延迟排序后错峰启动：
+    前一个服务超过 HEDGE_DELAY 秒未完成或已失败时才启动下一个，
+    有结果后尚未启动的服务 (通常是较慢或付费的服务) 不再请求。
+    已发出的 DALL-E / Flux 请求无法中止，其结果会被忽略。
+    :param generators: {服务名: fn(prompt, cancel_event) -> [url, ...]}
+    :param mode: MODE_FIRST 第一个成功即返回；MODE_ALL 等待全部完成
+    :param on_update: 回调 (服务名, 状态文字)，用于展示每个服务的进度
+    :return: {服务名: {'images': [...], 'error': str|None, 'latency': 秒}}
+    """
+    providers = stats.rank(list(generators))
+    if mode == MODE_FIRST:
+        # 跳过连续失败的服务 (除非所有服务都不健康)
+        healthy = [p for p in providers if stats.is_healthy(p)]
+        providers = healthy or providers
+
+    cancel_event = cancel_event or threading.Event()
+    results = {}
+
+    def run(provider):
+        if cancel_event.is_set():
+            raise Exception("Cancelled")
+        if on_update:
+            on_update(provider, "生成中...")
+        return generators[provider](prompt, cancel_event)
+
+    pool = ThreadPoolExecutor(max_workers=len(providers), thread_name_prefix="image-fanout")
+    waiting = list(providers)  # 尚未启动的服务
+    futures = {}               # future -> (服务名, 启动时间)
+    pending = set()
+
+    def launch():
+        provider = waiting.pop(0)
+        future = pool.submit(run, provider)
+        futures[future] = (provider, time.time())
+        pending.add(future)
+
+    if mode == MODE_FIRST:
+        launch()
+        for provider in waiting:
+            if on_update:
+                on_update(provider, "排队中 (前一个服务未完成时启动)")
+    else:
+        while waiting:
+            launch()
+
+    try:
+        while pending or waiting:
+            timeout = HEDGE_DELAY if waiting else None
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                provider, started = futures[future]
+                latency = time.time() - started
+                try:
+                    images = future.result()
+                    results[provider] = {'images': images, 'error': None, 'latency': latency}
+                    stats.record(provider, latency, True)
+                    if on_update:
+                        on_update(provider, f"✅ 完成 ({latency:.1f}s)")
+                except Exception as e:
+                    results[provider] = {'images': [], 'error': str(e), 'latency': latency}
+                    # 被主动取消的请求不计入失败
+                    if not cancel_event.is_set():
+                        stats.record(provider, latency, False)
+                    if on_update:
+                        on_update(provider, f"❌ {e}")
+
+            if mode == MODE_FIRST and any(r['images'] for r in results.values()):
+                # 先到先得：Bing 轮询会在下一次等待时退出；已发出的 HTTP 请求只能忽略其结果
+                cancel_event.set()
+                for future in pending:
+                    provider = futures[future][0]
+                    if on_update:
+                        if provider in CANCELLABLE:
+                            on_update(provider, "已取消 (其他服务已先完成)")
+                        else:
+                            on_update(provider, "已忽略 (其他服务已先完成，请求无法中止)")
+                for provider in waiting:
+                    if on_update:
+                        on_update(provider, "未启动 (其他服务已先完成)")
+                break
+
+            # 超时未完成或已失败：启动下一个服务
+            if waiting and not cancel_event.is_set():
+                launch()
+            elif cancel_event.is_set():
+                waiting.clear()
+    finally:
+        pool.shutdown(wait=False)
+    return results
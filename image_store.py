@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# 本地图片库根目录 (按内容寻址，所有用户共享)
+STORE_DIR = os.getenv("IMAGE_STORE_DIR", "./.image_store")
+# 缩略图最长边
+THUMBNAIL_SIZE = 384
+# 并行下载数
+DOWNLOAD_WORKERS = 4
+
+_download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="image-download")
+
+
+def _key_hash(*parts):
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _atomic_write(path, data, mode="wb"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _object_path(digest, ext):
+    return os.path.join(STORE_DIR, "objects", digest[:2], f"{digest}{ext}")
+
+
+def _thumb_path(digest):
+    return os.path.join(STORE_DIR, "thumbs", digest[:2], f"{digest}.jpg")
+
+
+def _guess_ext(content_type, url):
+    content_type = (content_type or "").lower()
+    if "png" in content_type:
+        return ".png"
+    if "webp" in content_type:
+        return ".webp"
+    if "jpeg" in content_type or "jpg" in content_type:
+        return ".jpg"
+    path = url.split("?")[0].lower()
+    for ext in (".png", ".webp", ".jpg", ".jpeg"):
+        if path.endswith(ext):
+            return ext
+    return ".jpg"
+
+
+def _make_thumbnail(source_path, digest):
+    thumb_path = _thumb_path(digest)
+    if os.path.exists(thumb_path):
+        return thumb_path
+    try:
+        from PIL import Image
+        with Image.open(source_path) as img:
+            img = img.convert("RGB")
+            img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+            tmp_path = f"{thumb_path}.{uuid.uuid4().hex}.tmp"
+            img.save(tmp_path, format="JPEG", quality=85)
+            os.replace(tmp_path, thumb_path)
+        return thumb_path
+    except Exception as e:
+        print(f"DEBUG: Thumbnail failed for {digest[:12]}: {e}")
+        return source_path
+
+
+def download(url):
+    """
+    下载一张图片到本地内容寻址存储 (相同内容只存一份)，同时生成缩略图。
+    :return: {'hash', 'path', 'thumb', 'source_url'}
+    """
+    import requests
+    response = requests.get(url, timeout=60)
+    response.raise_for_status()
+    data = response.content
+    digest = hashlib.sha256(data).hexdigest()
+    path = _object_path(digest, _guess_ext(response.headers.get("content-type"), url))
+    if not os.path.exists(path):
+        _atomic_write(path, data)
+    return {'hash': digest, 'path': path, 'thumb': _make_thumbnail(path, digest), 'source_url': url}
+
+
+def download_all(urls):
+    """
+    并行下载多张图片。下载失败的图片保留原始 URL (path/thumb 均为 URL)。
+    :return: 与 urls 顺序一致的记录列表
+    """
+    futures = [_download_pool.submit(download, url) for url in urls]
+    records = []
+    for url, future in zip(urls, futures):
+        try:
+            records.append(future.result())
+        except Exception as e:
+            print(f"DEBUG: Image download failed ({url}): {e}")
+            records.append({'hash': None, 'path': url, 'thumb': url, 'source_url': url})
+    return records
+
+
+# --- 索引：(绘画提示词, 风格, 服务) -> 已生成的图片 ---
+def _index_path(image_prompt, style, provider):
+    return os.path.join(STORE_DIR, "index", f"{_key_hash(image_prompt, style, provider)}.json")
+
+
+def lookup(image_prompt, style, provider):
+    """
+    查找同一 (提示词, 风格, 服务) 之前生成过的图片。
+    :return: 记录列表；没有记录或本地文件已被清理时返回 None
+    """
+    path = _index_path(image_prompt, style, provider)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            records = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not records or not all(os.path.exists(record['path']) for record in records):
+        return None
+    return records
+
+
+def record(image_prompt, style, provider, records):
+    """登记生成结果 (只登记已成功下载到本地的图片)"""
+    local_records = [r for r in records if r.get('hash')]
+    if local_records:
+        _atomic_write(_index_path(image_prompt, style, provider), json.dumps(local_records, ensure_ascii=False), mode="w")
+
+
+# --- 绘画提示词缓存：(文档, 风格, 模型) -> 提示词 ---
+def _prompt_path(doc_id, style, model_name):
+    return os.path.join(STORE_DIR, "prompts", f"{_key_hash(doc_id, style, model_name)}.txt")
+
+
+def lookup_prompt(doc_id, style, model_name):
+    path = _prompt_path(doc_id, style, model_name)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read() or None
+
+
+def record_prompt(doc_id, style, model_name, image_prompt):
+    _atomic_write(_prompt_path(doc_id, style, model_name), image_prompt, mode="w")
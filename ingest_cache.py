@@ -0,0 +1,135 @@
+import functools
+import hashlib
+import json
+import os
+import re
+import uuid
+
+# 磁盘缓存根目录 (所有用户共享，按内容寻址)
+# 注意：pages/ 是文档解析后全文的唯一存放位置 (Session 中只保存 doc_hash)，
+# 清理该目录后，已上传文档的配图等功能会取不到原文，需要重新上传
+CACHE_DIR = os.getenv("INGEST_CACHE_DIR", "./.ingest_cache")
+
+
+def file_hash(data):
+    """计算上传文件内容的 SHA-256 (作为文档的唯一标识)"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def _slug(text):
+    """把模型标识等转成安全的目录名"""
+    return re.sub(r"[^a-zA-Z0-9_.\-]", "_", text)
+
+
+class _JsonlWriter:
+    """
+    流式写入 JSONL：逐条追加到临时文件，正常结束时原子改名，
+    出错或中途放弃时删除临时文件，避免留下半截缓存。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        self._file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.tmp_path, "w", encoding="utf-8")
+        return self
+
+    def write(self, doc):
+        self._file.write(json.dumps({"page_content": doc.page_content, "metadata": doc.metadata}, ensure_ascii=False))
+        self._file.write("\n")
+
+    def __exit__(self, exc_type, exc, tb):
+        self._file.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+        return False
+
+
+def _iter_jsonl(path):
+    """逐行读取 JSONL (生成器)，内存占用与文件大小无关"""
+    from langchain_core.documents import Document
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                yield Document(page_content=item["page_content"], metadata=item["metadata"])
+
+
+# --- 阶段 1：解析后的页面文本 (按文件哈希) ---
+def _pages_path(doc_hash):
+    return os.path.join(CACHE_DIR, "pages", f"{doc_hash}.jsonl")
+
+
+def iter_pages(doc_hash):
+    """返回缓存页面的迭代器；未缓存时返回 None"""
+    path = _pages_path(doc_hash)
+    return _iter_jsonl(path) if os.path.exists(path) else None
+
+
+def read_text(doc_hash, max_chars=2000):
+    """
+    按需读取文档开头的 max_chars 个字符 (逐页读取，够数即停)。
+    Session 中只保存 doc_hash，需要文本的功能 (如生成配图提示词) 再从磁盘读取。
+    :return: 文本；未缓存时返回 None (不缓存 None，文件稍后写入后即可读到)
+    """
+    path = _pages_path(doc_hash)
+    if not os.path.exists(path):
+        return None
+    return _read_text(path, max_chars)
+
+
+@functools.lru_cache(maxsize=256)
+def _read_text(path, max_chars):
+    # 缓存文件按内容寻址、写入后不变，读取结果可以在所有 Session 间共享
+    parts, size = [], 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            text = json.loads(line)["page_content"]
+            parts.append(text[:max_chars - size])
+            size += len(parts[-1])
+            if size >= max_chars:
+                break
+    return "".join(parts)
+
+
+def pages_writer(doc_hash):
+    return _JsonlWriter(_pages_path(doc_hash))
+
+
+# --- 阶段 2：切分后的文本块 (按文件哈希 + 切分参数 + 切分方式版本) ---
+# 切分方式变化时加 1，旧缓存不再命中而重新切分 (2: 文本块带 start_index，用于合并相邻文本块)
+CHUNKS_VERSION = 2
+
+
+def _chunks_path(doc_hash, chunk_size, chunk_overlap):
+    return os.path.join(CACHE_DIR, "chunks", f"{doc_hash}_{chunk_size}_{chunk_overlap}_v{CHUNKS_VERSION}.jsonl")
+
+
+def iter_chunks(doc_hash, chunk_size, chunk_overlap):
+    """返回缓存文本块的迭代器；未缓存时返回 None"""
+    path = _chunks_path(doc_hash, chunk_size, chunk_overlap)
+    return _iter_jsonl(path) if os.path.exists(path) else None
+
+
+def chunks_writer(doc_hash, chunk_size, chunk_overlap):
+    return _JsonlWriter(_chunks_path(doc_hash, chunk_size, chunk_overlap))
+
+
+# --- 阶段 3：文本块向量 (按 Embedding 模型 + 文本块哈希) ---
+def cached_embeddings(embeddings, model_key):
+    """
+    用磁盘缓存包装 Embeddings：每个文本块按内容哈希存储向量，
+    文档稍作修改后只会重新计算发生变化的块。
+    """
+    from langchain.embeddings import CacheBackedEmbeddings
+    from langchain.storage import LocalFileStore
+
+    store = LocalFileStore(os.path.join(CACHE_DIR, "embeddings", _slug(model_key)))
+    return CacheBackedEmbeddings.from_bytes_store(embeddings, store, namespace="")
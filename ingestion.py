@@ -0,0 +1,277 @@
+import io
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import ingest_cache
+import knowledge_base
+
+# 默认切分参数
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+# 并发参数
+LOAD_WORKERS = int(os.getenv("INGEST_LOAD_WORKERS", "4"))    # 同时解析的文件数
+EMBED_WORKERS = int(os.getenv("INGEST_EMBED_WORKERS", "4"))  # 同时在途的 Embedding 请求数 (进程级上限)
+EMBED_BATCH_SIZE = 64                                        # 每个 Embedding 请求包含的文本块数
+MAX_IN_FLIGHT = EMBED_WORKERS * 2                            # 每个文件最多同时持有的待写入批次 (决定峰值内存)
+
+# 进程级共享的 Embedding 线程池，限制所有 Session 对 Embedding 服务的并发请求
+_embed_pool = ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="embed")
+
+
+def iter_pages(data, filename, on_page=None):
+    """
+    直接从内存中的上传内容逐页解析 (生成器，不落临时文件)。
+    :param on_page: 回调 (已解析页数, 总页数)
+    """
+    from langchain_core.documents import Document
+
+    if filename.endswith(".pdf"):
+        from pypdf import PdfReader
+        reader = PdfReader(io.BytesIO(data))
+        total = len(reader.pages)
+        for i, page in enumerate(reader.pages):
+            yield Document(page_content=page.extract_text() or "", metadata={"source": filename, "page": i})
+            if on_page:
+                on_page(i + 1, total)
+        return
+
+    if filename.endswith(".docx"):
+        import docx2txt
+        text = docx2txt.process(io.BytesIO(data))
+    else:
+        text = data.decode("utf-8", errors="ignore")
+    yield Document(page_content=text, metadata={"source": filename})
+    if on_page:
+        on_page(1, 1)
+
+
+def _get_splitter(chunk_size, chunk_overlap):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    # start_index 记录文本块在页内的位置，拼接上下文时据此合并重叠的相邻文本块
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
+
+
+def iter_document_chunks(data, filename, doc_hash, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, on_page=None):
+    """
+    逐页解析并切分文档 (生成器)，同时把每个阶段的结果流式写入磁盘缓存。
+    同一文件再次上传时直接从缓存逐行读取文本块。
+    """
+    cached_chunks = ingest_cache.iter_chunks(doc_hash, chunk_size, chunk_overlap)
+    if cached_chunks is not None:
+        print(f"DEBUG: Ingest cache hit (chunks): {doc_hash[:12]}")
+        for chunk in cached_chunks:
+            # 缓存可能来自其他用户上传的同一文件，来源以本次文件名为准
+            chunk.metadata["source"] = filename
+            yield chunk
+        return
+
+    splitter = _get_splitter(chunk_size, chunk_overlap)
+    cached_pages = ingest_cache.iter_pages(doc_hash)
+    with ingest_cache.chunks_writer(doc_hash, chunk_size, chunk_overlap) as chunk_cache:
+        if cached_pages is not None:
+            print(f"DEBUG: Ingest cache hit (pages): {doc_hash[:12]}")
+            for page in cached_pages:
+                page.metadata["source"] = filename
+                for chunk in splitter.split_documents([page]):
+                    chunk_cache.write(chunk)
+                    yield chunk
+            return
+
+        with ingest_cache.pages_writer(doc_hash) as page_cache:
+            for page in iter_pages(data, filename, on_page):
+                page_cache.write(page)
+                for chunk in splitter.split_documents([page]):
+                    chunk_cache.write(chunk)
+                    yield chunk
+
+
+def iter_batches(items, batch_size):
+    """把迭代器按固定大小分批 (生成器)"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class BatchIngest:
+    """
+    多文件并发处理：每个文件在独立线程中按 页 → 文本块 → 向量批次 → 写入向量库 流式处理，
+    同一时刻每个文件只持有 MAX_IN_FLIGHT 个批次，峰值内存与文档大小无关。
+    进度写入线程安全的字典，由 Streamlit 主线程轮询并刷新界面。
+    """
+
+    def __init__(self, files, store, user_id, embed_key, skip_doc_ids=(), shared=True):
+        """
+        :param files: [(filename, bytes), ...]
+        :param store: 用户知识库 (knowledge_base.open_store 的结果，其 Embedding 函数用于计算向量)
+        :param skip_doc_ids: 知识库中已存在的文档哈希，这些文件直接跳过
+        :param shared: True 时写入跨用户共享库 (相同文件只向量化一次)；False 时写入用户私有库
+        """
+        self.files = files
+        self.store = store
+        self.user_id = user_id
+        self.embed_key = embed_key
+        self.skip_doc_ids = set(skip_doc_ids)
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._progress = {i: (0.0, "等待中...") for i in range(len(files))}
+        self._pool = ThreadPoolExecutor(max_workers=max(1, min(LOAD_WORKERS, len(files))), thread_name_prefix="ingest")
+        self._futures = {}
+        seen = set()
+        for i, (filename, data) in enumerate(files):
+            doc_hash = ingest_cache.file_hash(data)
+            if doc_hash in seen:
+                # 同一批次中内容相同的文件只处理一次：两个线程写入同一个文档时，一方失败的清理会删掉另一方的文本块
+                self._progress[i] = (1.0, "与本批次中的其他文件相同，跳过")
+                future = Future()
+                future.set_result({'doc_id': doc_hash, 'filename': filename, 'chunk_count': 0, 'skipped': True})
+            else:
+                seen.add(doc_hash)
+                future = self._pool.submit(self._process, i, filename, data, doc_hash)
+            self._futures[future] = i
+
+    def _report(self, index, fraction, text):
+        with self._lock:
+            self._progress[index] = (fraction, text)
+
+    def progress(self):
+        """各文件当前进度快照: {index: (0~1, 状态文字)}"""
+        with self._lock:
+            return dict(self._progress)
+
+    def _process(self, index, filename, data, doc_hash):
+        if doc_hash in self.skip_doc_ids:
+            self._report(index, 1.0, "已在知识库中，跳过")
+            return {'doc_id': doc_hash, 'filename': filename, 'chunk_count': 0, 'skipped': True}
+        if self.shared:
+            return self._process_shared(index, filename, data, doc_hash)
+
+        written = self._write_chunks(index, knowledge_base.private_store(self.store), filename, data, doc_hash)
+        knowledge_base.register_document(self.user_id, self.embed_key, doc_hash, filename, written)
+        self._report(index, 1.0, f"✅ 完成 ({written} 个片段)")
+        return {'doc_id': doc_hash, 'filename': filename, 'chunk_count': written, 'skipped': False}
+
+    def _process_shared(self, index, filename, data, doc_hash):
+        """
+        相同内容的文档在共享库中只建一份：已建好则直接挂载，其他用户正在建立则等待，
+        否则由本线程认领并建立 (建立期间其他上传者等待，不会重复计算向量)。
+        三种情况显示相同的进度文字，不向用户透露其他人是否上传过相同文件。
+        """
+        deadline = time.time() + knowledge_base.SEGMENT_WAIT_TIMEOUT
+        while True:
+            status, build_id = knowledge_base.claim_segment(self.embed_key, doc_hash)
+            if status == 'ready':
+                chunk_count = knowledge_base.attach_segment(self.user_id, self.embed_key, doc_hash, filename)
+                if chunk_count is not None:
+                    self._report(index, 1.0, f"✅ 完成 ({chunk_count} 个片段)")
+                    return {'doc_id': doc_hash, 'filename': filename, 'chunk_count': chunk_count, 'skipped': False}
+                # 刚好被回收，重新认领
+                continue
+            if status == 'claimed':
+                break
+            if time.time() > deadline:
+                raise TimeoutError("文档处理超时，请稍后重试")
+            self._report(index, 0.0, "正在解析...")
+            time.sleep(1)
+
+        # 共享库中不保存文件名 (来源按各用户自己登记的文件名显示)；失败时放弃认领并删除已写入的文本块
+        written = self._write_chunks(
+            index, knowledge_base.shared_store(self.embed_key), filename, data, doc_hash, keep_source=False,
+            cleanup=lambda count: knowledge_base.abandon_segment(self.embed_key, doc_hash, build_id, count),
+        )
+        try:
+            knowledge_base.finish_segment(self.user_id, self.embed_key, doc_hash, build_id, filename, written)
+        except Exception:
+            # 认领已被接手时 abandon 不做任何删除
+            knowledge_base.abandon_segment(self.embed_key, doc_hash, build_id, written)
+            raise
+        self._report(index, 1.0, f"✅ 完成 ({written} 个片段)")
+        return {'doc_id': doc_hash, 'filename': filename, 'chunk_count': written, 'skipped': False}
+
+    def _write_chunks(self, index, target, filename, data, doc_hash, keep_source=True, cleanup=None):
+        """
+        解析 → 切分 → 分批向量化 → 写入 target。
+        :param keep_source: False 时文本块元数据中不保存文件名
+        :param cleanup: 失败时的清理函数 fn(可能已写入的文本块数量)，默认从 target 中删除这些文本块
+        :return: 写入的文本块数量
+        """
+        self._report(index, 0.0, "正在解析...")
+        pages_done = [0, 0]
+
+        def on_page(done, total):
+            pages_done[0], pages_done[1] = done, total
+
+        embeddings = self.store.embeddings
+        chunks = iter_document_chunks(data, filename, doc_hash, on_page=on_page)
+        in_flight = deque()
+        written = 0
+        attempted = 0  # 已开始写入的文本块数量 (含写入中途失败的批次)，失败时按它清理
+
+        def drain_one():
+            nonlocal written, attempted
+            start, batch, future = in_flight.popleft()
+            vectors = future.result()
+            attempted = start + len(batch)
+            knowledge_base.add_chunks(target, doc_hash, start, batch, vectors)
+            written += len(batch)
+            if pages_done[1]:
+                self._report(index, 0.95 * pages_done[0] / pages_done[1], f"第 {pages_done[0]}/{pages_done[1]} 页，已写入 {written} 个片段")
+            else:
+                self._report(index, 0.5, f"已写入 {written} 个片段")
+
+        try:
+            start = 0
+            for batch in iter_batches(chunks, EMBED_BATCH_SIZE):
+                if not keep_source:
+                    for chunk in batch:
+                        chunk.metadata.pop("source", None)
+                future = _embed_pool.submit(embeddings.embed_documents, [chunk.page_content for chunk in batch])
+                in_flight.append((start, batch, future))
+                start += len(batch)
+                if len(in_flight) >= MAX_IN_FLIGHT:
+                    drain_one()
+            while in_flight:
+                drain_one()
+        except Exception:
+            chunks.close()
+            for _, _, future in in_flight:
+                future.cancel()
+            # 清理已写入的部分文本块 (包括写到一半的批次)，保证知识库中不残留半个文档
+            if cleanup is None:
+                knowledge_base.delete_chunks(target, doc_hash, attempted)
+            else:
+                cleanup(attempted)
+            raise
+        return written
+
+    def iter_results(self, on_tick=None, poll_interval=0.2):
+        """
+        在调用线程 (Streamlit 主线程) 中按完成顺序产出每个文件的结果。
+        :param on_tick: 每次轮询时回调，参数为 progress() 快照，用于刷新界面
+        :yield: (index, result, error)
+        """
+        pending = set(self._futures)
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                if on_tick:
+                    on_tick(self.progress())
+                for future in done:
+                    index = self._futures[future]
+                    try:
+                        yield index, future.result(), None
+                    except Exception as e:
+                        self._report(index, 1.0, f"失败: {e}")
+                        yield index, None, e
+            if on_tick:
+                on_tick(self.progress())
+        finally:
+            self._pool.shutdown(wait=False)
@@ -0,0 +1,127 @@
+import math
+import re
+import threading
+import unicodedata
+
+# BM25 参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 英文/数字词：课程代码 (CS-101)、教室 (A302)、日期 (2024-05-01) 等
+_ASCII_RE = re.compile(r"[a-z0-9]+(?:[\-_./:][a-z0-9]+)*")
+_ASCII_PART_RE = re.compile(r"[a-z]+|[0-9]+")
+# 中日韩统一表意文字 (含扩展 A)
+_CJK_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff]+")
+
+
+def _ascii_terms(compound):
+    """'cs-101' -> ['cs', '101', 'cs101']：拆开的部分和去掉分隔符的整体都作为词项"""
+    parts = _ASCII_PART_RE.findall(compound)
+    if len(parts) > 1:
+        return parts + ["".join(parts)]
+    return parts
+
+
+def tokenize(text):
+    """
+    不依赖外部分词服务的切词：
+    - 英文/数字按词切分 (统一小写，全角字符先转半角)；
+    - 中文按相邻两字 (bigram) 切分，单字成词时保留单字。
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    terms = []
+    for compound in _ASCII_RE.findall(text):
+        terms.extend(_ascii_terms(compound))
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def identifier_terms(text):
+    """查询中带数字的词 (课程代码、教室号、日期)，用于判断关键词检索是否足够可信"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    terms = set()
+    for compound in _ASCII_RE.findall(text):
+        joined = "".join(_ASCII_PART_RE.findall(compound))
+        if any(ch.isdigit() for ch in joined):
+            terms.add(joined)
+    return terms
+
+
+class KeywordIndex:
+    """
+    文本块的内存倒排索引 (BM25 打分)。
+    只保存词项统计，不保存原文；原文按 chunk id 从向量库读取。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}  # term -> {chunk_id: 词频}
+        self._lengths = {}   # chunk_id -> 词项数
+        self._chunk_terms = {}  # chunk_id -> 该文本块包含的词项 (用于删除)
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, chunk_id, text):
+        terms = tokenize(text)
+        counts = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        with self._lock:
+            if chunk_id in self._lengths:
+                self._remove(chunk_id)
+            for term, count in counts.items():
+                self._postings.setdefault(term, {})[chunk_id] = count
+            self._lengths[chunk_id] = len(terms)
+            self._chunk_terms[chunk_id] = tuple(counts)
+            self._total_length += len(terms)
+
+    def _remove(self, chunk_id):
+        length = self._lengths.pop(chunk_id, None)
+        if length is None:
+            return
+        self._total_length -= length
+        for term in self._chunk_terms.pop(chunk_id, ()):
+            bucket = self._postings.get(term)
+            if bucket is not None:
+                bucket.pop(chunk_id, None)
+                if not bucket:
+                    del self._postings[term]
+
+    def remove(self, chunk_ids):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                self._remove(chunk_id)
+
+    def contains_all(self, chunk_id, terms):
+        with self._lock:
+            return all(chunk_id in self._postings.get(term, {}) for term in terms)
+
+    def search(self, query, k=10, doc_ids=None):
+        """
+        :param doc_ids: 只返回这些文档的文本块 (chunk id 为 "{doc_id}:{序号}")；None 表示不过滤
+        :return: [(chunk_id, score), ...]，按 BM25 分数从高到低
+        """
+        query_terms = set(tokenize(query))
+        scores = {}
+        with self._lock:
+            n = len(self._lengths)
+            if not n or not query_terms:
+                return []
+            avg_length = self._total_length / n or 1
+            for term in query_terms:
+                bucket = self._postings.get(term)
+                if not bucket:
+                    continue
+                idf = math.log(1 + (n - len(bucket) + 0.5) / (len(bucket) + 0.5))
+                for chunk_id, tf in bucket.items():
+                    if doc_ids is not None and chunk_id.rsplit(":", 1)[0] not in doc_ids:
+                        continue
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[chunk_id] / avg_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: -item[1])[:k]
@@ -0,0 +1,487 @@
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+
+import db_manager
+import keyword_index
+
+# 向量库后端："chroma" (默认) 或 "numpy" (进程内精确检索，见 numpy_store.py)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+
+# Chroma 单次写入的批大小 (chromadb 对单批数量有上限)
+ADD_BATCH_SIZE = 500
+
+# 混合检索参数
+HYBRID_CANDIDATES = 10  # 关键词 / 向量各自取的候选数
+RRF_K = 60              # Reciprocal Rank Fusion 常数
+# 关键词快速通道：查询中的课程代码/教室号/日期全部出现在第一名文本块中，
+# 且第一名分数领先第二名 KEYWORD_MARGIN 倍时，直接使用关键词结果，不计算问题向量
+KEYWORD_MARGIN = 1.5
+
+# 跨用户共享文档：内容相同 (doc_id 为文件哈希) 的文档只向量化一次。
+# 同一 Embedding 模型的所有共享文档写入同一个共享库，检索时按用户挂载的 doc_id 过滤，
+# 每次提问固定只检索 私有库 + 共享库 两个库，成本不随文档数量增长
+SHARED_DB_DIR = os.getenv("SHARED_DB_DIR", "./shared_db")
+SEGMENT_WAIT_TIMEOUT = 600   # 等待其他用户建立同一个文档的最长秒数
+SEGMENT_STALE_AFTER = 1800   # 建立 (或删除) 中的文档超过该秒数未完成，视为对方进程已退出
+
+# 进程内最多保留的倒排索引数量 (LRU 淘汰，被淘汰的库下次检索时重新构建)
+MAX_KEYWORD_INDEXES = int(os.getenv("MAX_KEYWORD_INDEXES", "64"))
+# 进程内最多保留的 numpy 私有库数量 (LRU 淘汰，被淘汰的库下次使用时重新从磁盘加载)
+MAX_PRIVATE_STORES = int(os.getenv("MAX_PRIVATE_STORES", "64"))
+
+# 进程级倒排索引：(向量库目录, collection) -> KeywordIndex，所有 Session 共享
+_keyword_indexes = OrderedDict()
+_index_lock = threading.Lock()
+
+# 每个向量库一把写锁：同一个库的写入与倒排索引构建串行化，不同用户/段之间互不阻塞
+_store_locks = {}
+
+# 进程内已打开的共享库：目录 -> 向量库 (每个 Embedding 模型一个)，所有 Session 共享
+_shared_stores = {}
+_segment_lock = threading.Lock()
+
+# 进程内已打开的 numpy 私有库：目录 -> 向量库。同一用户的多个标签页共用一个对象，
+# 行号分配不会互相覆盖 (跨进程由 NumpyVectorStore 的文件锁保证)
+_private_stores = OrderedDict()
+
+
+class KnowledgeBase:
+    """
+    用户知识库：私有向量库 + 共享库中本用户挂载的文档 (只读)。
+    检索函数在私有库和共享库 (按 shared_docs 过滤) 中分别检索后合并；
+    私有文档只写入 private，不会出现在其他用户的检索结果中。
+    """
+
+    def __init__(self, private, embeddings, embed_key):
+        self.private = private
+        self.embeddings = embeddings  # 本 Session 的 Embedding 函数 (私有库对象可能被多个 Session 共用)
+        self.embed_key = embed_key
+        self.shared = None        # 共享库 (挂载了共享文档时才打开)
+        self.shared_docs = set()  # 本用户挂载的共享文档 doc_id
+        self.filenames = {}       # doc_id -> 本用户上传时的文件名 (共享库中不保存来源)
+
+    def targets(self):
+        """:return: [(向量库, 只检索的 doc_id 集合或 None), ...]"""
+        targets = [(self.private, None)]
+        if self.shared_docs:
+            targets.append((self.shared, self.shared_docs))
+        return targets
+
+    def store_for(self, chunk_id):
+        return self.shared if chunk_id.rsplit(":", 1)[0] in self.shared_docs else self.private
+
+
+def private_store(store):
+    return store.private if isinstance(store, KnowledgeBase) else store
+
+
+def _targets(store):
+    return store.targets() if isinstance(store, KnowledgeBase) else [(store, None)]
+
+
+def _store_for(store, chunk_id):
+    return store.store_for(chunk_id) if isinstance(store, KnowledgeBase) else store
+
+
+def _user_db_dir(user_id):
+    if VECTOR_BACKEND == "numpy":
+        return f"./numpy_db_{user_id}"
+    return f"./chroma_db_{user_id}"
+
+
+def _registry_key(embed_key):
+    # 不同后端的文档登记互不影响，切换后端后需要重新上传
+    return embed_key if VECTOR_BACKEND == "chroma" else f"{embed_key}@{VECTOR_BACKEND}"
+
+
+def _collection_name(embed_key):
+    # 不同 Embedding 模型的向量维度不同，各自使用独立的 collection
+    return "kb_" + re.sub(r"[^a-zA-Z0-9_\-]", "_", embed_key)[:60]
+
+
+def _chunk_ids(doc_id, start, count):
+    return [f"{doc_id}:{i}" for i in range(start, start + count)]
+
+
+def _chunk_id(doc):
+    return f"{doc.metadata.get('doc_id')}:{doc.metadata.get('chunk')}"
+
+
+def _index_key(store):
+    if hasattr(store, "index_key"):
+        return store.index_key
+    return (store._persist_directory, store._collection.name)
+
+
+def _store_lock(store):
+    key = _index_key(store)
+    with _index_lock:
+        lock = _store_locks.get(key)
+        if lock is None:
+            lock = _store_locks[key] = threading.Lock()
+        return lock
+
+
+def _cached_index(key):
+    with _index_lock:
+        index = _keyword_indexes.get(key)
+        if index is not None:
+            _keyword_indexes.move_to_end(key)
+        return index
+
+
+def _cache_index(key, index):
+    with _index_lock:
+        _keyword_indexes[key] = index
+        while len(_keyword_indexes) > MAX_KEYWORD_INDEXES:
+            old_key, _ = _keyword_indexes.popitem(last=False)
+            print(f"DEBUG: Evicted keyword index for {old_key[1]}")
+
+
+def _release_store(store):
+    """库被关闭/删除时丢弃其倒排索引和写锁"""
+    key = _index_key(store)
+    with _index_lock:
+        _keyword_indexes.pop(key, None)
+        # 仍有写入持有的锁保留，避免同一个库同时出现两把锁
+        lock = _store_locks.get(key)
+        if lock is not None and not lock.locked():
+            del _store_locks[key]
+
+
+def _upsert(store, ids, vectors, splits):
+    if hasattr(store, "upsert_vectors"):
+        store.upsert_vectors(ids, vectors, [split.page_content for split in splits], [split.metadata for split in splits])
+    else:
+        store._collection.upsert(
+            ids=ids,
+            embeddings=vectors,
+            documents=[split.page_content for split in splits],
+            metadatas=[split.metadata for split in splits],
+        )
+
+
+def _open_private_store(user_id, embeddings, embed_key):
+    if VECTOR_BACKEND == "numpy":
+        from numpy_store import NumpyVectorStore
+        directory = os.path.join(_user_db_dir(user_id), _collection_name(embed_key))
+        evicted = []
+        with _segment_lock:
+            store = _private_stores.get(directory)
+            if store is None:
+                # 写入时总是传入预先算好的向量，库本身不需要 Embedding 函数
+                store = _private_stores[directory] = NumpyVectorStore(directory, None)
+                while len(_private_stores) > MAX_PRIVATE_STORES:
+                    old_directory, old_store = _private_stores.popitem(last=False)
+                    evicted.append(old_store)
+                    print(f"DEBUG: Evicted private store {old_directory}")
+            else:
+                _private_stores.move_to_end(directory)
+        # 被淘汰的库仍可被打开它的 Session 继续使用 (同目录多个实例由文件锁同步)，
+        # 这里只丢弃进程级缓存，memmap 随对象不再被引用而释放
+        for old_store in evicted:
+            _release_store(old_store)
+        return store
+
+    from langchain_community.vectorstores import Chroma
+    return Chroma(
+        collection_name=_collection_name(embed_key),
+        embedding_function=embeddings,
+        persist_directory=_user_db_dir(user_id),
+    )
+
+
+def open_store(user_id, embeddings, embed_key):
+    """打开 (或创建) 用户的持久化知识库，并挂载其引用的共享索引段"""
+    kb = KnowledgeBase(_open_private_store(user_id, embeddings, embed_key), embeddings, embed_key)
+    sync_segments(kb, list_documents(user_id, embed_key))
+    return kb
+
+
+def sync_segments(kb, documents):
+    """按知识库登记表 (list_documents 的结果) 同步挂载的共享文档"""
+    shared = [doc for doc in documents if doc['shared']]
+    kb.shared_docs = {doc['doc_id'] for doc in shared}
+    kb.filenames = {doc['doc_id']: doc['filename'] for doc in shared}
+    if kb.shared_docs and kb.shared is None:
+        kb.shared = shared_store(kb.embed_key)
+
+
+def _label_sources(store, docs):
+    """共享段的文本块按当前用户登记的文件名显示来源，不暴露其他上传者的文件名"""
+    if isinstance(store, KnowledgeBase):
+        for doc in docs:
+            filename = store.filenames.get(doc.metadata.get('doc_id'))
+            if filename is not None:
+                doc.metadata['source'] = filename
+    return docs
+
+
+def label_sources(docs, documents):
+    """
+    返回按当前用户登记的文件名标注来源的文本块副本 (不修改传入的文本块，用于跨用户共享的缓存结果)。
+    :param documents: list_documents 的结果
+    """
+    filenames = {doc['doc_id']: doc['filename'] for doc in documents}
+    return [
+        type(doc)(page_content=doc.page_content, metadata={
+            **doc.metadata, 'source': filenames.get(doc.metadata.get('doc_id'), "未知来源"),
+        })
+        for doc in docs
+    ]
+
+
+def list_documents(user_id, embed_key):
+    return db_manager.list_user_documents(user_id, _registry_key(embed_key))
+
+
+def add_chunks(store, doc_id, start, splits, vectors=None):
+    """
+    写入一个文档的一批文本块 (流式处理时逐批调用)。
+    :param start: 这批文本块在文档中的起始序号
+    :param vectors: 预先计算好的向量 (与 splits 一一对应)，为空时由向量库自行计算
+    """
+    for i, split in enumerate(splits):
+        split.metadata["doc_id"] = doc_id
+        split.metadata["chunk"] = start + i
+
+    with _store_lock(store):
+        for offset in range(0, len(splits), ADD_BATCH_SIZE):
+            batch = splits[offset:offset + ADD_BATCH_SIZE]
+            ids = _chunk_ids(doc_id, start + offset, len(batch))
+            if vectors is None:
+                store.add_documents(batch, ids=ids)
+            else:
+                # 向量已在并行批处理中算好，直接写入底层 collection，避免重复计算
+                _upsert(store, ids, vectors[offset:offset + ADD_BATCH_SIZE], batch)
+
+        # 同步更新倒排索引 (尚未建立时，首次检索会从向量库完整构建)
+        index = _cached_index(_index_key(store))
+        if index is not None:
+            for chunk_id, split in zip(_chunk_ids(doc_id, start, len(splits)), splits):
+                index.add(chunk_id, split.page_content)
+
+
+def delete_chunks(store, doc_id, chunk_count):
+    """删除一个文档的前 chunk_count 个文本块"""
+    if chunk_count:
+        with _store_lock(store):
+            ids = _chunk_ids(doc_id, 0, chunk_count)
+            store.delete(ids=ids)
+            index = _cached_index(_index_key(store))
+            if index is not None:
+                index.remove(ids)
+
+
+def register_document(user_id, embed_key, doc_id, filename, chunk_count):
+    """文档全部写入后再登记，未登记的文档不会出现在知识库列表中"""
+    db_manager.add_user_document(user_id, _registry_key(embed_key), doc_id, filename, chunk_count)
+    print(f"DEBUG: Added {chunk_count} chunks of {filename} to knowledge base of user {user_id}")
+
+
+def remove_document(store, user_id, embed_key, doc_id):
+    """
+    从用户知识库中删除一个文档：私有文档删除其全部文本块；
+    共享文档只解除挂载 (引用计数 -1)，没有其他用户引用时从共享库中删除。
+    """
+    for doc in list_documents(user_id, embed_key):
+        if doc['doc_id'] == doc_id:
+            if doc['shared']:
+                db_manager.remove_user_document(user_id, _registry_key(embed_key), doc_id)
+                if isinstance(store, KnowledgeBase):
+                    store.shared_docs.discard(doc_id)
+                collect_segments()
+            else:
+                delete_chunks(private_store(store), doc_id, doc['chunk_count'])
+                db_manager.remove_user_document(user_id, _registry_key(embed_key), doc_id)
+            return True
+    return False
+
+
+# --- 共享文档 ---
+def _shared_dir(registry_key):
+    return os.path.join(SHARED_DB_DIR, "pool", _collection_name(registry_key))
+
+
+def _open_shared(registry_key):
+    """
+    打开一个 Embedding 模型的共享库 (进程内只打开一次)。
+    库内向量在写入前已算好，检索时按问题向量查询，因此不绑定任何用户的 Embedding 函数 (及其 API Key)。
+    """
+    path = _shared_dir(registry_key)
+    with _segment_lock:
+        store = _shared_stores.get(path)
+        if store is None:
+            if VECTOR_BACKEND == "numpy":
+                from numpy_store import NumpyVectorStore
+                store = NumpyVectorStore(path, None)
+            else:
+                from langchain_community.vectorstores import Chroma
+                store = Chroma(collection_name="shared", embedding_function=None, persist_directory=path)
+            _shared_stores[path] = store
+        return store
+
+
+def shared_store(embed_key):
+    return _open_shared(_registry_key(embed_key))
+
+
+def claim_segment(embed_key, doc_id):
+    """
+    :return: (status, build_id)；status 为 'ready' (可挂载)、'building' (正在建立或删除，稍后重试)
+             或 'claimed' (由调用方写入 shared_store，完成后调用 finish_segment，失败时调用 abandon_segment)
+    """
+    return db_manager.claim_shared_segment(_registry_key(embed_key), doc_id, uuid.uuid4().hex, SEGMENT_STALE_AFTER)
+
+
+def finish_segment(user_id, embed_key, doc_id, build_id, filename, chunk_count):
+    """文档写入完成 (之后只读)，同时挂载到建立者的知识库；认领已失效时抛出 RuntimeError"""
+    if not db_manager.finish_shared_segment(user_id, _registry_key(embed_key), doc_id, build_id, filename, chunk_count):
+        raise RuntimeError("文档处理被中断，请重新上传该文件")
+    print(f"DEBUG: Built shared document {doc_id[:12]} ({chunk_count} chunks) for user {user_id}")
+
+
+def _remove_segment(registry_key, doc_id, build_id, chunk_count):
+    # 先删除文本块再删除记录：删除期间记录为 removing，相同文档不会被重新认领写入
+    delete_chunks(_open_shared(registry_key), doc_id, chunk_count)
+    db_manager.delete_shared_segment(registry_key, doc_id, build_id)
+
+
+def abandon_segment(embed_key, doc_id, build_id, chunk_count):
+    """
+    建立失败时放弃认领并删除已写入的文本块。
+    :param chunk_count: 可能已写入的文本块数量 (上限)
+    认领已被其他建立者接手时不删除任何文本块 (相同 chunk id 已属于新的建立者)。
+    """
+    registry_key = _registry_key(embed_key)
+    if db_manager.abandon_shared_segment(registry_key, doc_id, build_id):
+        _remove_segment(registry_key, doc_id, build_id, chunk_count)
+
+
+def attach_segment(user_id, embed_key, doc_id, filename):
+    """把已建好的共享文档登记到用户知识库；文档不存在 (刚被回收) 时返回 None"""
+    chunk_count = db_manager.attach_shared_document(user_id, _registry_key(embed_key), doc_id, filename)
+    if chunk_count is not None:
+        print(f"DEBUG: Attached shared document {doc_id[:12]} ({chunk_count} chunks) to user {user_id}")
+    return chunk_count
+
+
+def collect_segments():
+    """回收引用计数为 0 的共享文档 (先标记为删除中，删除文本块后再删除记录)"""
+    for registry_key, doc_id, build_id, chunk_count in db_manager.collect_shared_segments():
+        _remove_segment(registry_key, doc_id, build_id, chunk_count)
+        print(f"DEBUG: Collected shared document {doc_id[:12]}")
+
+
+# --- 混合检索 (BM25 关键词 + 向量) ---
+def get_keyword_index(store, page_size=1000):
+    """
+    获取向量库对应的倒排索引。进程内首次使用时从向量库分页读取全部文本块构建，
+    之后随 add_chunks / delete_chunks 增量更新。
+    """
+    key = _index_key(store)
+    index = _cached_index(key)
+    if index is not None:
+        return index
+
+    # 构建期间暂停该库的写入，保证索引与向量库一致
+    with _store_lock(store):
+        index = _cached_index(key)
+        if index is None:
+            index = keyword_index.KeywordIndex()
+            offset = 0
+            while True:
+                page = store.get(include=["documents"], limit=page_size, offset=offset)
+                for chunk_id, text in zip(page['ids'], page['documents']):
+                    index.add(chunk_id, text or "")
+                if len(page['ids']) < page_size:
+                    break
+                offset += page_size
+            print(f"DEBUG: Built keyword index for {key[1]} ({len(index)} chunks)")
+            _cache_index(key, index)
+    return index
+
+
+def get_chunks(store, chunk_ids):
+    """按 chunk id 从向量库读取文本块 (不需要计算向量)，保持传入顺序"""
+    from langchain_core.documents import Document
+    if not chunk_ids:
+        return []
+    groups = {}
+    for chunk_id in chunk_ids:
+        sub = _store_for(store, chunk_id)
+        groups.setdefault(id(sub), (sub, []))[1].append(chunk_id)
+    found = {}
+    for sub, ids in groups.values():
+        result = sub.get(ids=ids, include=["documents", "metadatas"])
+        for chunk_id, text, metadata in zip(result['ids'], result['documents'], result['metadatas']):
+            found[chunk_id] = Document(page_content=text or "", metadata=metadata or {})
+    return _label_sources(store, [found[chunk_id] for chunk_id in chunk_ids if chunk_id in found])
+
+
+def keyword_search(store, query, k=HYBRID_CANDIDATES):
+    """
+    :return: [(chunk_id, BM25 分数), ...]
+    私有库与共享库各有一个倒排索引 (在所有 Session 间共享)，共享库只返回本用户挂载的文档，按分数合并；
+    两个索引的 IDF 统计不同，分数只是近似可比，最终排名还会与向量结果融合。
+    """
+    hits = []
+    for sub, doc_ids in _targets(store):
+        hits.extend(get_keyword_index(sub).search(query, k, doc_ids=doc_ids))
+    return sorted(hits, key=lambda hit: -hit[1])[:k]
+
+
+def keyword_confident(store, query, hits):
+    """关键词结果是否足够可信，可以跳过问题向量计算"""
+    identifiers = keyword_index.identifier_terms(query)
+    if not identifiers or not hits:
+        return False
+    if not get_keyword_index(_store_for(store, hits[0][0])).contains_all(hits[0][0], identifiers):
+        return False
+    return len(hits) == 1 or hits[0][1] >= KEYWORD_MARGIN * hits[1][1]
+
+
+def _scored_by_vector(store, query_vector, k, doc_ids=None):
+    """:return: [(Document, 分数)]，分数越大越相似；doc_ids 不为 None 时只检索这些文档"""
+    where = None if doc_ids is None else {"doc_id": {"$in": sorted(doc_ids)}}
+    if hasattr(store, "similarity_search_with_score_by_vector"):
+        return store.similarity_search_with_score_by_vector(query_vector, k=k, filter=where)
+    # Chroma 返回距离 (越小越相似)
+    return [
+        (doc, -distance)
+        for doc, distance in store.similarity_search_by_vector_with_relevance_scores(query_vector, k=k, filter=where)
+    ]
+
+
+def vector_search(store, query_vector, k):
+    """在私有库与共享库 (只含本用户挂载的文档) 中按向量检索并合并 (同一 Embedding 模型下分数可以直接比较)"""
+    if not isinstance(store, KnowledgeBase) or not store.shared_docs:
+        return private_store(store).similarity_search_by_vector(query_vector, k=k)
+    scored = []
+    for sub, doc_ids in store.targets():
+        scored.extend(_scored_by_vector(sub, query_vector, k, doc_ids))
+    return [doc for doc, _ in sorted(scored, key=lambda item: -item[1])[:k]]
+
+
+def hybrid_search(store, query_vector, keyword_hits, k=4):
+    """
+    用 Reciprocal Rank Fusion 融合关键词与向量检索的排名。
+    :param keyword_hits: keyword_search() 的结果
+    """
+    vector_docs = vector_search(store, query_vector, HYBRID_CANDIDATES)
+    docs_by_id = {_chunk_id(doc): doc for doc in vector_docs}
+
+    scores = {}
+    for ranking in ([_chunk_id(doc) for doc in vector_docs], [chunk_id for chunk_id, _ in keyword_hits]):
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    top_ids = [chunk_id for chunk_id, _ in sorted(scores.items(), key=lambda item: -item[1])[:k]]
+
+    # 只由关键词命中的文本块需要从向量库读取原文
+    missing = [chunk_id for chunk_id in top_ids if chunk_id not in docs_by_id]
+    for doc in get_chunks(store, missing):
+        docs_by_id[_chunk_id(doc)] = doc
+    return _label_sources(store, [docs_by_id[chunk_id] for chunk_id in top_ids if chunk_id in docs_by_id])
@@ -0,0 +1,132 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+# 进程级客户端缓存上限 (LRU 兜底，防止无限增长)
+MAX_CACHED_CLIENTS = 64
+
+RAG_SYSTEM_PROMPT = (
+    "你是一个乐于助人的校园助手。请根据下面的上下文（Context）回答用户的问题。"
+    "如果上下文中没有答案，请诚实地说你不知道。\n\nContext: {context}"
+)
+
+# key -> 客户端 / 编译好的链；复用同一实例即复用其 HTTP 连接池 (keep-alive)
+_cache = OrderedDict()
+# key -> 正在使用该 key 的 Session 数量
+_refcounts = {}
+_lock = threading.Lock()
+
+
+def sanitize_base_url(url):
+    """修正 base_url：去除空格/反引号/引号，若为空则设为 None，避免 httpx 报错"""
+    if not url:
+        return None
+    cleaned = url.strip().strip("`").strip("\"").strip("'")
+    if not cleaned:
+        return None
+    # Ensure path includes /v1 for OpenAI-compatible providers
+    try:
+        parsed = urlparse(cleaned)
+        if parsed.path == "" or parsed.path == "/":
+            cleaned = cleaned.rstrip("/") + "/v1"
+    except Exception:
+        pass
+    return cleaned
+
+
+def hash_key(api_key):
+    """缓存键中不保存明文 Key，只保存其哈希"""
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+
+def client_key(kind, model, base_url, api_key, **options):
+    """缓存键: (类型, 模型, 规范化 base_url, api_key 哈希, 其他参数)"""
+    return (kind, model, sanitize_base_url(base_url), hash_key(api_key)) + tuple(sorted(options.items()))
+
+
+def _get_or_create(key, factory):
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    value = factory()
+
+    with _lock:
+        # 另一个线程可能已抢先创建，以先到者为准
+        value = _cache.setdefault(key, value)
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_CACHED_CLIENTS:
+            old_key, _ = _cache.popitem(last=False)
+            _refcounts.pop(old_key, None)
+        return value
+
+
+def track(slots, slot, key):
+    """
+    记录某个 Session 在某个用途 (slot) 上使用的缓存键。
+    键发生变化 (换了模型/Key/Base URL) 时，旧键不再被任何 Session 使用就立即淘汰。
+    :param slots: Session 级字典 (保存在 st.session_state 中)
+    """
+    old_key = slots.get(slot)
+    if old_key == key:
+        return
+    with _lock:
+        if old_key is not None:
+            _refcounts[old_key] = _refcounts.get(old_key, 1) - 1
+            if _refcounts[old_key] <= 0:
+                _refcounts.pop(old_key, None)
+                _cache.pop(old_key, None)
+                # 依赖该客户端的链也一并淘汰
+                _cache.pop(("rag_chain",) + old_key, None)
+        _refcounts[key] = _refcounts.get(key, 0) + 1
+    slots[slot] = key
+
+
+def get_chat_model(model, base_url, api_key, temperature=0, slots=None, slot=None):
+    """获取 (或创建) 缓存的 ChatOpenAI 实例"""
+    key = client_key("chat", model, base_url, api_key, temperature=temperature)
+    if slots is not None:
+        track(slots, slot or "chat", key)
+
+    def factory():
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(
+            model=model,
+            temperature=temperature,
+            api_key=api_key,
+            base_url=sanitize_base_url(base_url),
+            streaming=True,
+        )
+    return _get_or_create(key, factory)
+
+
+def get_rag_chain(model, base_url, api_key, slots=None):
+    """获取 (或创建) 编译好的 RAG 生成链: prompt | llm | parser"""
+    llm = get_chat_model(model, base_url, api_key, temperature=0, slots=slots, slot="rag")
+    key = ("rag_chain",) + client_key("chat", model, base_url, api_key, temperature=0)
+
+    def factory():
+        from langchain_core.prompts import ChatPromptTemplate
+        from langchain_core.output_parsers import StrOutputParser
+        prompt_template = ChatPromptTemplate.from_messages([
+            ("system", RAG_SYSTEM_PROMPT),
+            ("human", "{input}"),
+        ])
+        return prompt_template | llm | StrOutputParser()
+    return _get_or_create(key, factory)
+
+
+def get_openai_client(api_key, base_url=None, slots=None, slot=None):
+    """获取 (或创建) 缓存的官方 OpenAI SDK 客户端 (用于绘图接口)"""
+    key = client_key("openai", None, base_url, api_key)
+    if slots is not None:
+        track(slots, slot or "openai", key)
+
+    def factory():
+        from openai import OpenAI
+        if base_url:
+            return OpenAI(api_key=api_key, base_url=base_url)
+        return OpenAI(api_key=api_key)
+    return _get_or_create(key, factory)
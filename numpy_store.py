@@ -0,0 +1,484 @@
+import contextlib
+import json
+import os
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows：只有进程内的锁
+    fcntl = None
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+import quantization
+
+# 向量文件初始行数 (之后按倍数扩容)
+INITIAL_CAPACITY = 1024
+# 已删除行超过存活行数 (且不少于该值) 时自动压缩文件
+COMPACT_MIN_DEAD = 1000
+
+
+def _doc_id(chunk_id):
+    # chunk id 的格式为 "{doc_id}:{序号}"
+    return chunk_id.rsplit(":", 1)[0]
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    进程内精确检索的向量库：所有向量归一化后存放在一块连续的 float32 矩阵中
+    (内存映射文件 vectors.f32)，一次矩阵乘法完成 top-k 余弦相似度检索。
+    文本与元数据只追加写入 records.jsonl，内存中只保留每条记录的文件偏移。
+
+    quantization 为 float16 / int8 时，检索在压缩副本 (vectors.float16 / vectors.int8 + scales.f32)
+    上进行，原始 float32 向量只在重新打分时按行读取，不常驻内存。
+
+    接口与 LangChain Chroma 中 knowledge_base / main_app 用到的部分保持一致：
+    similarity_search_by_vector / add_documents / delete / get / as_retriever。
+    """
+
+    def __init__(self, directory, embedding_function, quantization_mode=None, rescore=None):
+        self.directory = directory
+        self._embedding_function = embedding_function
+        self.quantization = quantization_mode or quantization.VECTOR_QUANTIZATION
+        self.rescore = quantization.VECTOR_RESCORE if rescore is None else rescore
+        self._code_dtype = quantization.dtype_for(self.quantization)
+        self._lock = threading.RLock()
+        self._meta_path = os.path.join(directory, "meta.json")
+        self._lock_path = os.path.join(directory, "write.lock")
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    @property
+    def _is_float32(self):
+        return self.quantization == quantization.FLOAT32
+
+    # --- 持久化 ---
+    # 数据文件按 generation 命名 (0 为不带后缀的旧文件名)；compact() 写出下一代文件后
+    # 原子替换 meta.json 作为提交点，中途崩溃时旧文件保持完整。
+    def _paths(self, generation):
+        """:return: (原始向量, 检索向量, 缩放系数, 日志) 文件路径"""
+        suffix = f".{generation}" if generation else ""
+        full_path = os.path.join(self.directory, f"vectors.f32{suffix}")
+        codes_path = full_path if self._is_float32 else os.path.join(self.directory, f"vectors.{self.quantization}{suffix}")
+        return (
+            full_path,
+            codes_path,
+            os.path.join(self.directory, f"scales.f32{suffix}"),
+            os.path.join(self.directory, f"records.jsonl{suffix}"),
+        )
+
+    def _set_generation(self, generation):
+        self._generation = generation
+        self._full_path, self._codes_path, self._scales_path, self._records_path = self._paths(generation)
+
+    def _reset_state(self, generation=0):
+        self._set_generation(generation)
+        self._dim = None
+        self._capacity = 0
+        self._codes = None    # np.memmap (capacity, dim)，检索使用的向量 (float32 模式下即原始向量)
+        self._scales = None   # np.memmap (capacity,)，仅 int8 模式
+        self._size = 0        # 已使用的行数 (含已删除行)
+        self._alive = np.zeros(0, dtype=bool)
+        self._rows = {}       # id -> 行号
+        self._row_ids = []    # 行号 -> id
+        self._offsets = {}    # id -> records.jsonl 中的字节偏移
+        self._doc_rows = {}   # doc_id -> 存活行号集合 (按文档过滤检索时使用)
+        self._log_size = 0    # 已重放的日志字节数
+
+    @contextlib.contextmanager
+    def _write_guard(self):
+        """写操作：进程内加锁 + 跨进程文件锁，并先同步其他进程已写入的数据"""
+        with self._lock:
+            with open(self._lock_path, "a+b") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self._sync()
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_meta(self):
+        try:
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            print(f"DEBUG: Corrupt vector store meta in {self.directory}, treating as empty")
+            return None
+
+    def _write_meta(self, generation=None):
+        tmp_path = f"{self._meta_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                'dim': self._dim,
+                'quantization': self.quantization,
+                'generation': self._generation if generation is None else generation,
+            }, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _load(self):
+        meta = self._read_meta()
+        self._reset_state(meta.get('generation', 0) if meta else 0)
+        if meta is None or not meta.get('dim'):
+            return
+        self._dim = meta['dim']
+        if not os.path.exists(self._full_path):
+            # meta.json 存在但向量文件丢失：按空库处理，日志中的记录全部跳过
+            print(f"DEBUG: Vector file missing in {self.directory}, treating store as empty")
+        capacity = os.path.getsize(self._full_path) // (self._dim * 4) if os.path.exists(self._full_path) else 0
+        self._open_arrays(capacity)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._row_ids = [None] * capacity
+        if meta.get('quantization', quantization.FLOAT32) != self.quantization:
+            # 量化方式变更：从原始向量重建压缩副本
+            if not self._is_float32:
+                self._rebuild_codes()
+            self._write_meta()
+        self._replay()
+
+    def _replay(self):
+        """重放追加日志中尚未应用的部分：同一 id 以最后一条记录为准"""
+        if not os.path.exists(self._records_path):
+            return
+        skipped = 0
+        with open(self._records_path, "rb") as f:
+            f.seek(self._log_size)
+            offset = self._log_size
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # 其他进程正在写入的半行，下次再读
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if record is not None and (record.get('deleted') or record['row'] < self._capacity):
+                    self._apply(record, offset)
+                else:
+                    skipped += 1
+                offset += len(line)
+            self._log_size = offset
+        if skipped:
+            print(f"DEBUG: Skipped {skipped} unreadable records in {self._records_path}")
+
+    def _sync(self):
+        """读入其他进程 (或同一目录的其他实例) 写入的新数据；compact 过则整体重新加载"""
+        meta = self._read_meta()
+        if meta is None:
+            return
+        log_size = os.path.getsize(self._records_path) if os.path.exists(self._records_path) else 0
+        if meta.get('generation', 0) != self._generation or log_size < self._log_size or (self._dim is None and meta.get('dim')):
+            self._load()
+            return
+        if log_size == self._log_size:
+            return
+        capacity = os.path.getsize(self._full_path) // (self._dim * 4)
+        if capacity > self._capacity:
+            self._grow(capacity)
+        self._replay()
+
+    def _open_arrays(self, capacity):
+        """把各向量文件扩展到 capacity 行并重新映射"""
+        for array in (self._codes, self._scales):
+            if array is not None:
+                array.flush()
+        self._codes = self._scales = None
+
+        files = [(self._full_path, self._dim * 4)]
+        if not self._is_float32:
+            files.append((self._codes_path, self._dim * np.dtype(self._code_dtype).itemsize))
+        if self.quantization == quantization.INT8:
+            files.append((self._scales_path, 4))
+        for path, row_bytes in files:
+            with open(path, "ab") as f:
+                if f.tell() < capacity * row_bytes:
+                    f.truncate(capacity * row_bytes)
+
+        if capacity:
+            self._codes = np.memmap(self._codes_path, dtype=self._code_dtype, mode="r+", shape=(capacity, self._dim))
+            if self.quantization == quantization.INT8:
+                self._scales = np.memmap(self._scales_path, dtype=np.float32, mode="r+", shape=(capacity,))
+        self._capacity = capacity
+
+    def _rebuild_codes(self):
+        if not self._capacity:
+            return
+        full = np.memmap(self._full_path, dtype=np.float32, mode="r", shape=(self._capacity, self._dim))
+        for start in range(0, self._capacity, quantization.SCORE_BLOCK_ROWS):
+            end = start + quantization.SCORE_BLOCK_ROWS
+            codes, scales = quantization.quantize(full[start:end], self.quantization)
+            self._codes[start:end] = codes
+            if scales is not None:
+                self._scales[start:end] = scales
+        del full
+        self._codes.flush()
+        if self._scales is not None:
+            self._scales.flush()
+
+    def _apply(self, record, offset):
+        chunk_id = record['id']
+        doc_id = _doc_id(chunk_id)
+        old_row = self._rows.pop(chunk_id, None)
+        if old_row is not None:
+            self._alive[old_row] = False
+            rows = self._doc_rows.get(doc_id)
+            if rows is not None:
+                rows.discard(old_row)
+                if not rows:
+                    del self._doc_rows[doc_id]
+        self._offsets.pop(chunk_id, None)
+        if record.get('deleted'):
+            return
+        row = record['row']
+        self._rows[chunk_id] = row
+        self._doc_rows.setdefault(doc_id, set()).add(row)
+        self._row_ids[row] = chunk_id
+        self._alive[row] = True
+        self._offsets[chunk_id] = offset
+        self._size = max(self._size, row + 1)
+
+    def _grow(self, capacity):
+        self._open_arrays(capacity)
+        self._alive = np.concatenate([self._alive, np.zeros(capacity - len(self._alive), dtype=bool)])
+        self._row_ids.extend([None] * (capacity - len(self._row_ids)))
+
+    def _ensure_capacity(self, rows):
+        if rows <= self._capacity:
+            return
+        self._grow(max(rows, self._capacity * 2, INITIAL_CAPACITY))
+
+    def _write_vectors(self, start, vectors):
+        end = start + len(vectors)
+        if self._is_float32:
+            self._codes[start:end] = vectors
+        else:
+            # 原始向量直接写文件 (不经过内存映射，避免常驻内存)
+            with open(self._full_path, "r+b") as f:
+                f.seek(start * self._dim * 4)
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            codes, scales = quantization.quantize(vectors, self.quantization)
+            self._codes[start:end] = codes
+            if scales is not None:
+                self._scales[start:end] = scales
+                self._scales.flush()
+        self._codes.flush()
+
+    def _read_full(self, rows):
+        """按行读取原始 float32 向量"""
+        rows = np.asarray(rows)
+        if self._is_float32:
+            return np.asarray(self._codes[rows])
+        result = np.empty((len(rows), self._dim), dtype=np.float32)
+        row_bytes = self._dim * 4
+        with open(self._full_path, "rb") as f:
+            # 按行号顺序读取，减少磁盘寻道
+            for i in np.argsort(rows):
+                f.seek(int(rows[i]) * row_bytes)
+                result[i] = np.frombuffer(f.read(row_bytes), dtype=np.float32)
+        return result
+
+    def _append_records(self, records):
+        with open(self._records_path, "ab") as f:
+            offset = f.tell()
+            for record in records:
+                line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+                f.write(line)
+                self._apply(record, offset)
+                offset += len(line)
+        self._log_size = offset
+
+    def _read_records(self, ids):
+        if not ids:
+            return []
+        records = []
+        with open(self._records_path, "rb") as f:
+            for chunk_id in ids:
+                f.seek(self._offsets[chunk_id])
+                records.append(json.loads(f.readline()))
+        return records
+
+    # --- 写入 ---
+    @property
+    def embeddings(self):
+        return self._embedding_function
+
+    @property
+    def index_key(self):
+        """倒排索引等进程级缓存的键"""
+        return (self.directory, "numpy")
+
+    def upsert_vectors(self, ids, embeddings, documents, metadatas=None):
+        """写入预先计算好的向量 (对应 Chroma 的 collection.upsert)"""
+        if not ids:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        metadatas = metadatas or [{} for _ in ids]
+
+        with self._write_guard():
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+                self._write_meta()
+            start = self._size
+            self._ensure_capacity(start + len(ids))
+            # 先写向量再写日志：中途崩溃时日志中不会出现指向未写入向量的记录
+            self._write_vectors(start, vectors)
+            self._append_records([
+                {'id': chunk_id, 'row': start + i, 'text': text, 'metadata': metadata}
+                for i, (chunk_id, text, metadata) in enumerate(zip(ids, documents, metadatas))
+            ])
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        ids = list(ids) if ids else [uuid.uuid4().hex for _ in texts]
+        self.upsert_vectors(ids, self._embedding_function.embed_documents(texts), texts, metadatas)
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        with self._write_guard():
+            existing = [chunk_id for chunk_id in ids or [] if chunk_id in self._rows]
+            if existing:
+                self._append_records([{'id': chunk_id, 'deleted': True} for chunk_id in existing])
+            dead = self._size - len(self._rows)
+            if dead >= COMPACT_MIN_DEAD and dead > len(self._rows):
+                self._compact()
+        return True
+
+    def compact(self):
+        """重写向量文件与日志，只保留存活的记录"""
+        with self._write_guard():
+            self._compact()
+
+    def _compact(self):
+        # 新一代文件全部写完后再原子替换 meta.json，崩溃时仍使用旧文件
+        ids = [self._row_ids[row] for row in np.flatnonzero(self._alive[:self._size])]
+        records = self._read_records(ids)
+        if ids:
+            vectors = self._read_full([self._rows[chunk_id] for chunk_id in ids])
+        else:
+            vectors = np.zeros((0, self._dim or 0), dtype=np.float32)
+        old_paths = {self._full_path, self._codes_path, self._scales_path, self._records_path}
+        generation = self._generation + 1
+        full_path, codes_path, scales_path, records_path = self._paths(generation)
+
+        files = [(full_path, vectors)]
+        if not self._is_float32:
+            codes, scales = quantization.quantize(vectors, self.quantization)
+            files.append((codes_path, codes))
+            if scales is not None:
+                files.append((scales_path, scales))
+        for path, array in files:
+            with open(path, "wb") as f:
+                f.write(np.ascontiguousarray(array).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        with open(records_path, "wb") as f:
+            for row, (chunk_id, record) in enumerate(zip(ids, records)):
+                record = {'id': chunk_id, 'row': row, 'text': record['text'], 'metadata': record['metadata']}
+                f.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._codes = self._scales = None
+        self._write_meta(generation)
+        self._load()
+        for path in old_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    # --- 读取 ---
+    def get(self, ids=None, limit=None, offset=0, include=("documents", "metadatas"), **kwargs):
+        """与 Chroma.get 相同的返回结构：{'ids', 'documents', 'metadatas'}"""
+        with self._lock:
+            self._sync()
+            if ids is None:
+                ids = [self._row_ids[row] for row in np.flatnonzero(self._alive[:self._size])]
+                ids = ids[offset:offset + limit] if limit is not None else ids[offset:]
+            else:
+                ids = [chunk_id for chunk_id in ids if chunk_id in self._rows]
+            records = self._read_records(ids)
+        return {
+            'ids': ids,
+            'documents': [r['text'] for r in records] if "documents" in include else None,
+            'metadatas': [r['metadata'] for r in records] if "metadatas" in include else None,
+        }
+
+    def _top_k(self, embedding, k, doc_ids=None):
+        """:param doc_ids: 只在这些文档的文本块中检索 (None 表示全部)"""
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        with self._lock:
+            self._sync()
+            if not self._rows:
+                return []
+            rescore = self.rescore and not self._is_float32
+            if doc_ids is None:
+                n = self._size
+                rows, scores = quantization.search(
+                    self._codes[:n],
+                    None if self._scales is None else np.asarray(self._scales[:n]),
+                    query,
+                    k,
+                    mask=self._alive[:n],
+                    fetch_full=self._read_full if rescore else None,
+                )
+            else:
+                # 只取出指定文档的行参与计算，检索成本与库中其他文档的数量无关
+                subset = sorted(row for doc_id in doc_ids for row in self._doc_rows.get(doc_id, ()))
+                if not subset:
+                    return []
+                subset = np.asarray(subset)
+                found, scores = quantization.search(
+                    np.asarray(self._codes[subset]),
+                    None if self._scales is None else np.asarray(self._scales[subset]),
+                    query,
+                    k,
+                    fetch_full=(lambda found: self._read_full(subset[found])) if rescore else None,
+                )
+                rows = subset[found]
+            return [(self._row_ids[row], float(score)) for row, score in zip(rows, scores)]
+
+    def memory_bytes(self):
+        """检索时常驻内存的向量字节数 (压缩副本 + 缩放系数)"""
+        if not self._dim:
+            return 0
+        per_row = self._dim * np.dtype(self._code_dtype).itemsize
+        if self._scales is not None:
+            per_row += 4
+        return per_row * self._size
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        """
+        :param filter: 只支持按文档过滤 {"doc_id": {"$in": [...]}} (与 Chroma 的写法相同)
+        :return: [(Document, 余弦相似度), ...]
+        """
+        hits = self._top_k(embedding, k, None if filter is None else set(filter["doc_id"]["$in"]))
+        result = self.get(ids=[chunk_id for chunk_id, _ in hits])
+        docs = {
+            chunk_id: Document(page_content=text, metadata=metadata)
+            for chunk_id, text, metadata in zip(result['ids'], result['documents'], result['metadatas'])
+        }
+        return [(docs[chunk_id], score) for chunk_id, score in hits if chunk_id in docs]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, filter=filter)]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self._embedding_function.embed_query(query), k)
+
+    def _select_relevance_score_fn(self):
+        return lambda score: score
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, directory=None, quantization_mode=None, **kwargs):
+        store = cls(directory or f"./numpy_db_{uuid.uuid4().hex[:8]}", embedding, quantization_mode=quantization_mode)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
@@ -0,0 +1,251 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote
+
+# 待上传文件的本地暂存目录 (按 Bucket + 对象路径命名)，上传成功后删除；断点续传的检查点也保存在这里
+SPOOL_DIR = os.getenv("OSS_SPOOL_DIR", "./.oss_spool")
+# 同时进行的备份任务数 / 分片上传线程数 (进程级上限)
+BACKUP_WORKERS = int(os.getenv("OSS_BACKUP_WORKERS", "2"))
+PART_WORKERS = int(os.getenv("OSS_PART_WORKERS", "4"))
+# 超过该大小的文件使用分片上传
+MULTIPART_THRESHOLD = 10 * 1024 * 1024
+PART_SIZE = 5 * 1024 * 1024
+# 上传失败后的重试次数 (分片上传从检查点继续)
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 2
+
+_backup_pool = ThreadPoolExecutor(max_workers=BACKUP_WORKERS, thread_name_prefix="oss-backup")
+_part_pool = ThreadPoolExecutor(max_workers=PART_WORKERS, thread_name_prefix="oss-part")
+
+_buckets = {}           # (endpoint, access_key_id, access_key_secret, bucket_name) -> OssBucket
+_in_flight = {}         # (bucket_id, key) -> Future，同一对象同时只上传一次
+_known_objects = set()  # 已确认存在的 (bucket_id, key)，不再重复查询
+_lock = threading.Lock()
+
+
+class OssBucket:
+    """
+    oss2.Bucket 的精简封装，只暴露备份用到的操作 (测试时可替换为本地假 Bucket)。
+    """
+
+    def __init__(self, bucket):
+        self._bucket = bucket
+        self.id = f"{bucket.endpoint}/{bucket.bucket_name}"
+
+    def exists(self, key):
+        return self._bucket.object_exists(key)
+
+    def put(self, key, data, headers=None):
+        self._bucket.put_object(key, data, headers=headers)
+
+    def init_multipart(self, key, headers=None):
+        return self._bucket.init_multipart_upload(key, headers=headers).upload_id
+
+    def upload_part(self, key, upload_id, part_number, data):
+        return self._bucket.upload_part(key, upload_id, part_number, data).etag
+
+    def list_parts(self, key, upload_id):
+        """:return: {part_number: etag}；分片上传已失效时返回 None"""
+        import oss2
+        try:
+            return {part.part_number: part.etag for part in oss2.PartIterator(self._bucket, key, upload_id)}
+        except oss2.exceptions.NoSuchUpload:
+            return None
+
+    def complete_multipart(self, key, upload_id, parts):
+        from oss2.models import PartInfo
+        self._bucket.complete_multipart_upload(
+            key, upload_id, [PartInfo(number, etag) for number, etag in sorted(parts.items())]
+        )
+
+
+def get_bucket(config):
+    """
+    按凭证缓存 Bucket 客户端 (共享 HTTP 连接池)；配置不完整时返回 None。
+    """
+    endpoint = config.get('oss_endpoint')
+    access_key_id = config.get('oss_access_key_id')
+    access_key_secret = config.get('oss_access_key_secret')
+    bucket_name = config.get('oss_bucket_name')
+    if not all([endpoint, access_key_id, access_key_secret, bucket_name]):
+        return None
+
+    # oss2.Bucket 需要带协议的 endpoint
+    if not endpoint.startswith('http'):
+        endpoint = 'http://' + endpoint
+    cache_key = (endpoint, access_key_id, access_key_secret, bucket_name)
+    with _lock:
+        bucket = _buckets.get(cache_key)
+        if bucket is None:
+            import oss2  # 引入 OSS SDK (仅在备份时加载)
+            bucket = OssBucket(oss2.Bucket(oss2.Auth(access_key_id, access_key_secret), endpoint, bucket_name))
+            _buckets[cache_key] = bucket
+        return bucket
+
+
+def object_key(digest, filename):
+    """云端路径按内容哈希命名，相同文件只存一份 (例如 uploads/ab/ab12...pdf)"""
+    return f"uploads/{digest[:2]}/{digest}{os.path.splitext(filename)[1].lower()}"
+
+
+def _job_path(bucket, key, suffix):
+    name = hashlib.sha256(f"{bucket.id}|{key}".encode("utf-8")).hexdigest()
+    return os.path.join(SPOOL_DIR, f"{name}{suffix}")
+
+
+def _spool(data, path):
+    """把上传内容写入本地暂存文件 (已存在则复用)，之后按分片从磁盘读取"""
+    if not os.path.exists(path):
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+def _read_part(path, offset, size):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def _checkpoint_path(bucket, key):
+    return _job_path(bucket, key, ".checkpoint.json")
+
+
+def _load_checkpoint(bucket, key, size, part_size):
+    try:
+        with open(_checkpoint_path(bucket, key), "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get('size') != size or checkpoint.get('part_size') != part_size:
+        return None
+    return checkpoint
+
+
+def _save_checkpoint(bucket, key, checkpoint):
+    path = _checkpoint_path(bucket, key)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def _multipart_upload(bucket, key, path, headers, part_size=PART_SIZE):
+    """
+    断点续传的分片上传：upload_id 记录在本地检查点中，重试或进程重启后
+    以服务端已收到的分片为准，只上传缺失的分片；各分片并行上传。
+    """
+    size = os.path.getsize(path)
+    checkpoint = _load_checkpoint(bucket, key, size, part_size)
+    uploaded = None
+    if checkpoint is not None:
+        uploaded = bucket.list_parts(key, checkpoint['upload_id'])
+    if uploaded is None:
+        checkpoint = {'upload_id': bucket.init_multipart(key, headers), 'size': size, 'part_size': part_size}
+        _save_checkpoint(bucket, key, checkpoint)
+        uploaded = {}
+    else:
+        print(f"DEBUG: Resuming OSS upload {key} ({len(uploaded)} parts done)")
+
+    upload_id = checkpoint['upload_id']
+    part_count = max((size + part_size - 1) // part_size, 1)
+    futures = {
+        number: _part_pool.submit(
+            lambda number=number: bucket.upload_part(key, upload_id, number, _read_part(path, (number - 1) * part_size, part_size))
+        )
+        for number in range(1, part_count + 1) if number not in uploaded
+    }
+    parts = dict(uploaded)
+    error = None
+    # 等全部分片结束再报错，重试时不会重复上传仍在进行中的分片
+    for number, future in futures.items():
+        try:
+            parts[number] = future.result()
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
+    bucket.complete_multipart(key, upload_id, parts)
+    os.remove(_checkpoint_path(bucket, key))
+
+
+def _upload(bucket, key, path, filename, payload, multipart_threshold=MULTIPART_THRESHOLD, part_size=PART_SIZE):
+    """:param payload: [文件内容]，确认需要上传后才写入暂存文件并释放；为空时暂存文件已存在"""
+    if bucket.exists(key):
+        return False
+    if payload:
+        _spool(payload.pop(), path)
+    # 自定义元数据只能是 ASCII，原文件名做 URL 编码
+    headers = {'x-oss-meta-filename': quote(filename)}
+    if os.path.getsize(path) >= multipart_threshold:
+        _multipart_upload(bucket, key, path, headers, part_size)
+    else:
+        with open(path, "rb") as f:
+            bucket.put(key, f.read(), headers)
+    return True
+
+
+def _run_backup(bucket, key, payload, filename, multipart_threshold, part_size):
+    """后台任务：OSS 中没有该对象时才写入暂存文件并上传，失败时按 MAX_ATTEMPTS 重试 (分片上传从检查点继续)"""
+    try:
+        path = _job_path(bucket, key, ".data")
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                uploaded = _upload(bucket, key, path, filename, payload, multipart_threshold, part_size)
+                break
+            except Exception as e:
+                print(f"DEBUG: OSS backup of {key} failed (attempt {attempt}/{MAX_ATTEMPTS}): {e}")
+                if attempt == MAX_ATTEMPTS:
+                    # 保留暂存文件和检查点，下次上传同一文件时继续
+                    return False, str(e)
+                time.sleep(RETRY_DELAY * attempt)
+        with _lock:
+            _known_objects.add((bucket.id, key))
+        if os.path.exists(path):
+            os.remove(path)
+        if uploaded:
+            return True, f"已备份至 OSS: {key}"
+        return True, f"OSS 中已有相同文件，跳过上传: {key}"
+    except Exception as e:
+        return False, str(e)
+    finally:
+        with _lock:
+            _in_flight.pop((bucket.id, key), None)
+
+
+def submit_backup(data, filename, config, digest=None, bucket=None,
+                  multipart_threshold=MULTIPART_THRESHOLD, part_size=PART_SIZE):
+    """
+    提交后台备份任务，立即返回，不阻塞文档处理。
+    云端路径按内容哈希命名：OSS 中已有相同文件时跳过上传，同一文件同时只上传一次。
+    :param data: 文件内容 (bytes)，确认需要上传后由后台线程写入本地暂存文件，分片上传时从磁盘按段读取；
+                 没有空闲线程 (任务需要排队) 时立即写入暂存文件，排队期间不在内存中保留文件内容
+    :param digest: 内容的 SHA-256 (已计算过时传入，避免重复计算)
+    :param bucket: 指定 Bucket (测试用)，为空时按 config 获取
+    :return: Future -> (bool, str)；OSS 未配置时返回 None
+    """
+    bucket = bucket or get_bucket(config)
+    if bucket is None:
+        return None
+    key = object_key(digest or hashlib.sha256(data).hexdigest(), filename)
+
+    with _lock:
+        if (bucket.id, key) in _known_objects:
+            future = Future()
+            future.set_result((True, f"OSS 中已有相同文件，跳过上传: {key}"))
+            return future
+        future = _in_flight.get((bucket.id, key))
+        if future is None:
+            payload = [data]
+            if len(_in_flight) >= BACKUP_WORKERS:
+                _spool(payload.pop(), _job_path(bucket, key, ".data"))
+            future = _backup_pool.submit(_run_backup, bucket, key, payload, filename, multipart_threshold, part_size)
+            _in_flight[(bucket.id, key)] = future
+        return future
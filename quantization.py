@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+
+# 向量存储精度："float32" (原始)、"float16" (半精度) 或 "int8" (每个向量一个缩放系数)
+FLOAT32 = "float32"
+FLOAT16 = "float16"
+INT8 = "int8"
+MODES = (FLOAT32, FLOAT16, INT8)
+
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", FLOAT32)
+# 量化检索后是否用原始 float32 向量对候选重新打分
+VECTOR_RESCORE = os.getenv("VECTOR_RESCORE", "1") != "0"
+# 重新打分的候选数 = k * RESCORE_FACTOR
+RESCORE_FACTOR = 4
+# 分块反量化的行数：块足够小时临时 float32 数据留在 CPU 缓存中，比一次性转换快
+SCORE_BLOCK_ROWS = 1024
+
+
+def dtype_for(mode):
+    if mode not in MODES:
+        raise ValueError(f"Unknown vector quantization: {mode}")
+    return {FLOAT32: np.float32, FLOAT16: np.float16, INT8: np.int8}[mode]
+
+
+def quantize(vectors, mode):
+    """
+    :param vectors: (n, dim) float32，已归一化
+    :return: (codes, scales)；scales 仅 int8 模式有值 (每行一个 float32)
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if mode == INT8:
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    return vectors.astype(dtype_for(mode)), None
+
+
+def dequantize(codes, scales=None):
+    block = np.asarray(codes, dtype=np.float32)
+    if scales is not None:
+        block *= np.asarray(scales, dtype=np.float32)[:, None]
+    return block
+
+
+def scores(codes, scales, query):
+    """在压缩表示上计算内积，按块反量化为 float32 后做矩阵乘法"""
+    query = np.asarray(query, dtype=np.float32)
+    if codes.dtype == np.float32:
+        return np.asarray(codes) @ query
+    result = np.empty(codes.shape[0], dtype=np.float32)
+    for start in range(0, codes.shape[0], SCORE_BLOCK_ROWS):
+        end = start + SCORE_BLOCK_ROWS
+        block_scores = np.asarray(codes[start:end], dtype=np.float32) @ query
+        if scales is not None:
+            block_scores *= scales[start:end]
+        result[start:end] = block_scores
+    return result
+
+
+def search(codes, scales, query, k, mask=None, fetch_full=None, rescore_factor=RESCORE_FACTOR):
+    """
+    top-k 内积检索。
+    :param mask: 可选的布尔数组，False 的行不参与检索 (已删除)
+    :param fetch_full: fn(rows) -> (len(rows), dim) float32；提供时先取 k * rescore_factor 个候选，
+                       再用原始向量重新打分
+    :return: (行号数组, 分数数组)，分数从高到低
+    """
+    all_scores = scores(codes, scales, query)
+    if mask is not None:
+        all_scores[~mask] = -np.inf
+    available = int(all_scores.shape[0] if mask is None else mask.sum())
+    k = min(k, available)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    candidates = min(available, k * rescore_factor) if fetch_full is not None else k
+    rows = np.argpartition(-all_scores, candidates - 1)[:candidates]
+    if fetch_full is not None:
+        row_scores = fetch_full(rows) @ np.asarray(query, dtype=np.float32)
+    else:
+        row_scores = all_scores[rows]
+    order = np.argsort(-row_scores)[:k]
+    return rows[order], row_scores[order]
@@ -0,0 +1,146 @@
+"""
+OSS 后台备份测试：使用基于本地目录的假 Bucket (不需要 oss2 和网络)。
+覆盖：内容去重、同一文件并发提交只上传一次、分片并行上传、失败后从检查点续传。
+
+用法: python test_oss_backup.py  (或 pytest test_oss_backup.py)
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import oss_backup
+
+
+class FakeBucket:
+    """把对象和分片写入本地目录，接口与 oss_backup.OssBucket 相同"""
+
+    def __init__(self, root, fail_parts=()):
+        self.root = root
+        self.id = f"fake://{root}"
+        self.fail_parts = set(fail_parts)  # 首次上传时失败的分片号
+        self.puts = 0
+        self.part_uploads = []
+        self.lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.root, "objects", key)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def put(self, key, data, headers=None):
+        os.makedirs(os.path.dirname(self._path(key)), exist_ok=True)
+        with open(self._path(key), "wb") as f:
+            f.write(data)
+        with self.lock:
+            self.puts += 1
+
+    def init_multipart(self, key, headers=None):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.root, "uploads", upload_id))
+        return upload_id
+
+    def upload_part(self, key, upload_id, part_number, data):
+        with self.lock:
+            if part_number in self.fail_parts:
+                self.fail_parts.discard(part_number)
+                raise IOError(f"simulated failure of part {part_number}")
+            self.part_uploads.append(part_number)
+        with open(os.path.join(self.root, "uploads", upload_id, str(part_number)), "wb") as f:
+            f.write(data)
+        return f"etag-{part_number}"
+
+    def list_parts(self, key, upload_id):
+        folder = os.path.join(self.root, "uploads", upload_id)
+        if not os.path.isdir(folder):
+            return None
+        return {int(name): f"etag-{name}" for name in os.listdir(folder)}
+
+    def complete_multipart(self, key, upload_id, parts):
+        folder = os.path.join(self.root, "uploads", upload_id)
+        os.makedirs(os.path.dirname(self._path(key)), exist_ok=True)
+        with open(self._path(key), "wb") as out:
+            for number in sorted(parts):
+                with open(os.path.join(folder, str(number)), "rb") as f:
+                    out.write(f.read())
+        shutil.rmtree(folder)
+
+
+def _setup():
+    root = tempfile.mkdtemp()
+    oss_backup.SPOOL_DIR = os.path.join(root, "spool")
+    oss_backup.RETRY_DELAY = 0
+    oss_backup._known_objects.clear()
+    return root, FakeBucket(os.path.join(root, "bucket"))
+
+
+def test_dedup_by_content():
+    root, bucket = _setup()
+    try:
+        data = b"syllabus" * 1000
+        ok, msg = oss_backup.submit_backup(data, "大纲.pdf", {}, bucket=bucket).result()
+        assert ok and "已备份" in msg, msg
+        # 同一内容换个文件名再次上传：不再写入
+        ok, msg = oss_backup.submit_backup(data, "copy.pdf", {}, bucket=bucket).result()
+        assert ok and "跳过" in msg, msg
+        # 进程重启后 (内存记录清空) 通过 Bucket 查询发现已存在
+        oss_backup._known_objects.clear()
+        ok, msg = oss_backup.submit_backup(data, "again.pdf", {}, bucket=bucket).result()
+        assert ok and "跳过" in msg, msg
+        assert bucket.puts == 1
+        assert not os.listdir(oss_backup.SPOOL_DIR)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_existing_object_is_not_spooled():
+    root, bucket = _setup()
+    try:
+        data = b"notes" * 1000
+        key = oss_backup.object_key(hashlib.sha256(data).hexdigest(), "notes.txt")
+        bucket.put(key, data)
+        # 云端已有该对象：后台任务先查询，不再把内容写入本地暂存目录
+        ok, msg = oss_backup.submit_backup(data, "notes.txt", {}, bucket=bucket).result()
+        assert ok and "跳过" in msg, msg
+        assert not os.path.exists(oss_backup.SPOOL_DIR)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_concurrent_submit_uploads_once():
+    root, bucket = _setup()
+    try:
+        data = os.urandom(4096)
+        futures = [oss_backup.submit_backup(data, "a.txt", {}, bucket=bucket) for _ in range(10)]
+        assert all(future.result()[0] for future in futures)
+        assert bucket.puts == 1
+    finally:
+        shutil.rmtree(root)
+
+
+def test_multipart_resumes_after_failure():
+    root, bucket = _setup()
+    try:
+        part_size = 1024
+        data = os.urandom(part_size * 8 + 100)  # 9 个分片
+        bucket.fail_parts = {3, 7}
+        future = oss_backup.submit_backup(data, "big.pdf", {}, bucket=bucket, multipart_threshold=part_size, part_size=part_size)
+        ok, msg = future.result()
+        assert ok, msg
+        key = oss_backup.object_key(hashlib.sha256(data).hexdigest(), "big.pdf")
+        with open(bucket._path(key), "rb") as f:
+            assert f.read() == data
+        # 重试时只补传失败的分片，已成功的分片不重复上传
+        assert sorted(bucket.part_uploads) == list(range(1, 10))
+        assert not os.listdir(oss_backup.SPOOL_DIR)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    for test in (test_dedup_by_content, test_existing_object_is_not_spooled, test_concurrent_submit_uploads_once, test_multipart_resumes_after_failure):
+        test()
+        print(f"{test.__name__}: OK")